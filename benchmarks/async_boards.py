@@ -0,0 +1,99 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Benchmark of configuring N boards in parallel with AsyncTCPhandler.
+
+Starts N emulated boards (emulator.DoppioEmulator) that answer each request after a fixed latency,
+then programs N_REGISTERS ASIC SPI registers on every board:
+    - TCPhandler, one board after the other (PacketBatch, pipelined per board)
+    - AsyncTCPhandler, all boards concurrently from one event loop
+
+Run: python async_boards.py [N boards]
+"""
+
+import asyncio
+import time
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo'))
+
+from tcphandler import TCPhandler
+from asynctcphandler import AsyncTCPhandler
+from emulator import DoppioEmulator
+
+N_REGISTERS = 250
+LATENCY = 0.002                 # Seconds from request to readback
+
+
+def registers():
+    return [(addr, 1, 8, addr & 0xFF) for addr in range(N_REGISTERS)]
+
+
+def sequentialBoards(addresses: list) -> list:
+    wrongly_programmed = []
+    for address in addresses:
+        tcp = TCPhandler(*address)
+        tcp.doPrint = False
+        wrongly_programmed += tcp.writeAsicSpiRegs(registers())
+        tcp.socketClose()
+    return wrongly_programmed
+
+
+async def concurrentBoards(addresses: list) -> list:
+    async def configure(address):
+        async with AsyncTCPhandler(*address) as tcp:
+            return await tcp.writeAsicSpiRegs(registers())
+    results = await asyncio.gather(*[configure(address) for address in addresses])
+    return sum(results, [])
+
+
+def main():
+    n_boards = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    boards = [DoppioEmulator(latency=LATENCY) for _ in range(n_boards)]
+    addresses = [board.tcp_address for board in boards]
+    print(f'{n_boards} boards, {N_REGISTERS} registers each, {LATENCY*1e3:.1f} ms latency')
+
+    t_start = time.perf_counter()
+    wrongly_programmed = sequentialBoards(addresses)
+    elapsed = time.perf_counter() - t_start
+    print(f'{"TCPhandler, sequential":<28} {elapsed:8.3f} s   wrong: {len(wrongly_programmed)}')
+
+    t_start = time.perf_counter()
+    wrongly_programmed = asyncio.run(concurrentBoards(addresses))
+    elapsed = time.perf_counter() - t_start
+    print(f'{"AsyncTCPhandler, concurrent":<28} {elapsed:8.3f} s   wrong: {len(wrongly_programmed)}')
+
+    for board in boards:
+        board.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Benchmark of DecodePool throughput against the number of worker processes.
+
+The shared-memory ring is filled with generated pipeline sampling packets (emulator.generatePackets)
+without UDP, then the time for the pool to decode and extract features of all of them is measured.
+Reports packets per second per number of workers, compared with decoding in this process.
+
+Run: python decode_pool.py
+"""
+
+import functools
+import multiprocessing
+import time
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo'))
+
+import numpy as np
+from decodepool import DecodePool
+from decoders import decode
+from emulator import generatePackets
+from features import extractDecoded
+
+N_SLOTS = 8192
+N_ROUNDS = 10                   # Ring fills per measurement
+MAX_BATCH = 256
+
+
+def main():
+    packets = generatePackets(4, N_SLOTS)
+    packet_size = packets.shape[1]
+    reduce = functools.partial(extractDecoded, threshold=50, triggered_only=True)
+    n_packets = N_SLOTS*N_ROUNDS
+
+    lengths = np.full(MAX_BATCH, packet_size)
+    t_start = time.perf_counter()
+    for _ in range(N_ROUNDS):
+        for start in range(0, N_SLOTS, MAX_BATCH):
+            reduce(decode(4, packets[start:start + MAX_BATCH], lengths))
+    elapsed = time.perf_counter() - t_start
+    print(f'{"in process":<16} {n_packets/elapsed:12.0f} packets/s')
+
+    for n_workers in sorted({1, 2, 4, multiprocessing.cpu_count()}):
+        pool = DecodePool(4, reduce, n_workers, N_SLOTS, packet_size, MAX_BATCH)
+        ring = pool.createRing()
+        pool.attach(ring)
+        ring.data[:] = packets
+        ring.lengths[:] = packet_size
+        t_start = time.perf_counter()
+        for _ in range(N_ROUNDS):
+            ring.publish(N_SLOTS)
+            for _ in pool.results(timeout=0):
+                pass
+        elapsed = time.perf_counter() - t_start
+        print(f'{n_workers:>2} workers       {n_packets/elapsed:12.0f} packets/s')
+        del ring
+        pool.ring = None
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Benchmark of the native-endian conversion stage on a histogram-and-mean workload, as in examples/udp.py.
+Times include the conversion.
+
+A capture of pipeline sampling packets with random ADC values is analysed:
+    big-endian: Header stripped with a '>u2' view, NumPy converts during each operation.
+    native in place: CaptureBuffer.samples() byteswaps once in the capture buffer.
+    native into out: CaptureBuffer.samples(out=...) strips and byteswaps into a preallocated array.
+
+Run: python native_endian.py
+"""
+
+import time
+
+import numpy as np
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo'))
+
+from capturebuffer import CaptureBuffer
+
+N_PACKETS = 10000
+HEADER_LENGTH = 10 + 14         # Common header + pipeline header, masked
+N_CELLS = 160
+REPEATS = 10
+BINS = np.arange(30000, 35000, 1)
+
+
+def fillCapture(capture, packets):
+    """Loads synthetic packets into capture, as captureNpackets with mask_header would."""
+    capture.reset(skip=HEADER_LENGTH)
+    capture.data[:, :packets.shape[1]] = packets
+    capture.lengths[:] = packets.shape[1]
+    capture.n_packets = capture.n_slots
+
+
+def workload(samples):
+    """Histogram, mean and per-cell mean of all samples."""
+    counts, _ = np.histogram(samples, BINS)
+    return counts, samples.mean(), samples.mean(axis=0)
+
+
+def timeVariant(name, capture, packets, get_samples):
+    elapsed = 0.0
+    for _ in range(REPEATS):
+        fillCapture(capture, packets)
+        t_start = time.perf_counter()
+        workload(get_samples())
+        elapsed += time.perf_counter() - t_start
+    n_samples = REPEATS*N_PACKETS*N_CELLS
+    print(f'{name:<20} {elapsed/REPEATS*1e3:8.1f} ms per capture {n_samples/elapsed/1e6:8.1f} Msamples/s')
+
+
+def main():
+    rng = np.random.default_rng(0)
+    packets = np.zeros((N_PACKETS, HEADER_LENGTH + 2*N_CELLS), dtype=np.uint8)
+    adc = rng.normal(32500, 300, (N_PACKETS, N_CELLS)).astype('>u2')
+    packets[:, HEADER_LENGTH:] = adc.view(np.uint8)
+
+    capture = CaptureBuffer(N_PACKETS, 1024)
+    out = np.empty((N_PACKETS, N_CELLS), dtype=np.uint16)
+
+    timeVariant('big-endian', capture, packets, lambda: capture.samples(native=False))
+    timeVariant('native in place', capture, packets, lambda: capture.samples())
+    timeVariant('native into out', capture, packets, lambda: capture.samples(out=out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Micro-benchmark of TCP packet header construction.
+
+Compares the former binary-string header (kept here as reference) with TCPhandler._getPacketHeader
+and with _packPacketHeader writing in place into a reused buffer. Reports headers built per second.
+
+Run: python packet_header.py
+"""
+
+import socket
+import time
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo'))
+
+from tcphandler import TCPhandler
+
+N_HEADERS = 200000
+
+
+def stringPacketHeader(packet_count: int, packet_type: int, len_reg_data: int) -> bytes:
+    """Header as built by ideasdoppyo 0.2.1, including the packet count round-trip."""
+    version = '{0:03b}'.format(0)
+    system_number = '{0:05b}'.format(0)
+    sequence_flag = '{0:02b}'.format(0)
+    reserved = '{0:032b}'.format(0)
+    packet_count_bin = '{0:014b}'.format(int('{0:014b}'.format(packet_count), 2) + 1)[-14:]
+    packet_type_bin = '{0:08b}'.format(packet_type)
+    data_length_bin = '{0:016b}'.format(len_reg_data)
+    packet_header = version + system_number + packet_type_bin + sequence_flag + packet_count_bin + reserved + data_length_bin
+    return int(packet_header, 2).to_bytes(10, 'big')
+
+
+def timeHeaders(name, build_header):
+    t_start = time.perf_counter()
+    for _ in range(N_HEADERS):
+        build_header()
+    elapsed = time.perf_counter() - t_start
+    print(f'{name:<32} {N_HEADERS/elapsed:12.0f} headers/s')
+
+
+def main():
+    # Listening socket so TCPhandler can connect, no board needed
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    tcp = TCPhandler(server_ip='127.0.0.1', port=server.getsockname()[1])
+    tcp.doPrint = False
+    buffer = bytearray(10)
+
+    def getPacketHeader():
+        tcp._getPacketHeader(0xC2, 7)
+        tcp._packetCountIncrement()
+
+    def packPacketHeader():
+        tcp._packPacketHeader(buffer, 0, 0xC2, 7)
+        tcp._packetCountIncrement()
+
+    timeHeaders('binary string (0.2.1)', lambda: stringPacketHeader(5, 0xC2, 7))
+    timeHeaders('_getPacketHeader', getPacketHeader)
+    timeHeaders('_packPacketHeader (in place)', packPacketHeader)
+
+    tcp.socketClose()
+    server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Benchmark suite of control-plane and data-plane hot paths, against loopback stand-ins.
+
+Each benchmark runs a workload of n_packets packets (n_bytes bytes) repeat times and reports
+the best time as packets/s and MB/s. Allocations are measured in a separate run with tracemalloc:
+peak bytes and allocated blocks still alive after the workload.
+
+Results are stored as JSON, to compare releases:
+    python suite.py                                  # Writes results/suite_<version>_<date>.json
+    python suite.py --compare results/old.json       # Also prints the change to an earlier result
+    python suite.py --filter decode                  # Only benchmarks containing 'decode'
+
+Control plane runs against emulator.DoppioEmulator with zero latency. UDP receive queues bursts of
+packets in the socket buffer on 127.0.0.1 and times only draining them, as udp_receive.py.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import socket
+import time
+import tracemalloc
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo'))
+
+import numpy as np
+from tcphandler import TCPhandler, PACKET_HEADER
+from udphandler import UDPhandler
+from capturebuffer import CaptureBuffer
+from configimage import ConfigurationImage
+from decoders import decode, toNativeEndian
+from emulator import DoppioEmulator, generatePackets
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+UDP_ADDRESS = ('127.0.0.1', 50112)
+UDP_BURST = 500                         # Packets queued per burst, must fit in the socket receive buffer
+
+BENCHMARKS = []
+
+
+def getVersion() -> str:
+    """ideasdoppyo.__version__ of the benchmarked source tree."""
+    init_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo', '__init__.py')
+    with open(init_path) as f:
+        return f.read().split("__version__ = '")[1].split("'")[0]
+
+
+def benchmark(name: str, n_packets: int, n_bytes: int, repeat: int=5):
+    """
+    Registers a benchmark. The decorated function sets up and returns the workload function,
+    and optionally a teardown function, as (workload, teardown).
+
+    The workload may return the seconds to report, timing only part of its work. Otherwise it is timed whole.
+    """
+    def register(setup):
+        BENCHMARKS.append({'name': name, 'setup': setup, 'n_packets': n_packets, 'n_bytes': n_bytes, 'repeat': repeat})
+        return setup
+    return register
+
+
+def runBenchmark(entry: dict) -> dict:
+    """Times and measures allocations of one benchmark."""
+    workload, teardown = entry['setup']()
+    try:
+        workload()                                          # Warm up
+        times = []
+        for _ in range(entry['repeat']):
+            t_start = time.perf_counter()
+            elapsed = workload()
+            times.append(time.perf_counter() - t_start if elapsed is None else elapsed)
+        tracemalloc.start()
+        blocks_before = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+        workload()
+        _, peak = tracemalloc.get_traced_memory()
+        blocks_after = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+    finally:
+        if teardown is not None:
+            teardown()
+    best = min(times)
+    return {'name': entry['name'],
+            'n_packets': entry['n_packets'],
+            'n_bytes': entry['n_bytes'],
+            'best_s': best,
+            'median_s': float(np.median(times)),
+            'packets_per_s': entry['n_packets']/best,
+            'MB_per_s': entry['n_bytes']/best/1e6,
+            'alloc_peak_bytes': peak,
+            'alloc_blocks_retained': blocks_after - blocks_before}
+
+
+# Control plane ------------------------------------------------------
+N_HEADERS = 100000
+N_READBACKS = 20000
+N_REGISTERS = 2000
+
+
+def connectEmulator() -> tuple:
+    board = DoppioEmulator()
+    tcp = TCPhandler(*board.tcp_address)
+    tcp.doPrint = False
+
+    def teardown():
+        tcp.socketClose()
+        board.close()
+    return tcp, teardown
+
+
+@benchmark('_getPacketHeader', N_HEADERS, 10*N_HEADERS)
+def setupPacketHeader():
+    tcp, teardown = connectEmulator()
+
+    def workload():
+        getPacketHeader = tcp._getPacketHeader
+        for _ in range(N_HEADERS):
+            getPacketHeader(0xC2, 7)
+    return workload, teardown
+
+
+@benchmark('_commonReadBack', N_READBACKS, 17*N_READBACKS)
+def setupCommonReadBack():
+    tcp, teardown = connectEmulator()
+    frames = b''.join(PACKET_HEADER.pack(0x00C4, i, 0, 7) + bytes([0, 2, 0, i & 0xFF, 0, 8, i & 0xFF])
+                      for i in range(N_READBACKS))
+
+    def workload():
+        # Readbacks buffered in the reader, as after one large receive
+        tcp.reader.view.release()
+        tcp.reader.buffer = bytearray(frames)
+        tcp.reader.view = memoryview(tcp.reader.buffer)
+        tcp.reader.start = 0
+        tcp.reader.end = len(frames)
+        now = time.monotonic()
+        tcp.not_readback = {i: (17, (i & 0xFF, i & 0xFF), now) for i in range(N_READBACKS)}
+        for _ in range(N_READBACKS):
+            tcp._commonReadBack(17)
+        tcp.now_readback = []
+    return workload, teardown
+
+
+def bulkRegisters() -> list:
+    return [(0x2000 + i, 1, 8, i & 0xFF) for i in range(N_REGISTERS)]
+
+
+@benchmark('writeAsicSpiReg, auto readback', N_REGISTERS, 16*N_REGISTERS)
+def setupAutoReadBack():
+    tcp, teardown = connectEmulator()
+
+    def workload():
+        tcp.setAutoReadBack(True, window=50)
+        for register in bulkRegisters():
+            tcp.writeAsicSpiReg(*register)
+        tcp.finishReadBack()
+        assert not tcp.checkReadBack()
+    return workload, teardown
+
+
+@benchmark('writeAsicSpiRegs (batch)', N_REGISTERS, 16*N_REGISTERS)
+def setupBatch():
+    tcp, teardown = connectEmulator()
+
+    def workload():
+        assert not tcp.writeAsicSpiRegs(bulkRegisters())
+    return workload, teardown
+
+
+@benchmark('ConfigurationImage.replay', N_REGISTERS, 16*N_REGISTERS)
+def setupReplay():
+    tcp, teardown = connectEmulator()
+    image = ConfigurationImage.fromOperations([('writeAsicSpiReg', *register) for register in bulkRegisters()], tcp)
+
+    def workload():
+        assert not image.replay(tcp)
+    return workload, teardown
+
+
+# Data plane ---------------------------------------------------------
+def setupUdpReceive(n_packets: int, packet_size: int, receive_burst) -> tuple:
+    """Workload queuing n_packets in bursts, returning the time of receive_burst(udp, burst) only."""
+    udp = UDPhandler(data_format=4, server_ip=UDP_ADDRESS[0], port=UDP_ADDRESS[1])
+    udp.udp_s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8*1024*1024)
+    udp.setTimeout(1.0)
+    sender = socket.socket(type=socket.SOCK_DGRAM)
+    packet = bytes(packet_size)
+
+    def workload():
+        elapsed = 0.0
+        remaining = n_packets
+        while remaining > 0:
+            burst = min(remaining, UDP_BURST)
+            for _ in range(burst):
+                sender.sendto(packet, UDP_ADDRESS)
+            t_start = time.perf_counter()
+            receive_burst(udp, burst)
+            elapsed += time.perf_counter() - t_start
+            remaining -= burst
+        return elapsed
+
+    def teardown():
+        sender.close()
+        udp.udp_s.close()
+    return workload, teardown
+
+
+def registerUdpBenchmarks():
+    for n_packets in [1000, 10000]:
+        for packet_size in [64, 344, 1024]:
+            def setupCollect(n_packets=n_packets, packet_size=packet_size):
+                # collectNpackets(N) receives N + 1 packets
+                return setupUdpReceive(n_packets, packet_size, lambda udp, burst: udp.collectNpackets(burst - 1))
+
+            def setupCapture(n_packets=n_packets, packet_size=packet_size):
+                capture = CaptureBuffer(UDP_BURST, 1024)
+
+                def receiveBurst(udp, burst):
+                    if udp.batch_receiver is None:
+                        udp.setBatchReceive(True, batch_size=64)
+                    udp.captureNpackets(burst, capture)
+                return setupUdpReceive(n_packets, packet_size, receiveBurst)
+
+            benchmark(f'collectNpackets N={n_packets} size={packet_size}', n_packets, n_packets*packet_size, repeat=3)(setupCollect)
+            benchmark(f'captureNpackets batch N={n_packets} size={packet_size}', n_packets, n_packets*packet_size, repeat=3)(setupCapture)
+
+
+registerUdpBenchmarks()
+
+
+N_DECODE = 20000
+
+
+@benchmark('decode pipeline sampling + cell sums', N_DECODE, N_DECODE*generatePackets(4, 1).shape[1])
+def setupDecode():
+    packets = generatePackets(4, N_DECODE)
+    lengths = np.full(N_DECODE, packets.shape[1])
+
+    def workload():
+        # decode only builds views, the sum reads every sample
+        decode(4, packets, lengths)['cells'].sum(axis=1)
+    return workload, None
+
+
+@benchmark('decode pipeline sampling + native cells', N_DECODE, N_DECODE*generatePackets(4, 1).shape[1])
+def setupDecodeNative():
+    packets = generatePackets(4, N_DECODE)
+    lengths = np.full(N_DECODE, packets.shape[1])
+
+    def workload():
+        toNativeEndian(decode(4, packets, lengths)['cells'], inplace=False)
+    return workload, None
+
+# --------------------------------------------------------------------
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--filter', default='', help='Run benchmarks with names containing this')
+    parser.add_argument('--output', default=None, help='JSON result path')
+    parser.add_argument('--compare', default=None, help='Earlier JSON result to compare with')
+    args = parser.parse_args()
+
+    results = []
+    for entry in BENCHMARKS:
+        if args.filter not in entry['name']:
+            continue
+        result = runBenchmark(entry)
+        results.append(result)
+        print(f'{result["name"]:<44} {result["packets_per_s"]:12.0f} packets/s {result["MB_per_s"]:9.1f} MB/s '
+              f'{result["alloc_peak_bytes"]/1024:9.0f} KiB peak {result["alloc_blocks_retained"]:6d} blocks')
+
+    version = getVersion()
+    run = {'version': version,
+           'date': datetime.datetime.now().isoformat(timespec='seconds'),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'platform': platform.platform(),
+           'results': results}
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f'suite_{version}_{datetime.date.today().isoformat()}.json')
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+    print(f'Results written to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {result['name']: result for result in json.load(f)['results']}
+        print(f'\nChange in packets/s compared to {args.compare}:')
+        for result in results:
+            if result['name'] in previous:
+                change = result['packets_per_s']/previous[result['name']]['packets_per_s'] - 1
+                flag = '  REGRESSION' if change < -0.1 else ''
+                print(f'{result["name"]:<44} {change*100:+7.1f} %{flag}')
+
+
+if __name__ == '__main__':
+    main()
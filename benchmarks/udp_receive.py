@@ -0,0 +1,105 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Benchmark of UDP receive paths against a loopback sender.
+
+A burst of pipeline sampling sized packets is queued in the socket buffer on 127.0.0.1,
+then only the time to drain the burst with each receive path is measured.
+Reports packets per second.
+
+Run: python udp_receive.py
+"""
+
+import socket
+import time
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo'))
+
+from udphandler import UDPhandler
+from capturebuffer import CaptureBuffer
+
+SERVER_IP = '127.0.0.1'
+PORT = 50111
+PACKET_SIZE = 10 + 14 + 320     # Common header + pipeline header + 160 cells
+BURST = 1000                    # Packets queued per burst, must fit in the socket receive buffer
+N_BURSTS = 50
+
+
+def timePath(name, sender, receive_burst):
+    """Queues N_BURSTS bursts and times receive_burst for each of them."""
+    packet = bytes(PACKET_SIZE)
+    address = (SERVER_IP, PORT)
+    elapsed = 0.0
+    for _ in range(N_BURSTS):
+        for _ in range(BURST):
+            sender.sendto(packet, address)
+        t_start = time.perf_counter()
+        receive_burst()
+        elapsed += time.perf_counter() - t_start
+    n_packets = N_BURSTS*BURST
+    print(f'{name:<36} {n_packets/elapsed:12.0f} packets/s {n_packets*PACKET_SIZE/elapsed/1e6:8.1f} MB/s')
+
+
+def main():
+    udp = UDPhandler(data_format=4, server_ip=SERVER_IP, port=PORT)
+    udp.udp_s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8*1024*1024)
+    udp.setTimeout(1.0)
+    sender = socket.socket(type=socket.SOCK_DGRAM)
+
+    capture = CaptureBuffer(BURST, udp.max_packet_size)
+
+    def receiveData():
+        for _ in range(BURST):
+            udp.receiveData()
+
+    def captureNpackets():
+        udp.captureNpackets(BURST, capture)
+
+    try:
+        timePath('receiveData (recvfrom per packet)', sender, receiveData)
+        timePath('captureNpackets (recv_into)', sender, captureNpackets)
+        udp.setBatchReceive(True, batch_size=64, use_recvmmsg=False)
+        timePath('captureNpackets (batch, fallback)', sender, captureNpackets)
+        udp.setBatchReceive(True, batch_size=64)
+        if udp.batch_receiver.has_recvmmsg:
+            timePath('captureNpackets (batch, recvmmsg)', sender, captureNpackets)
+        else:
+            print('recvmmsg not available on this platform.')
+    except socket.timeout:
+        print('Packets were lost, reduce BURST or increase the socket receive buffer.')
+    finally:
+        sender.close()
+        udp.udp_s.close()
+
+
+if __name__ == '__main__':
+    main()
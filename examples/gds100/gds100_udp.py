@@ -37,12 +37,9 @@ import sys, os
 sys.path.append('.\\..\\..\\src\\ideasdoppyo')
 
 from udphandler import UDPhandler
-from dataformats import pipeline_sampling_format, common_header_format, pipeline_data_format
 
-def GDS100binaryToDataframe(data_string):
-    gds100_format = common_header_format + pipeline_sampling_format
-    dtype = np.dtype(gds100_format)
-    np_data = np.frombuffer(data_string, dtype)
+def GDS100captureToDataframe(udp, capture):
+    np_data = udp.decodeCapture(capture)['packets']
     df_events = pd.DataFrame(np_data)
     print(df_events)
 
@@ -51,14 +48,14 @@ def main():
     udp = UDPhandler(data_format = 4)
 
     try:
-        data_string = udp.collectNpackets(10)
+        capture = udp.captureNpackets(10)
 
     except KeyboardInterrupt:
         udp.socketClose()
         sys.exit()
 
     # Process data
-    GDS100binaryToDataframe(data_string)
+    GDS100captureToDataframe(udp, capture)
 
 if __name__ == '__main__':
     main()
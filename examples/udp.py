@@ -36,18 +36,28 @@ import sys, os
 sys.path.append('.\\..\\src\\ideasdoppyo')
 
 from udphandler import UDPhandler
+from histogram import SampleHistogram
+
+N_CAPTURES = 100
 
 def main():
-    data_array = udp.collectNpackets(N=1000, include_header=False)
+    udp.mask_header = True
+    # Spectrum accumulated over all captures, without keeping the samples
+    histogram = SampleHistogram(low=30000, high=35000)
+    capture = None
+    for _ in range(N_CAPTURES):
+        capture = udp.captureNpackets(N=1000, capture=capture)
+        histogram.update(capture.samples(native=False))
+    data_array = capture.samples()      # Native-endian samples of the last capture, header masked
     udp.socketClose()
-    return data_array
+    return data_array, histogram
 
 if __name__ == '__main__':
     udp = UDPhandler(data_format=0)
     try:
-        data_array = main()
+        data_array, histogram = main()
         flat = np.array(data_array).flatten()
-        plt.hist(flat, np.arange(30000, 35000, 1))
+        plt.stairs(histogram.counts[0], histogram.edges)
         plt.xlabel('ADC[LSB]')
         plt.ylabel('Counts')
         plt.grid()
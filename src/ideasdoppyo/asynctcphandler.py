@@ -0,0 +1,292 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+asyncio client for IDEAS Doppio TCP control, for configuring many boards from one process.
+
+Same packet types as TCPhandler. Each write/read is a coroutine that returns when its readback
+arrives, matched by packet count. Coroutines on one board may run concurrently, up to window
+outstanding packets, and many boards are configured concurrently with asyncio.gather.
+
+Example:
+    async def configure(ip):
+        async with AsyncTCPhandler(ip) as tcp:
+            await tcp.writeSysReg(0xFFA0, 1, 1)
+            return await tcp.writeAsicSpiRegs([(0xFA00, 1, 8, 5), (0xFA01, 1, 8, 26)])
+
+    async def main():
+        return await asyncio.gather(*[configure(ip) for ip in board_ips])
+
+    wrongly_programmed = asyncio.run(main())
+"""
+
+import asyncio
+
+from tcphandler import PACKET_HEADER, doPrinter, getPacketHeaderFields, parseReadBack
+
+
+class AsyncTCPhandler:
+    """
+    server_ip: IP on the hardware side.
+    window: Maximum number of packets sent before their readbacks are received.
+    """
+    def __init__(self, server_ip: str="10.10.0.50", port: int=50010, window: int=50):
+        self.server_ip = server_ip
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+        # General variables for all ASICs and systems
+        self.asic_id = int(0).to_bytes(1, 'big')
+
+        # For SPI transactions
+        self.version = 0                                    # 3 bits
+        self.system_number = 0                              # 5 bits
+        self.sequence_flag = 0                              # 2 bits
+        self.packet_count = 0                               # 14 bits
+        self.reserved = 0                                   # 32 bits
+        self.spi_format = int(2).to_bytes(1, 'big')         # System level SPI format.
+
+        # Printer instance
+        self.doPrint = False
+        self.doPrinter = doPrinter(1)
+        self.trace = None                                   # Optional PacketTrace, see TCPhandler.setTrace
+
+        # TCP ReadBack
+        self.window = window
+        self.readback_timeout = 3.0                         # Seconds before an outstanding readback is reported
+        self.not_readback = {}                              # packet_count: (future, reg_addr)
+        self.wrongly_programmed = []                        # Addresses with wrong readback
+        self.readback_timeouts = []                         # Addresses without readback
+        self.unexpected_readback = []                       # Packet counts of readbacks without request
+        self._window_slots = None
+        self._read_task = None
+
+    async def connect(self) -> None:
+        """Opens the connection and starts receiving readbacks."""
+        self.reader, self.writer = await asyncio.open_connection(self.server_ip, self.port)
+        self._window_slots = asyncio.Semaphore(self.window)
+        self._read_task = asyncio.get_running_loop().create_task(self._readLoop())
+
+    async def close(self) -> None:
+        """Closes the connection. Outstanding coroutines raise ConnectionError."""
+        if self._read_task is not None:
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except asyncio.CancelledError:
+                pass
+            self._read_task = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+            self.writer = None
+        self._failPending(ConnectionError('TCP connection closed.'))
+
+    async def __aenter__(self) -> 'AsyncTCPhandler':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
+
+    def _tracePacket(self, packet: bytes) -> None:
+        """Prints packet if doPrint, and records it in the trace."""
+        if self.doPrint:
+            self.doPrinter.data_bytes = packet
+            print(self.doPrinter)
+        if self.trace is not None:
+            self.trace.record(packet)
+
+    def _failPending(self, error: Exception) -> None:
+        for future, _ in self.not_readback.values():
+            if not future.done():
+                future.set_exception(error)
+        self.not_readback.clear()
+
+    async def _readLoop(self) -> None:
+        """Receives readbacks and resolves the future of the matching request."""
+        try:
+            while True:
+                header = await self.reader.readexactly(PACKET_HEADER.size)
+                data_length = (header[8] << 8) | header[9]
+                frame = header + await self.reader.readexactly(data_length)
+                if self.doPrint or self.trace is not None:
+                    self._tracePacket(frame)
+                packet_count, reg_addr, value = parseReadBack(frame)
+                request = self.not_readback.pop(packet_count, None)
+                if request is None:
+                    self.unexpected_readback.append(packet_count)
+                    if self.doPrint:
+                        print(f'ERROR: Readback without request, packet count {packet_count}')
+                    continue
+                future, _ = request
+                if not future.done():
+                    future.set_result((reg_addr, value))
+        except (asyncio.IncompleteReadError, ConnectionError) as error:
+            self._failPending(ConnectionError(f'TCP connection to {self.server_ip} closed: {error}'))
+
+    def _getPacketHeader(self, packet_type: hex, len_reg_data: hex) -> bytes:
+        """Packet header with the current packet_count, see TCPhandler._getPacketHeader."""
+        packet_id, packet_sequence = getPacketHeaderFields(self, packet_type)
+        return PACKET_HEADER.pack(packet_id, packet_sequence, self.reserved, len_reg_data)
+
+    async def _request(self, packet_type: hex, data_field: bytes, reg_addr: hex=None) -> tuple:
+        """
+        Sends one packet and waits for its readback.
+
+        Returns:
+            (reg_addr, value): Of the readback. None if no readback within readback_timeout.
+        """
+        assert (self.writer is not None), f"AsyncTCPhandler is not connected, use connect()"
+        async with self._window_slots:
+            packet_count = self.packet_count
+            if packet_count in self.not_readback:
+                # Packet count wrapped around before the old readback arrived
+                old_future = self.not_readback.pop(packet_count)[0]
+                if not old_future.done():
+                    old_future.set_exception(asyncio.TimeoutError())
+            future = asyncio.get_running_loop().create_future()
+            self.not_readback[packet_count] = (future, reg_addr)
+            write_packet = self._getPacketHeader(packet_type, len(data_field)) + data_field
+            self.packet_count = (self.packet_count + 1) & 0x3FFF
+            self.writer.write(write_packet)
+            if self.doPrint or self.trace is not None:
+                self._tracePacket(write_packet)
+            await self.writer.drain()
+            try:
+                return await asyncio.wait_for(future, self.readback_timeout)
+            except asyncio.CancelledError:
+                if self.not_readback.get(packet_count, (None,))[0] is future:
+                    del self.not_readback[packet_count]
+                raise
+            except asyncio.TimeoutError:
+                if self.not_readback.get(packet_count, (None,))[0] is future:
+                    del self.not_readback[packet_count]
+                if reg_addr is not None:
+                    self.readback_timeouts.append(hex(reg_addr))
+                if self.doPrint:
+                    print(f'ERROR: No readback for packet count {packet_count}, address {reg_addr}')
+                return None
+
+    def _verify(self, readback: tuple, reg_addr: hex, value: hex) -> bool:
+        if readback is None:
+            return False
+        if readback != (reg_addr, value):
+            self.wrongly_programmed.append(hex(reg_addr))
+            if self.doPrint:
+                print(f'ERROR: Readback is wrong!: {reg_addr}')
+            return False
+        return True
+
+    async def writeSysReg(self, reg_addr: hex, value: hex, len_reg_data: hex) -> bool:
+        """
+        Writes system register value. Packet type 0x10.
+
+        Returns:
+            return_val: Verification that the address and value is correctly written.
+        """
+        data_field = reg_addr.to_bytes(2, 'big') + len_reg_data.to_bytes(1, 'big') + value.to_bytes(len_reg_data, 'big')
+        readback = await self._request(0x10, data_field, reg_addr)
+        return self._verify(readback, reg_addr, value)
+
+    async def readSysReg(self, reg_addr: hex) -> int:
+        """
+        Reads system register value. Packet type 0x11.
+
+        Returns:
+            value: Read value, None if no readback.
+        """
+        readback = await self._request(0x11, reg_addr.to_bytes(2, 'big'), reg_addr)
+        return None if readback is None else readback[1]
+
+    async def writeReadShiftReg(self, configuration_data: bytes) -> int:
+        """
+        Write/read ASICs with shift registers. Packet type 0xC0.
+
+        Returns:
+            value: Shifted-out data, None if no readback.
+        """
+        conf_len = len(configuration_data)
+        conf_bit_len = (conf_len*8-(8-conf_len%8)).to_bytes(2, 'big')
+        readback = await self._request(0xC0, self.asic_id + conf_bit_len + configuration_data)
+        return None if readback is None else readback[1]
+
+    async def writeAsicSpiReg(self, reg_addr: hex, reg_length: int, asic_bit_length: int, write_data: hex) -> bool:
+        """
+        Write ASIC SPI register. Packet type 0xC2.
+
+        Returns:
+            return_val: Verification that the address and value is correctly written.
+        """
+        data_field = (self.asic_id + self.spi_format + reg_addr.to_bytes(2, 'big')
+                      + asic_bit_length.to_bytes(2, 'big') + write_data.to_bytes(reg_length, 'big'))
+        readback = await self._request(0xC2, data_field, reg_addr)
+        return self._verify(readback, reg_addr, write_data)
+
+    async def readAsicSpiReg(self, reg_addr: hex, reg_bit_length: int) -> int:
+        """
+        Read ASIC SPI Register. Packet type 0xC3.
+
+        Returns:
+            value: Read value, None if no readback.
+        """
+        data_field = self.asic_id + self.spi_format + reg_addr.to_bytes(2, 'big') + reg_bit_length.to_bytes(2, 'big')
+        readback = await self._request(0xC3, data_field, reg_addr)
+        return None if readback is None else readback[1]
+
+    async def writeAsicSpiRegs(self, registers: list) -> list:
+        """
+        Writes many ASIC SPI registers, pipelined up to window outstanding packets.
+
+        Args:
+            registers: List of (reg_addr, reg_length, asic_bit_length, write_data).
+
+        Returns:
+            wrongly_programmed: Addresses with wrong or missing readback.
+        """
+        results = await asyncio.gather(*[self.writeAsicSpiReg(*register) for register in registers])
+        return [hex(register[0]) for register, ok in zip(registers, results) if not ok]
+
+    async def writeSysRegs(self, registers: list) -> list:
+        """
+        Writes many system registers, pipelined up to window outstanding packets.
+
+        Args:
+            registers: List of (reg_addr, value, len_reg_data).
+
+        Returns:
+            wrongly_programmed: Addresses with wrong or missing readback.
+        """
+        results = await asyncio.gather(*[self.writeSysReg(*register) for register in registers])
+        return [hex(register[0]) for register, ok in zip(registers, results) if not ok]
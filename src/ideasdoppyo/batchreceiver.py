@@ -0,0 +1,190 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Batched receive of UDP packets. Drains many datagrams per Python call into a CaptureBuffer.
+On Linux recvmmsg is called through ctypes, other platforms fall back to a recv_into loop.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import sys
+import weakref
+
+import numpy as np
+from capturebuffer import CaptureBuffer
+
+
+MSG_DONTWAIT = 0x40          # Linux value, only used with recvmmsg
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+def _loadRecvmmsg():
+    """Returns libc recvmmsg, or None if not available."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+_recvmmsg = _loadRecvmmsg()
+
+
+class BatchReceiver:
+    """
+    Receives up to batch_size packets per call into consecutive slots of a CaptureBuffer.
+
+    Blocks until at least one packet is available, then returns everything already queued in the socket.
+    """
+    def __init__(self, udp_s: socket.socket, batch_size: int=64, use_recvmmsg: bool=True):
+        """
+        Args:
+            udp_s: Bound UDP socket.
+            batch_size: Maximum number of packets per call.
+            use_recvmmsg: Use recvmmsg if available. If False, always use the recv_into loop.
+        """
+        self.udp_s = udp_s
+        self.batch_size = batch_size
+        self.has_recvmmsg = use_recvmmsg and _recvmmsg is not None
+
+        # recvmmsg message tables, built once per CaptureBuffer: capture: (iovecs, msgs, msg_len)
+        self._tables = weakref.WeakKeyDictionary()
+
+    def _getTable(self, capture: CaptureBuffer) -> tuple:
+        """Points one iovec per slot of capture, and exposes all msg_len fields as a numpy view."""
+        table = self._tables.get(capture)
+        if table is not None:
+            return table
+        n_slots = capture.n_slots
+        base_address = capture.data.ctypes.data
+        iovecs = (_iovec * n_slots)()
+        msgs = (_mmsghdr * n_slots)()
+        for i in range(n_slots):
+            iovecs[i].iov_base = base_address + i*capture.slot_size
+            iovecs[i].iov_len = capture.slot_size
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+        msg_table = np.frombuffer(msgs, dtype=np.uint8).reshape(n_slots, ctypes.sizeof(_mmsghdr))
+        msg_len = msg_table[:, _mmsghdr.msg_len.offset:_mmsghdr.msg_len.offset + 4].view(np.uint32)[:, 0]
+        table = (iovecs, msgs, msg_len)
+        self._tables[capture] = table
+        return table
+
+    def _waitReadable(self, timeout: float) -> None:
+        """Blocks until the socket has data. Raises socket.timeout."""
+        if timeout is None:
+            timeout = self.udp_s.gettimeout()
+        readable, _, _ = select.select([self.udp_s], [], [], timeout)
+        if not readable:
+            raise socket.timeout('timed out')
+
+    def receiveInto(self, capture: CaptureBuffer, start: int, count: int=None, timeout: float=None) -> int:
+        """
+        Receives packets into capture slots start, start+1, ... and updates capture.lengths.
+
+        Args:
+            capture: Destination buffer.
+            start: First slot to fill.
+            count: Maximum number of packets, limited by batch_size and free slots.
+            timeout: Seconds to wait for the first packet. Defaults to the socket timeout.
+
+        Returns:
+            n: Number of packets received, at least 1.
+        """
+        if count is None:
+            count = self.batch_size
+        count = min(count, self.batch_size, capture.n_slots - start)
+        assert (count > 0), f"no free slots in capture buffer from slot {start}"
+
+        if self.has_recvmmsg:
+            return self._receiveRecvmmsg(capture, start, count, timeout)
+        return self._receiveLoop(capture, start, count, timeout)
+
+    def _receiveRecvmmsg(self, capture: CaptureBuffer, start: int, count: int, timeout: float) -> int:
+        _, msgs, msg_len = self._getTable(capture)
+        fd = self.udp_s.fileno()
+        msgs_address = ctypes.addressof(msgs) + start*ctypes.sizeof(_mmsghdr)
+        while True:
+            self._waitReadable(timeout)
+            n = _recvmmsg(fd, msgs_address, count, MSG_DONTWAIT, None)
+            if n > 0:
+                capture.lengths[start:start + n] = msg_len[start:start + n]
+                return n
+            err = ctypes.get_errno()
+            if n < 0 and err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise OSError(err, 'recvmmsg: ' + errno.errorcode.get(err, str(err)))
+
+    def _receiveLoop(self, capture: CaptureBuffer, start: int, count: int, timeout: float) -> int:
+        """Fallback: waits for the first packet, then drains queued packets with the socket non-blocking."""
+        recv_into = self.udp_s.recv_into
+        slot_views = capture.slot_views
+        lengths = capture.lengths
+        n = 0
+        socket_timeout = self.udp_s.gettimeout()
+        while n == 0:
+            self._waitReadable(timeout)
+            self.udp_s.setblocking(False)
+            try:
+                while n < count:
+                    lengths[start + n] = recv_into(slot_views[start + n])
+                    n += 1
+            except BlockingIOError:
+                pass
+            finally:
+                self.udp_s.settimeout(socket_timeout)
+        return n
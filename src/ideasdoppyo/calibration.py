@@ -0,0 +1,189 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Per-cell pedestal and gain calibration of pipeline sampling, keyed by Source ID.
+
+Pedestals are estimated with a running mean per Source ID and cell, updated once per batch of
+decoded packets. Correction works on the whole (N, 160) cell block in a few array operations.
+Tables are saved as one .npy file and memory-mapped on load.
+
+Example:
+    calibration = PedestalCalibration.load('pedestals.npy')     # Or PedestalCalibration()
+    for data, lengths in ring.batches(timeout=1.0):
+        decoded = decode(4, data, lengths)
+        calibration.updateDecoded(decoded)                       # On pedestal (random trigger) runs
+        corrected = calibration.correctDecoded(decoded, out=buffer)
+    calibration.save('pedestals.npy')
+"""
+
+import os
+
+import numpy as np
+from dataformats import PIPELINE_CELLS
+
+N_SOURCES = 256                     # Source ID is one byte
+
+
+def getTableDtype(n_cells: int=PIPELINE_CELLS) -> np.dtype:
+    """Calibration table record of one Source ID."""
+    return np.dtype([('pedestal', '<f4', (n_cells,)),
+                     ('gain', '<f4', (n_cells,)),
+                     ('n_updates', '<i8')])
+
+
+class PedestalCalibration:
+    """
+    Pedestal and gain per Source ID and cell. corrected = (sample - pedestal)*gain.
+
+    Args:
+        mode: 'ewma' exponential moving average with weight alpha per packet, or 'window' mean of
+            the last window packets per Source ID. The window is not saved: after load, the first update
+            of a Source ID replaces its pedestal with the mean of the packets received since.
+        table: Table of getTableDtype records, e.g. memory-mapped by load. New table if None.
+    """
+    def __init__(self, mode: str='ewma', alpha: float=0.01, window: int=100, n_cells: int=PIPELINE_CELLS,
+                 table: np.ndarray=None):
+        assert (mode in ['ewma', 'window']), f"mode should be 'ewma' or 'window'"
+        self.mode = mode
+        self.alpha = alpha
+        self.window = window
+        self.n_cells = n_cells
+        if table is None:
+            table = np.zeros(N_SOURCES, getTableDtype(n_cells))
+            table['gain'] = 1.0
+        self.table = table
+        self.pedestal = table['pedestal']           # (N_SOURCES, n_cells) views into table
+        self.gain = table['gain']
+        self.n_updates = table['n_updates']
+        self._ring = None                           # (N_SOURCES, window, n_cells) last packets, mode 'window'
+        self._ring_position = np.zeros(N_SOURCES, np.int64)
+
+    def update(self, cells: np.ndarray, source_ids: np.ndarray) -> None:
+        """
+        Updates the pedestals of the Source IDs in the batch.
+
+        Args:
+            cells: (N, n_cells) samples, any integer or float dtype and byte order.
+            source_ids: (N,) Source ID per packet.
+        """
+        if len(cells) == 0:
+            return
+        source_ids = np.asarray(source_ids, np.int64)
+        counts = np.bincount(source_ids, minlength=N_SOURCES)
+        sources = np.flatnonzero(counts)
+        if self.mode == 'ewma':
+            self._updateEwma(cells, source_ids, counts, sources)
+        else:
+            self._updateWindow(cells, source_ids, counts, sources)
+        self.n_updates[sources] += counts[sources]
+
+    def _updateEwma(self, cells, source_ids, counts, sources) -> None:
+        # Batch mean per Source ID and cell, applied as counts[source] packets at the batch mean
+        flat_index = (source_ids[:, None]*self.n_cells + np.arange(self.n_cells)).ravel()
+        sums = np.bincount(flat_index, weights=cells.ravel(), minlength=N_SOURCES*self.n_cells)
+        batch_mean = sums.reshape(N_SOURCES, self.n_cells)[sources]/counts[sources, None]
+        keep = (1.0 - self.alpha)**counts[sources]
+        keep[self.n_updates[sources] == 0] = 0.0                # First batch of a Source ID sets the pedestal
+        self.pedestal[sources] = keep[:, None]*self.pedestal[sources] + (1.0 - keep[:, None])*batch_mean
+
+    def _updateWindow(self, cells, source_ids, counts, sources) -> None:
+        if self._ring is None:
+            self._ring = np.zeros((N_SOURCES, self.window, self.n_cells), np.float32)
+        # Position of each packet among the packets of its Source ID in the batch
+        order = np.argsort(source_ids, kind='stable')
+        first = np.cumsum(counts) - counts
+        rank = np.empty(len(source_ids), np.int64)
+        rank[order] = np.arange(len(source_ids)) - first[source_ids[order]]
+        slots = (self._ring_position[source_ids] + rank) % self.window
+        self._ring[source_ids, slots] = cells
+        self._ring_position[sources] += counts[sources]
+        filled = np.minimum(self._ring_position[sources], self.window)
+        self.pedestal[sources] = self._ring[sources].sum(axis=1)/filled[:, None]
+
+    def updateDecoded(self, decoded: dict) -> None:
+        """Updates from decoded pipeline sampling packets, see decoders.decode."""
+        self.update(decoded['cells'], decoded['packets']['Source ID'])
+
+    def correct(self, cells: np.ndarray, source_ids: np.ndarray, out: np.ndarray=None) -> np.ndarray:
+        """
+        Pedestal-subtracted and gain-corrected samples.
+
+        Args:
+            cells: (N, n_cells) samples.
+            source_ids: (N,) Source ID per packet.
+            out: (>= N, n_cells) float32 array to reuse. May be cells itself, if cells is float32.
+
+        Returns:
+            corrected: (N, n_cells) float32, a view of out if given.
+        """
+        n = len(cells)
+        if out is None:
+            out = np.empty((n, self.n_cells), np.float32)
+        out = out[:n]
+        source_ids = np.asarray(source_ids)
+        if n and (source_ids == source_ids[0]).all():
+            # One Source ID, broadcast its row instead of gathering a row per packet
+            pedestal = self.pedestal[source_ids[0]]
+            gain = self.gain[source_ids[0]]
+        else:
+            pedestal = self.pedestal[source_ids]
+            gain = self.gain[source_ids]
+        np.subtract(cells, pedestal, out=out, casting='unsafe')
+        np.multiply(out, gain, out=out)
+        return out
+
+    def correctDecoded(self, decoded: dict, out: np.ndarray=None) -> np.ndarray:
+        """Corrects decoded pipeline sampling packets, see correct."""
+        return self.correct(decoded['cells'], decoded['packets']['Source ID'], out)
+
+    def setGain(self, source_id: int, gain: np.ndarray) -> None:
+        """Gain per cell of source_id, scalar or (n_cells,)."""
+        self.gain[source_id] = gain
+
+    def save(self, path: str) -> None:
+        """Saves the table as .npy, see load. A memory-mapped table is flushed instead if path is its file."""
+        if isinstance(self.table, np.memmap) and self.table.filename == os.path.abspath(path):
+            self.table.flush()
+        else:
+            np.save(path, np.asarray(self.table))
+
+    @classmethod
+    def load(cls, path: str, writable: bool=True, **options) -> 'PedestalCalibration':
+        """
+        Memory-maps a table saved by save.
+
+        Args:
+            writable: Updates are written to the file. Else the table is read-only.
+            options: mode, alpha, window, see PedestalCalibration.
+        """
+        table = np.load(path, mmap_mode='r+' if writable else 'r')
+        n_cells = table.dtype['pedestal'].shape[0]
+        return cls(n_cells=n_cells, table=table, **options)
@@ -0,0 +1,148 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Preallocated capture buffer for UDP packets from IDEAS Doppio.
+Packets are received directly into fixed-size slots, no intermediate bytes objects are created.
+"""
+
+import numpy as np
+
+MAX_PACKET_SIZE = 2048      # Default slot size, holds the longest Doppio data packets of about 1500 bytes
+
+
+def getBufferSize(n_slots: int, slot_size: int) -> int:
+    """Bytes of an external CaptureBuffer buffer: packet slots, then int64 lengths."""
+    return n_slots*slot_size + 8*n_slots
+
+
+def getBufferViews(buffer, n_slots: int, slot_size: int) -> tuple:
+    """(data, lengths) arrays of a CaptureBuffer in an external buffer, see getBufferSize."""
+    data = np.ndarray((n_slots, slot_size), dtype=np.uint8, buffer=buffer)
+    lengths = np.ndarray(n_slots, dtype=np.int64, buffer=buffer, offset=n_slots*slot_size)
+    return data, lengths
+
+
+class CaptureBuffer:
+    """
+    Fixed memory packet store of n_slots * slot_size bytes, allocated once.
+
+    Packet i is stored from byte offset i*slot_size in buffer. Header masking is done by
+    offsetting views (skip), the received bytes are never moved.
+    """
+    def __init__(self, n_slots: int, slot_size: int=MAX_PACKET_SIZE, buffer=None):
+        """
+        Args:
+            n_slots: Maximum number of packets held.
+            slot_size: Maximum byte length of one packet. Longer packets are truncated.
+            buffer: Writable buffer of at least getBufferSize bytes to hold data and lengths,
+                e.g. multiprocessing.shared_memory.SharedMemory.buf. Allocated if None.
+        """
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+
+        if buffer is None:
+            self.data = np.zeros((n_slots, slot_size), dtype=np.uint8)
+            self.lengths = np.zeros(n_slots, dtype=np.int64)    # Received bytes per packet, including header
+        else:
+            self.data, self.lengths = getBufferViews(buffer, n_slots, slot_size)
+        self.buffer = self.data.reshape(-1)                 # Flat view of data
+
+        flat = memoryview(self.buffer)
+        self.slot_views = [flat[i*slot_size:(i+1)*slot_size] for i in range(n_slots)]
+
+        self.skip = 0                                       # Bytes masked at start of each packet
+        self.n_packets = 0
+        self.native_endian = False                          # Payloads byteswapped in place by samples()
+
+    def __len__(self) -> int:
+        return self.n_packets
+
+    def reset(self, skip: int=0) -> None:
+        """Marks buffer as empty. Memory is reused, not cleared."""
+        self.skip = skip
+        self.n_packets = 0
+        self.native_endian = False
+
+    @property
+    def offsets(self) -> np.ndarray:
+        """Byte offset of each payload (header masked) in buffer."""
+        return np.arange(self.n_packets, dtype=np.int64)*self.slot_size + self.skip
+
+    @property
+    def payload_lengths(self) -> np.ndarray:
+        """Byte length of each payload (header masked)."""
+        return np.maximum(self.lengths[:self.n_packets] - self.skip, 0)
+
+    def packet(self, index: int) -> memoryview:
+        """Zero-copy view of payload of packet index."""
+        if not 0 <= index < self.n_packets:
+            raise IndexError(f'Packet index {index} out of range, {self.n_packets} packets captured.')
+        return self.slot_views[index][self.skip:max(self.lengths[index], self.skip)]
+
+    def payloads(self) -> np.ndarray:
+        """
+        Zero-copy 2D view (n_packets, payload length) of all payloads.
+
+        NOTE For packets of different length, bytes beyond payload_lengths are undefined.
+        """
+        max_length = int(self.lengths[:self.n_packets].max()) if self.n_packets else self.skip
+        return self.data[:self.n_packets, self.skip:max(max_length, self.skip)]
+
+    def packed(self) -> bytes:
+        """All payloads concatenated, i.e. the format returned by UDPhandler.collectNpackets."""
+        return b''.join([self.packet(i) for i in range(self.n_packets)])
+
+    def samples(self, sample_dtype: str='>u2', native: bool=True, out: np.ndarray=None) -> np.ndarray:
+        """
+        Payloads as a (n_packets, n_samples) array of sample_dtype, e.g. the 160 cells of pipeline sampling
+        with mask_header set.
+
+        Header stripping and byteswap are done in one pass over the data:
+            out given: Samples are converted into out, the capture is not changed.
+            native: Samples are byteswapped once, in place in this buffer, and a native-endian view is returned.
+                The payload bytes are then native-endian until reset(), so packet() and decoders no longer apply.
+            otherwise: A view with sample_dtype is returned.
+        """
+        sample_dtype = np.dtype(sample_dtype)
+        itemsize = sample_dtype.itemsize
+        n = self.n_packets
+        n_samples = max(int(self.lengths[:n].max()) - self.skip, 0)//itemsize if n else 0
+        stored_dtype = sample_dtype.newbyteorder('=') if self.native_endian else sample_dtype
+        view = np.ndarray((n, n_samples), dtype=stored_dtype, buffer=self.buffer, offset=self.skip,
+                          strides=(self.slot_size, itemsize))
+        if out is not None:
+            np.copyto(out[:n, :n_samples], view)
+            return out[:n, :n_samples]
+        if native and not stored_dtype.isnative:
+            view.byteswap(inplace=True)
+            self.native_endian = True
+            view = view.view(sample_dtype.newbyteorder('='))
+        return view
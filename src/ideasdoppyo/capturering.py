@@ -0,0 +1,251 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Background capture of UDP packets into a fixed-size ring of packet slots.
+One producer thread receives, one consumer reads. The ring is single-producer/single-consumer
+and needs no locks: only the producer advances write_count, only the consumer advances read_count.
+"""
+
+import socket
+import threading
+
+from capturebuffer import CaptureBuffer, MAX_PACKET_SIZE
+from batchreceiver import BatchReceiver
+from sequencechecker import SequenceChecker
+from runfile import RunWriter
+
+
+class CaptureRing:
+    """
+    Ring of n_slots packet slots of slot_size bytes.
+
+    Statistics for sizing the ring:
+        high_water: Largest number of filled slots seen.
+        overruns: Packets received while the ring was full, and therefore discarded.
+        packets_received: All packets received by the producer, including overruns.
+
+    error: Exception that stopped the producer, None while capturing or after a normal stop.
+    """
+    def __init__(self, n_slots: int, slot_size: int=MAX_PACKET_SIZE, skip: int=0, buffer=None):
+        """
+        Args:
+            n_slots: Number of packet slots.
+            slot_size: Maximum byte length of one packet.
+            skip: Bytes masked at start of each packet in packets().
+            buffer: External buffer for the slots, e.g. shared memory. See CaptureBuffer.
+        """
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.skip = skip
+
+        self.capture = CaptureBuffer(n_slots, slot_size, buffer)
+        self.data = self.capture.data
+        self.lengths = self.capture.lengths
+
+        self.write_count = 0
+        self.read_count = 0
+        self.stopped = False
+        self.error = None
+        self._data_event = threading.Event()
+
+        self.high_water = 0
+        self.overruns = 0
+        self.packets_received = 0
+
+    @property
+    def fill(self) -> int:
+        """Number of filled slots not yet released by the consumer."""
+        return self.write_count - self.read_count
+
+    def freeSlots(self) -> tuple:
+        """Producer: (start, count) of contiguous free slots."""
+        start = self.write_count % self.n_slots
+        count = min(self.n_slots - self.fill, self.n_slots - start)
+        return start, count
+
+    def publish(self, n: int) -> None:
+        """Producer: hands n filled slots to the consumer."""
+        self.write_count += n
+        self.packets_received += n
+        fill = self.write_count - self.read_count
+        if fill > self.high_water:
+            self.high_water = fill
+        self._data_event.set()
+
+    def discard(self, n: int) -> None:
+        """Producer: counts n packets received while the ring was full."""
+        self.overruns += n
+        self.packets_received += n
+
+    def stop(self, error: Exception=None) -> None:
+        """Producer: no more packets will be published. error is the reason if the producer failed."""
+        self.error = error
+        self.stopped = True
+        self._data_event.set()
+
+    def waitPublished(self, count: int, timeout: float=None) -> bool:
+        """
+        Consumer: waits until more than count packets are published in total, see write_count.
+
+        Returns:
+            available: False on timeout, or when stopped.
+        """
+        while self.write_count <= count:
+            if self.stopped:
+                return False
+            self._data_event.clear()
+            if self.write_count > count:
+                break
+            if not self._data_event.wait(timeout):
+                return False
+        return True
+
+    def acquire(self, max_n: int=None, timeout: float=None) -> tuple:
+        """
+        Consumer: waits for filled slots.
+
+        Args:
+            max_n: Maximum number of slots returned.
+            timeout: Seconds to wait. None waits until data or stop.
+
+        Returns:
+            (start, count): Contiguous filled slots. count is 0 on timeout, or when stopped and empty.
+        """
+        while self.write_count == self.read_count:
+            if self.stopped:
+                return 0, 0
+            self._data_event.clear()
+            if self.write_count != self.read_count:
+                break
+            if not self._data_event.wait(timeout):
+                return 0, 0
+        start = self.read_count % self.n_slots
+        count = min(self.write_count - self.read_count, self.n_slots - start)
+        if max_n is not None:
+            count = min(count, max_n)
+        return start, count
+
+    def release(self, n: int) -> None:
+        """Consumer: returns n slots to the producer."""
+        self.read_count += n
+
+    def batches(self, max_n: int=None, timeout: float=None):
+        """
+        Consumer generator of filled slots as zero-copy views.
+
+        Yields:
+            (data, lengths): data is a (count, slot_size) uint8 view, lengths the received bytes per slot.
+            The slots are returned to the ring when the next batch is requested.
+        """
+        while True:
+            start, count = self.acquire(max_n, timeout)
+            if count == 0:
+                return
+            try:
+                yield self.data[start:start + count], self.lengths[start:start + count]
+            finally:
+                self.release(count)
+
+    def packets(self, timeout: float=None):
+        """
+        Consumer generator of single packet payloads (header masked by skip) as zero-copy memoryviews.
+
+        The slot is returned to the ring when the next packet is requested.
+        """
+        slot_views = self.capture.slot_views
+        skip = self.skip
+        while True:
+            start, count = self.acquire(None, timeout)
+            if count == 0:
+                return
+            for i in range(start, start + count):
+                try:
+                    yield slot_views[i][skip:max(int(self.lengths[i]), skip)]
+                finally:
+                    self.release(1)
+
+
+class CaptureThread(threading.Thread):
+    """Producer thread. Receives from batch_receiver into ring until stopCapture."""
+    def __init__(self, ring: CaptureRing, batch_receiver: BatchReceiver, sequence_checker: SequenceChecker=None,
+                 run_writer: RunWriter=None, poll_interval: float=0.1):
+        """
+        Args:
+            ring: Destination ring.
+            batch_receiver: Receive engine on the UDP socket.
+            sequence_checker: If given, every received batch is checked, including overruns.
+            run_writer: If given, every received batch is recorded, including overruns.
+            poll_interval: Seconds between checks for stopCapture while no packets arrive.
+        """
+        super().__init__(daemon=True)
+        self.ring = ring
+        self.batch_receiver = batch_receiver
+        self.sequence_checker = sequence_checker
+        self.run_writer = run_writer
+        self.poll_interval = poll_interval
+        self.error = None
+        self._stop_event = threading.Event()
+        self._overrun_capture = CaptureBuffer(batch_receiver.batch_size, ring.slot_size)
+
+    def run(self) -> None:
+        ring = self.ring
+        receive_into = self.batch_receiver.receiveInto
+        sequence_checker = self.sequence_checker
+        run_writer = self.run_writer
+        try:
+            while not self._stop_event.is_set():
+                start, count = ring.freeSlots()
+                try:
+                    if count > 0:
+                        n = receive_into(ring.capture, start, count, self.poll_interval)
+                        if sequence_checker is not None:
+                            sequence_checker.checkPackets(ring.data[start:start + n])
+                        if run_writer is not None:
+                            run_writer.writePackets(ring.data[start:start + n], ring.lengths[start:start + n])
+                        ring.publish(n)
+                    else:
+                        n = receive_into(self._overrun_capture, 0, None, self.poll_interval)
+                        if sequence_checker is not None:
+                            sequence_checker.checkPackets(self._overrun_capture.data[:n])
+                        if run_writer is not None:
+                            run_writer.writePackets(self._overrun_capture.data[:n], self._overrun_capture.lengths[:n])
+                        ring.discard(n)
+                except socket.timeout:
+                    pass
+        except Exception as error:
+            self.error = error
+        finally:
+            ring.stop(self.error)
+
+    def stopCapture(self, timeout: float=None) -> None:
+        """Stops the thread and waits for it to finish."""
+        self._stop_event.set()
+        self.join(timeout)
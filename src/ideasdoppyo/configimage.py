@@ -0,0 +1,310 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Compiled configuration images: the byte stream of a register configuration, encoded once.
+
+A ConfigurationImage holds all packets of a sequence of writeSysReg / writeAsicSpiReg /
+writeReadShiftReg operations in one buffer, with the readbacks they are expected to return.
+Replaying patches Packet ID and Packet Sequence in place, streams the buffer with a sliding window,
+receives all readbacks into one buffer and verifies them with one vectorized comparison.
+
+Example:
+    operations = [('writeSysReg', 0xFFA0, 1, 1),
+                  ('writeAsicSpiReg', 0xFA00, 1, 8, 5),
+                  ('writeReadShiftReg', shift_reg_bytes)]
+    image = ConfigurationImage.cached('gds100.npz', operations, tcp)
+    wrongly_programmed = image.replay(tcp)
+
+ASIC SPI and shift register operations are recorded with asic_id and spi_format, taken from the
+handler passed when compiling if not given. Images for different ASICs have different keys.
+"""
+
+import hashlib
+import json
+import os
+import socket
+
+import numpy as np
+from tcphandler import PACKET_HEADER, TCPhandler
+
+# Readback packet type per write packet type
+READBACK_TYPE = {0x10: 0x12, 0xC0: 0xC1, 0xC2: 0xC4}
+
+# Number of recorded arguments per operation, the last ones are asic_id (and spi_format)
+OPERATION_LENGTHS = {'writeSysReg': 3, 'writeAsicSpiReg': 6, 'writeReadShiftReg': 2}
+
+
+def getSpiDefaults(tcp: TCPhandler=None) -> tuple:
+    """(asic_id, spi_format) of tcp as integers. The TCPhandler defaults if tcp is None."""
+    if tcp is None:
+        return 0, 2
+    return tcp.asic_id[0], tcp.spi_format[0]
+
+
+def normalizeOperations(operations: list, tcp: TCPhandler=None) -> list:
+    """
+    Operations as recorded by ConfigurationImage: missing asic_id and spi_format are taken from tcp.
+
+    Args:
+        operations: List of (method name, *args), see ConfigurationImage.fromOperations.
+    """
+    asic_id, spi_format = getSpiDefaults(tcp)
+    defaults = {'writeSysReg': (), 'writeAsicSpiReg': (asic_id, spi_format), 'writeReadShiftReg': (asic_id,)}
+    normalized = []
+    for method, *args in operations:
+        assert (method in OPERATION_LENGTHS), f"unknown operation {method}"
+        n_required = OPERATION_LENGTHS[method] - len(defaults[method])
+        args = args + [None]*(OPERATION_LENGTHS[method] - len(args))
+        args[n_required:] = [default if arg is None else arg for arg, default in zip(args[n_required:], defaults[method])]
+        normalized.append((method, *args))
+    return normalized
+
+
+def _jsonOperation(operation: tuple) -> list:
+    return [field.hex() if isinstance(field, (bytes, bytearray)) else field for field in operation]
+
+
+def getOperationsKey(operations: list, tcp: TCPhandler=None) -> str:
+    """Hash of a list of operations, identifies a cached image. See normalizeOperations."""
+    operations = normalizeOperations(operations, tcp)
+    return hashlib.sha1(json.dumps([_jsonOperation(operation) for operation in operations]).encode()).hexdigest()
+
+
+class ConfigurationImage:
+    """
+    Packets and expected readbacks of a configuration. Add operations with the TCPhandler write
+    methods of the same name, or with fromOperations.
+
+    Args:
+        tcp: Handler whose asic_id and spi_format are used when an operation does not give them.
+    """
+    def __init__(self, tcp: TCPhandler=None):
+        self.asic_id, self.spi_format = getSpiDefaults(tcp)
+        self.operations = []                # (method name, *args), as passed to the write methods
+        self.packets = bytearray()          # All packets, packet ID and sequence patched at replay
+        self.expected = bytearray()         # All expected readbacks
+        self.compare_mask = bytearray()     # Bits of expected compared with the received readbacks
+        self.packet_offsets = [0]
+        self.readback_offsets = [0]
+        self._arrays = None
+
+    def __len__(self) -> int:
+        return len(self.operations)
+
+    @property
+    def key(self) -> str:
+        """See getOperationsKey."""
+        return getOperationsKey(self.operations)
+
+    def _add(self, operation: tuple, packet_type: hex, data_field: bytes, compare_value: bool=True) -> None:
+        """Appends packet, and its expected readback which echoes the data field."""
+        header = PACKET_HEADER.pack(packet_type, 0, 0, len(data_field))
+        self.packets += header + data_field
+        readback_header = PACKET_HEADER.pack(READBACK_TYPE[packet_type], 0, 0, len(data_field))
+        self.expected += readback_header + data_field
+        # Compare packet type, packet count and data length. Sequence flag and reserved are not compared.
+        header_mask = bytes([0x00, 0xFF, 0x3F, 0xFF, 0, 0, 0, 0, 0xFF, 0xFF])
+        if compare_value:
+            self.compare_mask += header_mask + b'\xFF'*len(data_field)
+        else:
+            self.compare_mask += header_mask + b'\xFF'*3 + bytes(len(data_field) - 3)
+        self.packet_offsets.append(len(self.packets))
+        self.readback_offsets.append(len(self.expected))
+        self.operations.append(operation)
+        self._arrays = None
+
+    def writeSysReg(self, reg_addr: hex, value: hex, len_reg_data: hex) -> None:
+        """See TCPhandler.writeSysReg."""
+        data_field = reg_addr.to_bytes(2, 'big') + len_reg_data.to_bytes(1, 'big') + value.to_bytes(len_reg_data, 'big')
+        self._add(('writeSysReg', reg_addr, value, len_reg_data), 0x10, data_field)
+
+    def writeAsicSpiReg(self, reg_addr: hex, reg_length: int, asic_bit_length: int, write_data: hex,
+                        asic_id: int=None, spi_format: int=None) -> None:
+        """See TCPhandler.writeAsicSpiReg. asic_id and spi_format default to those of the image."""
+        asic_id = self.asic_id if asic_id is None else asic_id
+        spi_format = self.spi_format if spi_format is None else spi_format
+        data_field = (bytes([asic_id, spi_format]) + reg_addr.to_bytes(2, 'big')
+                      + asic_bit_length.to_bytes(2, 'big') + write_data.to_bytes(reg_length, 'big'))
+        self._add(('writeAsicSpiReg', reg_addr, reg_length, asic_bit_length, write_data, asic_id, spi_format),
+                  0xC2, data_field)
+
+    def writeReadShiftReg(self, configuration_data: bytes, asic_id: int=None) -> None:
+        """See TCPhandler.writeReadShiftReg. The shifted-out data is not verified."""
+        asic_id = self.asic_id if asic_id is None else asic_id
+        conf_len = len(configuration_data)
+        conf_bit_len = (conf_len*8-(8-conf_len%8)).to_bytes(2, 'big')
+        data_field = bytes([asic_id]) + conf_bit_len + bytes(configuration_data)
+        self._add(('writeReadShiftReg', bytes(configuration_data), asic_id), 0xC0, data_field, compare_value=False)
+
+    @classmethod
+    def fromOperations(cls, operations: list, tcp: TCPhandler=None) -> 'ConfigurationImage':
+        """
+        Compiles a list of operations.
+
+        Args:
+            operations: List of (method name, *args), e.g. ('writeSysReg', 0xFFA0, 1, 1).
+            tcp: See ConfigurationImage.
+        """
+        image = cls(tcp)
+        for method, *args in operations:
+            assert (method in OPERATION_LENGTHS), f"unknown operation {method}"
+            getattr(image, method)(*args)
+        return image
+
+    def _getArrays(self) -> tuple:
+        """Offsets as arrays, cached until the next added operation."""
+        if self._arrays is None:
+            self._arrays = (np.array(self.packet_offsets, np.int64),
+                            np.array(self.readback_offsets, np.int64),
+                            np.frombuffer(self.compare_mask, np.uint8))
+        return self._arrays
+
+    def save(self, path: str) -> None:
+        """Saves the compiled image, see load."""
+        packet_offsets, readback_offsets, compare_mask = self._getArrays()
+        operations = json.dumps([_jsonOperation(operation) for operation in self.operations])
+        np.savez(path, packets=np.frombuffer(self.packets, np.uint8), expected=np.frombuffer(self.expected, np.uint8),
+                 compare_mask=compare_mask, packet_offsets=packet_offsets, readback_offsets=readback_offsets,
+                 operations=np.array(operations), key=np.array(self.key))
+
+    @classmethod
+    def load(cls, path: str) -> 'ConfigurationImage':
+        """Loads an image saved by save, without compiling it again."""
+        image = cls()
+        with np.load(path) as arrays:
+            image.packets = bytearray(arrays['packets'].tobytes())
+            image.expected = bytearray(arrays['expected'].tobytes())
+            image.compare_mask = bytearray(arrays['compare_mask'].tobytes())
+            image.packet_offsets = arrays['packet_offsets'].tolist()
+            image.readback_offsets = arrays['readback_offsets'].tolist()
+            for method, *args in json.loads(str(arrays['operations'])):
+                if method == 'writeReadShiftReg':
+                    args = [bytes.fromhex(args[0]), *args[1:]]
+                image.operations.append((method, *args))
+        return image
+
+    @classmethod
+    def cached(cls, path: str, operations: list, tcp: TCPhandler=None) -> 'ConfigurationImage':
+        """
+        Loads the image at path if it was compiled from operations, else compiles and saves it.
+
+        Args:
+            tcp: See ConfigurationImage. Part of the key through asic_id and spi_format.
+        """
+        if os.path.exists(path):
+            image = cls.load(path)
+            if image.key == getOperationsKey(operations, tcp):
+                return image
+        image = cls.fromOperations(operations, tcp)
+        image.save(path)
+        return image
+
+    def _patchHeaders(self, tcp: TCPhandler) -> None:
+        """Writes Packet ID and Packet Sequence of tcp into all packets and expected readbacks."""
+        packet_offsets, readback_offsets, _ = self._getArrays()
+        packet_sequence = (tcp.sequence_flag & 0x3) << 14 | ((tcp.packet_count + np.arange(len(self))) & 0x3FFF)
+        packet_id_high = ((tcp.version & 0x7) << 5 | (tcp.system_number & 0x1F))
+        for buffer, starts in ((self.packets, packet_offsets[:-1]), (self.expected, readback_offsets[:-1])):
+            buffer_bytes = np.frombuffer(buffer, np.uint8)
+            buffer_bytes[starts] = packet_id_high
+            buffer_bytes[starts + 2] = packet_sequence >> 8
+            buffer_bytes[starts + 3] = packet_sequence & 0xFF
+
+    def replay(self, tcp: TCPhandler, window: int=50) -> list:
+        """
+        Sends all packets and verifies all readbacks.
+
+        Readbacks are compared by position in the stream. After a lost readback, the following
+        packets are reported as wrongly programmed. Packets go to the asic_id and spi_format recorded
+        per operation, see ConfigurationImage.
+
+        Args:
+            tcp: Connected TCPhandler, without outstanding readbacks. Its packet_count is advanced.
+            window: Maximum number of packets sent before their readbacks are received.
+
+        Returns:
+            wrongly_programmed: Addresses, see TCPhandler.checkReadBack. Shift registers are reported as 'shift'.
+        """
+        assert (not tcp.not_readback), f"{len(tcp.not_readback)} readbacks outstanding, use finishReadBack first"
+        packet_offsets, readback_offsets, compare_mask = self._getArrays()
+        n_packets = len(self)
+        self._patchHeaders(tcp)
+        packets = memoryview(self.packets)
+        received = bytearray(len(self.expected))
+        received_view = memoryview(received)
+        window = window or n_packets
+        n_sent = 0
+        n_received = 0
+        n_bytes = 0
+        try:
+            while n_received < n_packets:
+                if n_sent < n_packets and n_sent - n_received <= window//2:
+                    last = min(n_received + window, n_packets)
+                    tcp.tcp_s.sendall(packets[packet_offsets[n_sent]:packet_offsets[last]])
+                    n_sent = last
+                n_bytes += tcp.reader.readInto(received_view[n_bytes:readback_offsets[n_sent]])
+                n_received = int(np.searchsorted(readback_offsets, n_bytes, 'right')) - 1
+        except socket.timeout:
+            if tcp.doPrint:
+                print(f'ERROR: No readback for {n_packets - n_received} of {n_packets} packets.')
+        finally:
+            packets.release()
+            received_view.release()
+        tcp.packet_count = (tcp.packet_count + n_packets) & 0x3FFF
+
+        # Packets with any compared bit differing from the expected readback
+        difference = np.bitwise_xor(np.frombuffer(received, np.uint8), np.frombuffer(self.expected, np.uint8))
+        wrong_bytes = np.flatnonzero(difference[:readback_offsets[n_received]] & compare_mask[:readback_offsets[n_received]])
+        is_wrong = np.zeros(n_packets, bool)
+        is_wrong[np.searchsorted(readback_offsets, wrong_bytes, 'right') - 1] = True
+        is_wrong[n_received:] = True
+
+        wrongly_programmed = []
+        for operation, wrong in zip(self.operations, is_wrong.tolist()):
+            method, *args = operation
+            space = 'sys' if method == 'writeSysReg' else 'spi' if method == 'writeAsicSpiReg' else None
+            if space is None:
+                if wrong:
+                    wrongly_programmed.append('shift')
+                continue
+            reg_addr = args[0]
+            asic_id = args[4] if space == 'spi' else None
+            tcp._shadowWrite(space, reg_addr, asic_id)
+            if wrong:
+                wrongly_programmed.append(hex(reg_addr))
+            else:
+                tcp._shadowReadBack(space, reg_addr, args[1] if space == 'sys' else args[3], asic_id=asic_id)
+        if tcp.doPrint:
+            if not wrongly_programmed:
+                print(f'Readback is as expected!')
+            else:
+                print(f'ERROR: Readback is wrong!: {wrongly_programmed}')
+        return wrongly_programmed
@@ -28,6 +28,8 @@ ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
 THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import numpy as np
+
 common_header_format = [('Packet ID', '>u2'),
                 ('Packet Sequence', '>u2'),
                 ('Timestamp', '>u4'),
@@ -42,8 +44,119 @@ pipeline_header_format = [('Source ID', '>u1'),
       ('Event ID', '>u4'),
       ('PPS Timestamp', '>u4')]
 
-pipeline_data_format = [('Cell' + str(i), '>u2') for i in range(160)]
+PIPELINE_CELLS = 160
+
+pipeline_data_format = [('Cell' + str(i), '>u2') for i in range(PIPELINE_CELLS)]
 
 pipeline_sampling_format = pipeline_header_format + pipeline_data_format
 
+# Same layout, with all cells as one (160,) subarray field.
+pipeline_cells_format = [('Cells', '>u2', (PIPELINE_CELLS,))]
+
+pipeline_sampling_cells_format = pipeline_header_format + pipeline_cells_format
+
+# --------------------------------------------------------------------
+
+
+# Image, packet type 0xD1 --------------------------------------------
+image_header_format = [('Frame Number', '>u2'),
+      ('Image Width', '>u2'),
+      ('Image Height', '>u2'),
+      ('Spectral Channels', '>u2'),
+      ('Reserved0', '>u1'),
+      ('Data Width', '>u1'),
+      ('User Defined', '>u4'),
+      ('Packets per Image', '>u2'),
+      ('Data Packet Sequence', '>u2'),
+      ('Reserved1', '>u2')]
+
+# Image data is 0 - 1400 bytes, given by Data Length.
+
+# --------------------------------------------------------------------
+
+
+# Multi-event pulse height, packet type 0xD4 -------------------------
+multi_event_header_format = [('Number of Events', '>u1'),
+      ('Samples per Event', '>u2')]
+
+# Repeated Number of Events times, each followed by Samples per Event samples.
+multi_event_event_format = [('Timestamp', '>u4')]
+
+multi_event_sample_format = [('Trigger Type', '>u1'),
+      ('Source ID', '>u1'),
+      ('Channel ID', '>u1'),
+      ('Sample', '>u2')]
+
+# --------------------------------------------------------------------
+
+
+# Single-event pulse height, packet type 0xD5 ------------------------
+single_event_header_format = [('Source ID', '>u1'),
+      ('Trigger Type', '>u1'),
+      ('Channel ID', '>u1'),
+      ('Hold Delay', '>u2'),
+      ('Number of Samples', '>u2')]
+
+# Followed by Number of Samples samples.
+single_event_sample_format = [('Sample', '>u2')]
+
+# --------------------------------------------------------------------
+
+
+# Trigger time, packet type 0xD6 -------------------------------------
+trigger_time_header_format = [('Number of Events', '>u1')]     # Number of events - 1
+
+# Repeated Number of Events + 1 times. Triggered: ASIC (2 bits) + Channel (6 bits).
+trigger_time_event_format = [('Timestamp', '>u4'),
+      ('Triggered', '>u1')]
+
+# --------------------------------------------------------------------
+
+
+# Waveform features of pipeline sampling, see features.py -------------
+waveform_features_format = [('Event ID', '<u4'),
+      ('PPS Timestamp', '<u4'),
+      ('Source ID', 'u1'),
+      ('Peak Cell', 'u1'),
+      ('Threshold Cell', 'u1'),       # First cell above threshold, 255 if none
+      ('Time over Threshold', 'u1'),  # Number of cells above threshold
+      ('Amplitude', '<f4'),
+      ('Integral', '<f4'),
+      ('Baseline', '<f4'),
+      ('Baseline RMS', '<f4')]
+
+# --------------------------------------------------------------------
+
+
+# Composite dtypes, including common header ------------------------
+dtype_format_dict = {
+    'common_header' : common_header_format,
+    'pipeline_sampling' : common_header_format + pipeline_sampling_format,
+    'pipeline_sampling_cells' : common_header_format + pipeline_sampling_cells_format,
+    'image_header' : common_header_format + image_header_format,
+    'multi_event_header' : common_header_format + multi_event_header_format,
+    'multi_event_event' : multi_event_event_format,
+    'multi_event_sample' : multi_event_sample_format,
+    'single_event_header' : common_header_format + single_event_header_format,
+    'single_event_sample' : single_event_sample_format,
+    'trigger_time_header' : common_header_format + trigger_time_header_format,
+    'trigger_time_event' : trigger_time_event_format,
+    'waveform_features' : waveform_features_format
+}
+
+_dtype_cache = {}
+
+
+def getDtype(name: str) -> np.dtype:
+    """
+    Compiled dtype of a format in dtype_format_dict. Built on first use, then cached.
+
+    Use this instead of np.dtype(format list) in loops.
+    """
+    dtype = _dtype_cache.get(name)
+    if dtype is None:
+        dtype = np.dtype(dtype_format_dict[name])
+        _dtype_cache[name] = dtype
+    return dtype
+
 # --------------------------------------------------------------------
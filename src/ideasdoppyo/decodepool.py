@@ -0,0 +1,184 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Multi-process decoding of captured packets, fed through shared memory.
+
+The capture ring lives in a multiprocessing.shared_memory block. The capture thread receives into it
+as usual; DecodePool hands each filled batch of slots to a worker process as (sequence number,
+first slot, count), so payloads are never pickled. Workers run decoders.decode and a reduce function,
+and return only its result. Results are yielded in batch sequence order, and the slots of a batch
+are returned to the ring after its result is yielded.
+
+Example:
+    pool = udp.startDecodePool(functools.partial(features.extractDecoded, threshold=50))
+    for features in pool.results(timeout=1.0):
+        ...
+    udp.stopDecodePool()
+
+The reduce function must be picklable, i.e. a module-level function or a functools.partial of one.
+"""
+
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+from capturebuffer import getBufferSize, getBufferViews, MAX_PACKET_SIZE
+from capturering import CaptureRing
+from decoders import decode
+
+
+def _workerLoop(shared_memory_name: str, n_slots: int, slot_size: int, data_format: int, reduce,
+                tasks: multiprocessing.Queue, results: multiprocessing.Queue) -> None:
+    """Worker process: decodes and reduces batches of slots until it receives None."""
+    shared = shared_memory.SharedMemory(shared_memory_name)
+    data, lengths = getBufferViews(shared.buf, n_slots, slot_size)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            sequence, start, count = task
+            try:
+                result = reduce(decode(data_format, data[start:start + count], lengths[start:start + count]))
+            except Exception as error:
+                result = error
+            results.put((sequence, result))
+    finally:
+        del data, lengths
+        shared.close()
+
+
+class DecodePool:
+    """
+    Worker processes decoding batches of a CaptureRing in shared memory. See module docstring.
+
+    Args:
+        data_format: See UDPhandler.
+        reduce: Function of the decoded batch (see decoders.decode), returning a small result.
+        n_workers: Number of worker processes, default number of CPUs.
+        n_slots: Slots of the capture ring.
+        slot_size: Maximum byte length of one packet.
+        max_batch: Maximum packets per task.
+    """
+    def __init__(self, data_format: int, reduce, n_workers: int=None, n_slots: int=4096, slot_size: int=MAX_PACKET_SIZE,
+                 max_batch: int=256):
+        self.data_format = data_format
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.max_batch = max_batch
+        self.max_in_flight = 2*self.n_workers          # Tasks queued or running
+
+        self.shared_memory = shared_memory.SharedMemory(create=True, size=getBufferSize(n_slots, slot_size))
+        self.ring = None                                # Set by attach
+        self.dispatch_count = 0                         # Slots handed to workers, counted as write_count
+        self.sequence = 0                               # Sequence number of the next task
+        self.next_result = 0                            # Sequence number of the next result to yield
+        self.batches_done = 0
+        self.errors = 0
+
+        self._counts = {}                               # sequence: slots of task
+        self._pending = {}                              # sequence: result received out of order
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._workers = [multiprocessing.Process(target=_workerLoop, daemon=True,
+                                                 args=(self.shared_memory.name, n_slots, slot_size, data_format,
+                                                       reduce, self._tasks, self._results))
+                         for _ in range(self.n_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def createRing(self, skip: int=0) -> CaptureRing:
+        """Capture ring in the shared memory of the pool, for CaptureThread. See attach."""
+        return CaptureRing(self.n_slots, self.slot_size, skip, buffer=self.shared_memory.buf)
+
+    def attach(self, ring: CaptureRing) -> None:
+        """Consumes ring, created by createRing."""
+        self.ring = ring
+        self.dispatch_count = ring.read_count
+
+    def _dispatch(self) -> None:
+        """Hands published slots to the workers, up to max_in_flight tasks."""
+        ring = self.ring
+        while len(self._counts) < self.max_in_flight and ring.write_count > self.dispatch_count:
+            start = self.dispatch_count % self.n_slots
+            count = min(ring.write_count - self.dispatch_count, self.n_slots - start, self.max_batch)
+            self._tasks.put((self.sequence, start, count))
+            self._counts[self.sequence] = count
+            self.sequence += 1
+            self.dispatch_count += count
+
+    def results(self, timeout: float=None):
+        """
+        Generator of reduce results, in capture order.
+
+        Ends when no packets arrive within timeout and all results are yielded, or when the capture
+        is stopped and all packets are processed. A result of a failed task is its exception, re-raised here.
+        """
+        ring = self.ring
+        assert (ring is not None), f"no capture ring attached, see UDPhandler.startDecodePool"
+        while True:
+            self._dispatch()
+            if not self._counts:
+                if not ring.waitPublished(self.dispatch_count, timeout):
+                    if ring.write_count == self.dispatch_count:
+                        return
+                continue
+            try:
+                sequence, result = self._results.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            self._pending[sequence] = result
+            while self.next_result in self._pending:
+                result = self._pending.pop(self.next_result)
+                count = self._counts.pop(self.next_result)
+                self.next_result += 1
+                ring.release(count)
+                self.batches_done += 1
+                if isinstance(result, Exception):
+                    self.errors += 1
+                    raise result
+                yield result
+                self._dispatch()
+
+    def close(self) -> None:
+        """Stops the workers and frees the shared memory."""
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(5.0)
+            if worker.is_alive():
+                worker.terminate()
+        self.shared_memory.unlink()
+        try:
+            self.shared_memory.close()
+        except BufferError:
+            pass                        # Views of the ring are still referenced, closed when garbage collected
@@ -0,0 +1,365 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Vectorized decoding of captured UDP data packets into structured NumPy arrays.
+
+Decoders are registered per (data_format, packet type) and operate on a whole capture at once.
+Packets are located by a precomputed offset index, and records are read with one strided view
+or one gather, without per-packet Python. Counts in packet headers are clipped to the received length.
+
+Variable-length contents are returned flat with CSR-style offsets: items of packet i are
+items[offsets[i]:offsets[i+1]].
+"""
+
+import numpy as np
+from capturebuffer import CaptureBuffer
+from dataformats import getDtype
+
+COMMON_HEADER_LENGTH = getDtype('common_header').itemsize
+
+# UDPhandler data_format: packet type
+DATA_FORMAT_PACKET_TYPE = {
+    0 : 0xD1,       # Image
+    1 : 0xD4,       # Multi-event pulse height
+    2 : 0xD5,       # Single-event pulse height
+    3 : 0xD6,       # Trigger time
+    4 : 0xDA        # Pipeline sampling
+}
+
+# UDPhandler data_format: dataformats dtype of the fixed part of each packet
+DATA_FORMAT_DTYPE = {
+    0 : 'image_header',
+    1 : 'multi_event_header',
+    2 : 'single_event_header',
+    3 : 'trigger_time_header',
+    4 : 'pipeline_sampling'
+}
+
+
+# CSR offsets key: items key, in decoder results
+OFFSET_KEYS = {
+    'image_data_offsets' : 'image_data',
+    'event_offsets' : 'events',
+    'sample_offsets' : 'samples'
+}
+
+
+def mergeDecoded(results: list) -> dict:
+    """Concatenates decoder results of consecutive groups of packets, shifting CSR offsets."""
+    if len(results) == 1:
+        return results[0]
+    merged = {}
+    for key in results[0]:
+        if key in OFFSET_KEYS:
+            items_key = OFFSET_KEYS[key]
+            shift = 0
+            offsets = [np.zeros(1, dtype=np.int64)]
+            for result in results:
+                offsets.append(result[key][1:] + shift)
+                shift += len(result[items_key])
+            merged[key] = np.concatenate(offsets)
+        else:
+            merged[key] = np.concatenate([result[key] for result in results])
+    return merged
+
+
+def buildOffsetIndex(buffer) -> tuple:
+    """
+    Offset index of consecutive packets, e.g. from UDPhandler.collectNpackets without header masking.
+
+    Follows the common header Data Length field from packet to packet. When two consecutive packets have
+    equal length, the following run of equal-length packets is found with one array comparison, so
+    fixed-length formats need no per-packet Python.
+
+    Returns:
+        (offsets, lengths): Byte offset and byte length of each packet. The length of a truncated
+            last packet is clipped to the bytes present.
+    """
+    buffer = np.frombuffer(buffer, dtype=np.uint8)
+    view = memoryview(buffer)       # Fast single byte reads
+    n_bytes = len(buffer)
+    offsets = []                    # Arrays of offsets per run
+    lengths = []
+    packet_offsets = []             # Single packets, not yet in offsets
+    packet_lengths = []
+    position = 0
+    previous_length = None
+    run = 64
+    while position + COMMON_HEADER_LENGTH <= n_bytes:
+        length = COMMON_HEADER_LENGTH + ((view[position + 8] << 8) | view[position + 9])
+        if length != previous_length:
+            packet_offsets.append(position)
+            packet_lengths.append(length)
+            position += length
+            previous_length = length
+            run = 64
+            continue
+        # Assume up to run following packets of the same length, keep those that are
+        n = min(run, (n_bytes - position - COMMON_HEADER_LENGTH)//length + 1)
+        starts = position + np.arange(n, dtype=np.int64)*length
+        same = ((buffer[starts + 8].astype(np.int64) << 8) | buffer[starts + 9]) == length - COMMON_HEADER_LENGTH
+        n_same = n if same.all() else int(np.argmin(same))
+        offsets += [np.array(packet_offsets, dtype=np.int64), starts[:n_same]]
+        lengths += [np.array(packet_lengths, dtype=np.int64), np.full(n_same, length, dtype=np.int64)]
+        packet_offsets = []
+        packet_lengths = []
+        position += n_same*length
+        run = 2*run if n_same == n else 64
+    offsets.append(np.array(packet_offsets, dtype=np.int64))
+    lengths.append(np.array(packet_lengths, dtype=np.int64))
+    offsets = np.concatenate(offsets)
+    return offsets, np.minimum(np.concatenate(lengths), n_bytes - offsets)
+
+
+def getOffsetIndex(packets, lengths: np.ndarray=None) -> tuple:
+    """
+    Flat buffer and offset index of packets.
+
+    Args:
+        packets: CaptureBuffer, (n_packets, slot_size) uint8 array with lengths (e.g. CaptureRing.batches()),
+            or consecutive packets as bytes.
+        lengths: Received bytes per slot, for a 2D array.
+
+    Returns:
+        (buffer, offsets, lengths): Flat uint8 array, byte offset and byte length of each packet.
+    """
+    if isinstance(packets, CaptureBuffer):
+        n = packets.n_packets
+        return packets.buffer, np.arange(n, dtype=np.int64)*packets.slot_size, packets.lengths[:n]
+    if isinstance(packets, np.ndarray) and packets.ndim == 2:
+        assert (lengths is not None), f"lengths is required for packets in slots"
+        n, slot_size = packets.shape
+        return packets.reshape(-1), np.arange(n, dtype=np.int64)*slot_size, np.asarray(lengths)[:n]
+    buffer = np.frombuffer(packets, dtype=np.uint8)
+    offsets, lengths = buildOffsetIndex(buffer)
+    return buffer, offsets, lengths
+
+
+def gatherRecords(buffer: np.ndarray, starts: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """
+    One record of dtype at each byte offset in starts.
+
+    Evenly spaced records are returned as a zero-copy strided view of buffer, others are gathered into a copy.
+    """
+    dtype = np.dtype(dtype)
+    n = len(starts)
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    if n == 1:
+        stride = dtype.itemsize
+    else:
+        stride = int(starts[1] - starts[0])
+    if stride > 0 and (n < 3 or np.all(np.diff(starts) == stride)):
+        return np.ndarray((n,), dtype=dtype, buffer=buffer, offset=int(starts[0]), strides=(stride,))
+    index = np.asarray(starts, dtype=np.int64)[:, None] + np.arange(dtype.itemsize)
+    return buffer[index].view(dtype)[:, 0]
+
+
+def gatherRanges(buffer: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> tuple:
+    """
+    Concatenates byte ranges buffer[starts[i]:starts[i]+lengths[i]].
+
+    Returns:
+        (data, offsets): Concatenated bytes and CSR offsets (n+1) into data.
+    """
+    lengths = np.maximum(np.asarray(lengths, dtype=np.int64), 0)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    index = np.arange(offsets[-1], dtype=np.int64) + np.repeat(np.asarray(starts, dtype=np.int64) - offsets[:-1], lengths)
+    return buffer[index], offsets
+
+
+def _repeatIndex(counts: np.ndarray) -> tuple:
+    """For items repeated counts[i] times: (owner index, position within owner, CSR offsets)."""
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    owner = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(offsets[-1], dtype=np.int64) - offsets[:-1][owner]
+    return owner, position, offsets
+
+
+def _getItemsFit(lengths: np.ndarray, dtype: np.dtype, item_length) -> np.ndarray:
+    """Number of items of item_length bytes after a dtype header within the received lengths of packets."""
+    return np.maximum(np.asarray(lengths, dtype=np.int64) - dtype.itemsize, 0)//np.maximum(item_length, 1)
+
+
+def decodePipelineSampling(buffer: np.ndarray, offsets: np.ndarray, lengths: np.ndarray) -> dict:
+    """
+    Packet type 0xDA, fixed length.
+
+    Returns:
+        {'packets': common header, pipeline header and Cell0 - Cell159 per packet,
+        'cells': (n_packets, 160) view of the same cells, for plain ndarray operations}
+    """
+    packets = gatherRecords(buffer, offsets, getDtype('pipeline_sampling'))
+    cells = packets.view(getDtype('pipeline_sampling_cells'))['Cells']
+    return {'packets': packets, 'cells': cells}
+
+
+def decodeImage(buffer: np.ndarray, offsets: np.ndarray, lengths: np.ndarray) -> dict:
+    """
+    Packet type 0xD1. Image data length is given by Data Length.
+
+    Returns:
+        {'packets': common and image header per packet, 'image_data': uint8, 'image_data_offsets': CSR offsets}
+    """
+    dtype = getDtype('image_header')
+    packets = gatherRecords(buffer, offsets, dtype)
+    data_lengths = np.minimum(packets['Data Length'].astype(np.int64) + COMMON_HEADER_LENGTH, lengths) - dtype.itemsize
+    image_data, image_data_offsets = gatherRanges(buffer, offsets + dtype.itemsize, data_lengths)
+    return {'packets': packets, 'image_data': image_data, 'image_data_offsets': image_data_offsets}
+
+
+def decodeMultiEventPulseHeight(buffer: np.ndarray, offsets: np.ndarray, lengths: np.ndarray) -> dict:
+    """
+    Packet type 0xD4. Each packet holds Number of Events events of Samples per Event samples.
+
+    Returns:
+        {'packets': common and packet header per packet, 'events': Timestamp per event, 'event_offsets': CSR
+        offsets into events per packet, 'samples': per sample, 'sample_offsets': CSR offsets into samples per event}
+    """
+    dtype = getDtype('multi_event_header')
+    sample_dtype = getDtype('multi_event_sample')
+    event_header_length = getDtype('multi_event_event').itemsize
+    packets = gatherRecords(buffer, offsets, dtype)
+
+    samples_per_event = packets['Samples per Event'].astype(np.int64)
+    event_length = event_header_length + sample_dtype.itemsize*samples_per_event
+    n_events = np.minimum(packets['Number of Events'].astype(np.int64), _getItemsFit(lengths, dtype, event_length))
+    event_packet, event_position, event_offsets = _repeatIndex(n_events)
+    event_starts = offsets[event_packet] + dtype.itemsize + event_position*event_length[event_packet]
+    events = gatherRecords(buffer, event_starts, getDtype('multi_event_event'))
+
+    sample_event, sample_position, sample_offsets = _repeatIndex(samples_per_event[event_packet])
+    sample_starts = event_starts[sample_event] + event_header_length + sample_position*sample_dtype.itemsize
+    samples = gatherRecords(buffer, sample_starts, sample_dtype)
+    return {'packets': packets, 'events': events, 'event_offsets': event_offsets,
+            'samples': samples, 'sample_offsets': sample_offsets}
+
+
+def decodeSingleEventPulseHeight(buffer: np.ndarray, offsets: np.ndarray, lengths: np.ndarray) -> dict:
+    """
+    Packet type 0xD5. Each packet holds Number of Samples samples.
+
+    Returns:
+        {'packets': common and event header per packet, 'samples': '>u2', 'sample_offsets': CSR offsets}
+    """
+    dtype = getDtype('single_event_header')
+    sample_dtype = getDtype('single_event_sample')
+    packets = gatherRecords(buffer, offsets, dtype)
+    n_samples = np.minimum(packets['Number of Samples'].astype(np.int64), _getItemsFit(lengths, dtype, sample_dtype.itemsize))
+    sample_bytes, byte_offsets = gatherRanges(buffer, offsets + dtype.itemsize, n_samples*sample_dtype.itemsize)
+    samples = sample_bytes.view(sample_dtype)
+    return {'packets': packets, 'samples': samples, 'sample_offsets': byte_offsets//sample_dtype.itemsize}
+
+
+def decodeTriggerTime(buffer: np.ndarray, offsets: np.ndarray, lengths: np.ndarray) -> dict:
+    """
+    Packet type 0xD6. Each packet holds Number of Events + 1 events.
+
+    Returns:
+        {'packets': common header and event count per packet, 'events': per event, 'event_offsets': CSR offsets}
+    """
+    dtype = getDtype('trigger_time_header')
+    event_dtype = getDtype('trigger_time_event')
+    packets = gatherRecords(buffer, offsets, dtype)
+    n_events = np.minimum(packets['Number of Events'].astype(np.int64) + 1, _getItemsFit(lengths, dtype, event_dtype.itemsize))
+    event_packet, event_position, event_offsets = _repeatIndex(n_events)
+    event_starts = offsets[event_packet] + dtype.itemsize + event_position*event_dtype.itemsize
+    events = gatherRecords(buffer, event_starts, event_dtype)
+    return {'packets': packets, 'events': events, 'event_offsets': event_offsets}
+
+
+def toNativeEndian(array: np.ndarray, inplace: bool=True) -> np.ndarray:
+    """
+    Converts big-endian records or samples, e.g. decode(4, capture)['cells'], to native byte order.
+
+    Args:
+        inplace: Byteswap once in the memory of array, which may be the capture buffer. Other views
+            of the same memory (e.g. 'packets' and 'cells') are invalid afterwards.
+            If False, a native-endian copy is returned.
+    """
+    native_dtype = array.dtype.newbyteorder('=')
+    if array.dtype == native_dtype:
+        return array
+    if not inplace:
+        return array.astype(native_dtype)
+    array.byteswap(inplace=True)
+    return array.view(native_dtype)
+
+
+# (data_format, packet type): decoder
+decoder_dict = {
+    (0, 0xD1) : decodeImage,
+    (1, 0xD4) : decodeMultiEventPulseHeight,
+    (2, 0xD5) : decodeSingleEventPulseHeight,
+    (3, 0xD6) : decodeTriggerTime,
+    (4, 0xDA) : decodePipelineSampling
+}
+
+
+def registerDecoder(data_format: int, packet_type: int, decoder) -> None:
+    """
+    Adds or replaces a decoder.
+
+    Args:
+        decoder: Function (buffer, offsets, lengths) -> dict of arrays, see decodePipelineSampling.
+    """
+    decoder_dict[(data_format, packet_type)] = decoder
+
+
+def decode(data_format: int, packets, lengths: np.ndarray=None, packet_type: int=None) -> dict:
+    """
+    Decodes all packets of packet_type in a capture. Packets must include the common header.
+
+    NOTE Fixed-length records may be views into the capture buffer. Copy them before the buffer is reused.
+
+    Args:
+        data_format: UDPhandler data_format.
+        packets: See getOffsetIndex.
+        lengths: Received bytes per slot, for packets as a 2D array.
+        packet_type: Defaults to the packet type of data_format. Other packets are skipped, and so are
+            packets shorter than the fixed part of data_format, see DATA_FORMAT_DTYPE.
+
+    Returns:
+        decoded: Dictionary of structured arrays, see the decoder of the format.
+    """
+    if packet_type is None:
+        packet_type = DATA_FORMAT_PACKET_TYPE[data_format]
+    decoder = decoder_dict[(data_format, packet_type)]
+    buffer, offsets, lengths = getOffsetIndex(packets, lengths)
+    min_length = getDtype(DATA_FORMAT_DTYPE[data_format]).itemsize
+    is_decoded = (buffer[offsets + 1] == packet_type) & (lengths >= min_length)
+    if not is_decoded.all():
+        offsets = offsets[is_decoded]
+        lengths = lengths[is_decoded]
+    return decoder(buffer, offsets, lengths)
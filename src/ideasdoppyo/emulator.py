@@ -0,0 +1,366 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Local emulator of an IDEAS Doppio board, for testing and benchmarking without hardware.
+
+TCP: Serves the control protocol (0x10/0x11 -> 0x12, 0xC0 -> 0xC1, 0xC2/0xC3 -> 0xC4) from a register
+memory model, with a configurable latency per request.
+UDP: Streams generated data packets of each UDPhandler data_format at a configurable rate, with
+injectable packet loss and reordering.
+
+Example:
+    with DoppioEmulator(latency=0.0005) as board:
+        tcp = TCPhandler(*board.tcp_address)
+        udp = UDPhandler(data_format=4, server_ip='127.0.0.1', port=50011)
+        board.startStream(('127.0.0.1', 50011), data_format=4, n_packets=100000, rate=50000, loss=0.001)
+        capture = udp.captureNpackets(1000)
+"""
+
+import socket
+import threading
+import time
+
+import numpy as np
+from dataformats import getDtype
+from decoders import COMMON_HEADER_LENGTH, DATA_FORMAT_PACKET_TYPE
+from tcphandler import PACKET_HEADER, FramedReader
+
+
+class RegisterModel:
+    """
+    Register memory of the emulated board.
+
+    Registers not yet written read back as zero. Pulse registers read back as written,
+    then return to zero. Writing a reset register clears all ASIC SPI registers.
+    """
+    def __init__(self):
+        self.sys_regs = {}                  # address: value bytes
+        self.spi_regs = {}                  # address: value bytes
+        self.shift_reg = b''                # Last shifted-in configuration
+        self.pulse_registers = set()        # (space, address), space 'sys' or 'spi'
+        self.reset_registers = {0xFFA0}     # System registers clearing the ASIC SPI registers when written 0
+        self.lock = threading.Lock()
+
+    def _store(self, space: str, registers: dict, reg_addr: int, value: bytes) -> None:
+        if (space, reg_addr) in self.pulse_registers:
+            registers.pop(reg_addr, None)
+        else:
+            registers[reg_addr] = value
+
+    def writeSys(self, reg_addr: int, value: bytes) -> None:
+        with self.lock:
+            self._store('sys', self.sys_regs, reg_addr, value)
+            if reg_addr in self.reset_registers and not any(value):
+                self.spi_regs.clear()
+
+    def readSys(self, reg_addr: int, length: int=1) -> bytes:
+        with self.lock:
+            return self.sys_regs.get(reg_addr, bytes(length))
+
+    def writeSpi(self, reg_addr: int, value: bytes) -> None:
+        with self.lock:
+            self._store('spi', self.spi_regs, reg_addr, value)
+
+    def readSpi(self, reg_addr: int, length: int=1) -> bytes:
+        with self.lock:
+            return self.spi_regs.get(reg_addr, bytes(length))
+
+    def shift(self, configuration_data: bytes) -> bytes:
+        """Shifts in configuration_data. Returns the previous contents, as shifted out."""
+        with self.lock:
+            shifted_out = self.shift_reg[:len(configuration_data)].ljust(len(configuration_data), b'\0')
+            self.shift_reg = bytes(configuration_data)
+            return shifted_out
+
+
+def getPacketLength(data_format: int, image_bytes: int=256, n_events: int=4, n_samples: int=8) -> int:
+    """Byte length of the packets generated by generatePackets, including common header."""
+    return _getPacketDtype(data_format, image_bytes, n_events, n_samples).itemsize
+
+
+def _getPacketDtype(data_format: int, image_bytes: int, n_events: int, n_samples: int) -> np.dtype:
+    """Fixed-size dtype of one generated packet of data_format."""
+    if data_format == 0:
+        return np.dtype(getDtype('image_header').descr + [('Image Data', 'u1', (image_bytes,))])
+    elif data_format == 1:
+        event = np.dtype(getDtype('multi_event_event').descr + [('Samples', getDtype('multi_event_sample'), (n_samples,))])
+        return np.dtype(getDtype('multi_event_header').descr + [('Events', event, (n_events,))])
+    elif data_format == 2:
+        return np.dtype(getDtype('single_event_header').descr + [('Samples', '>u2', (n_samples,))])
+    elif data_format == 3:
+        return np.dtype(getDtype('trigger_time_header').descr + [('Events', getDtype('trigger_time_event'), (n_events,))])
+    elif data_format == 4:
+        return getDtype('pipeline_sampling_cells')
+    assert False, f"data_format should be 0, 1, 2, 3 or 4, not {data_format}"
+
+
+def generatePackets(data_format: int, n_packets: int, first_sequence: int=0, system_number: int=0,
+                    image_bytes: int=256, n_events: int=4, n_samples: int=8, seed: int=0) -> np.ndarray:
+    """
+    Generates data packets as sent by Doppio, with common header.
+
+    Samples are a noisy baseline around 1000 with an occasional pulse. Packet Sequence counts from
+    first_sequence, Timestamp and Event ID count packets.
+
+    Args:
+        data_format: See UDPhandler.
+        image_bytes: Image data bytes per packet, data_format 0.
+        n_events: Events per packet, data_format 1 and 3.
+        n_samples: Samples per event, data_format 1 and 2.
+
+    Returns:
+        packets: (n_packets, packet length) uint8.
+    """
+    rng = np.random.default_rng(seed)
+    dtype = _getPacketDtype(data_format, image_bytes, n_events, n_samples)
+    packets = np.zeros(n_packets, dtype)
+    counter = np.arange(n_packets, dtype=np.int64)
+    packets['Packet ID'] = (system_number & 0x1F) << 8 | DATA_FORMAT_PACKET_TYPE[data_format]
+    packets['Packet Sequence'] = (first_sequence + counter) & 0xFFFF
+    packets['Timestamp'] = (first_sequence + counter) & 0xFFFFFFFF
+    packets['Data Length'] = dtype.itemsize - COMMON_HEADER_LENGTH
+
+    def samples(shape):
+        # Pulse in 10 % of the waveforms, starting between 1/4 and 1/2 of the waveform
+        values = rng.normal(1000, 5, shape)
+        pulse = rng.random(shape[0]) < 0.1
+        n_pulses = int(pulse.sum())
+        rise = np.arange(shape[1]) - rng.integers(shape[1]//4, shape[1]//2 + 1, n_pulses)[:, None]
+        tau = max(shape[1]//40, 1)
+        pulse_shape = np.where(rise >= 0, rise/tau*np.exp(1 - rise/tau), 0.0)
+        values[pulse] += rng.exponential(500, n_pulses)[:, None]*pulse_shape
+        return np.clip(values, 0, 0xFFFF).astype(np.uint16)
+
+    if data_format == 0:
+        packets['Frame Number'] = counter & 0xFFFF
+        packets['Image Width'] = image_bytes
+        packets['Image Height'] = 1
+        packets['Spectral Channels'] = 1
+        packets['Data Width'] = 8
+        packets['Packets per Image'] = 1
+        packets['Image Data'] = rng.integers(0, 256, (n_packets, image_bytes), dtype=np.uint8)
+    elif data_format == 1:
+        packets['Number of Events'] = n_events
+        packets['Samples per Event'] = n_samples
+        packets['Events']['Timestamp'] = packets['Timestamp'][:, None]*n_events + np.arange(n_events)
+        event_samples = packets['Events']['Samples']
+        event_samples['Channel ID'] = np.arange(n_samples) % 64
+        event_samples['Sample'] = samples((n_packets*n_events, n_samples)).reshape(n_packets, n_events, n_samples)
+    elif data_format == 2:
+        packets['Channel ID'] = counter % 64
+        packets['Number of Samples'] = n_samples
+        packets['Samples'] = samples((n_packets, n_samples))
+    elif data_format == 3:
+        packets['Number of Events'] = n_events - 1
+        packets['Events']['Timestamp'] = packets['Timestamp'][:, None]*n_events + np.arange(n_events)
+        packets['Events']['Triggered'] = rng.integers(0, 256, (n_packets, n_events), dtype=np.uint8)
+    elif data_format == 4:
+        packets['Event ID'] = counter
+        packets['PPS Timestamp'] = counter // 1000
+        packets['Cells'] = samples((n_packets, getDtype('pipeline_sampling_cells')['Cells'].shape[0]))
+    return packets.view(np.uint8).reshape(n_packets, dtype.itemsize)
+
+
+def applyLossReorder(n_packets: int, loss: float=0.0, reorder: float=0.0, seed: int=0) -> np.ndarray:
+    """
+    Send order of packets, with injected loss and reordering.
+
+    Args:
+        loss: Probability that a packet is dropped.
+        reorder: Probability that a packet is swapped with the next one.
+
+    Returns:
+        order: Indices of the packets to send, in send order.
+    """
+    rng = np.random.default_rng(seed)
+    order = np.arange(n_packets)
+    swap = np.flatnonzero(rng.random(n_packets - 1) < reorder) if n_packets > 1 else np.zeros(0, np.int64)
+    swap = swap[np.diff(swap, prepend=-2) > 1]      # No overlapping swaps
+    order[swap], order[swap + 1] = order[swap + 1], order[swap].copy()
+    return order[rng.random(n_packets) >= loss]
+
+
+class DoppioEmulator:
+    """
+    Emulated Doppio board. TCP control server, and UDP data stream to a UDPhandler.
+
+    Args:
+        host: Address of the TCP server.
+        tcp_port: Port of the TCP server, 0 for any free port. See tcp_address.
+        latency: Seconds from receiving a TCP request to sending its readback.
+    """
+    def __init__(self, host: str='127.0.0.1', tcp_port: int=0, latency: float=0.0):
+        self.registers = RegisterModel()
+        self.latency = latency
+        self.n_requests = 0
+        self.n_sent = 0                     # UDP packets sent by the last stream
+        self.drop_readbacks = set()         # Packet counts of requests applied without readback, to emulate loss
+
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, tcp_port))
+        server.listen(16)
+        self.server = server
+        self.tcp_address = server.getsockname()
+        self.udp_s = socket.socket(type=socket.SOCK_DGRAM)
+
+        self._connections = []
+        self._stream_thread = None
+        self._stop_stream = threading.Event()
+        self._accept_thread = threading.Thread(target=self._acceptLoop, name='DoppioEmulator', daemon=True)
+        self._accept_thread.start()
+
+    def __enter__(self) -> 'DoppioEmulator':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stops streaming and closes all sockets."""
+        self.stopStream()
+        self.server.close()
+        for connection in self._connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+        self.udp_s.close()
+
+    def _acceptLoop(self) -> None:
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connections.append(connection)
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection: socket.socket) -> None:
+        """Answers requests of one TCP connection, in order."""
+        reader = FramedReader(connection)
+        try:
+            while True:
+                frame = reader.readFrame()
+                self.n_requests += 1
+                readback = self.handleRequest(frame)
+                if readback is None or (int.from_bytes(frame[2:4], 'big') & 0x3FFF) in self.drop_readbacks:
+                    continue
+                if self.latency:
+                    time.sleep(self.latency)
+                connection.sendall(readback)
+        except (ConnectionError, OSError):
+            connection.close()
+
+    def handleRequest(self, frame: bytes) -> bytes:
+        """
+        Applies a request packet to the register model.
+
+        Returns:
+            readback: Readback packet, None for unknown packet types.
+        """
+        packet_id, packet_sequence, reserved, _ = PACKET_HEADER.unpack_from(frame)
+        packet_type = packet_id & 0xFF
+        data = frame[PACKET_HEADER.size:]
+        if packet_type == 0x10:
+            reg_addr = int.from_bytes(data[0:2], 'big')
+            self.registers.writeSys(reg_addr, data[3:3 + data[2]])
+            readback_type, readback_data = 0x12, data
+        elif packet_type == 0x11:
+            reg_addr = int.from_bytes(data[0:2], 'big')
+            value = self.registers.readSys(reg_addr)
+            readback_type, readback_data = 0x12, data[0:2] + bytes([len(value)]) + value
+        elif packet_type == 0xC0:
+            readback_type, readback_data = 0xC1, data[0:3] + self.registers.shift(data[3:])
+        elif packet_type == 0xC2:
+            self.registers.writeSpi(int.from_bytes(data[2:4], 'big'), data[6:])
+            readback_type, readback_data = 0xC4, data
+        elif packet_type == 0xC3:
+            reg_addr = int.from_bytes(data[2:4], 'big')
+            reg_length = (int.from_bytes(data[4:6], 'big') + 7)//8
+            readback_type, readback_data = 0xC4, data[0:6] + self.registers.readSpi(reg_addr, reg_length)
+        else:
+            return None
+        readback_id = (packet_id & 0xFF00) | readback_type
+        return PACKET_HEADER.pack(readback_id, packet_sequence, reserved, len(readback_data)) + readback_data
+
+    def stream(self, address: tuple, data_format: int, n_packets: int, rate: float=None, loss: float=0.0,
+               reorder: float=0.0, seed: int=0, **packet_options) -> int:
+        """
+        Sends generated data packets to a UDPhandler, see generatePackets.
+
+        Args:
+            address: (ip, port) of the UDPhandler.
+            rate: Packets per second. As fast as possible if None.
+            loss: Probability that a packet is dropped, see applyLossReorder.
+            reorder: Probability that a packet is swapped with the next one.
+            packet_options: image_bytes, n_events, n_samples, see generatePackets.
+
+        Returns:
+            n_sent: Number of packets sent.
+        """
+        packets = generatePackets(data_format, n_packets, seed=seed, **packet_options)
+        order = applyLossReorder(n_packets, loss, reorder, seed)
+        self.n_sent = 0
+        t_start = time.perf_counter()
+        for n, index in enumerate(order.tolist()):
+            if self._stop_stream.is_set():
+                break
+            if rate is not None:
+                delay = t_start + n/rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.udp_s.sendto(packets[index], address)
+            self.n_sent += 1
+        return self.n_sent
+
+    def startStream(self, address: tuple, data_format: int, n_packets: int, **stream_options) -> None:
+        """Runs stream in a background thread, see stream. Stopped by stopStream."""
+        self.stopStream()
+        self._stop_stream.clear()
+        self._stream_thread = threading.Thread(target=self.stream, args=(address, data_format, n_packets),
+                                               kwargs=stream_options, name='DoppioEmulatorStream', daemon=True)
+        self._stream_thread.start()
+
+    def stopStream(self, timeout: float=None) -> None:
+        """Stops the background stream and waits for it."""
+        if self._stream_thread is not None:
+            self._stop_stream.set()
+            self._stream_thread.join(timeout)
+            self._stream_thread = None
+
+    def waitStream(self, timeout: float=None) -> None:
+        """Waits until the background stream has sent all packets."""
+        if self._stream_thread is not None:
+            self._stream_thread.join(timeout)
+            self._stream_thread = None
@@ -0,0 +1,114 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Batched feature extraction of pipeline sampling waveforms.
+
+Each 160-cell waveform is reduced to one dataformats 'waveform_features' record (28 bytes, from a
+344 byte packet), keyed by Event ID and PPS Timestamp. All features are computed with reductions
+over the whole (N, 160) block:
+    Baseline, Baseline RMS: mean and standard deviation of the first n_baseline cells.
+    Amplitude, Peak Cell: maximum of the baseline-subtracted waveform (times polarity) and its cell.
+    Integral: sum of the baseline-subtracted waveform over integral_window.
+    Threshold Cell, Time over Threshold: first cell and number of cells above threshold.
+With triggered_only, waveforms that never cross threshold are dropped.
+
+Example:
+    features = extractDecoded(decode(4, data, lengths), threshold=50, triggered_only=True)
+"""
+
+import numpy as np
+from dataformats import getDtype
+
+NO_CROSSING = 255
+
+
+def extractFeatures(cells: np.ndarray, packets: np.ndarray, threshold: float, n_baseline: int=16,
+                    polarity: int=1, integral_window: tuple=None, triggered_only: bool=False,
+                    work: np.ndarray=None) -> np.ndarray:
+    """
+    Reduces waveforms to features, see module docstring.
+
+    Args:
+        cells: (N, n_cells) samples, any dtype and byte order, e.g. decoded 'cells' or calibrated samples.
+        packets: (N,) records with Event ID, PPS Timestamp and Source ID, e.g. decoded 'packets'.
+        threshold: Threshold on the baseline-subtracted waveform, times polarity.
+        n_baseline: Number of first cells used for the baseline.
+        polarity: 1 for positive pulses, -1 for negative pulses.
+        integral_window: (first cell, end cell) of the integral. All cells if None.
+        triggered_only: Drop waveforms without threshold crossing.
+        work: (>= N, n_cells) float32 array to reuse for the baseline-subtracted waveforms.
+
+    Returns:
+        features: (N,) 'waveform_features' records, fewer with triggered_only.
+    """
+    n = len(cells)
+    if work is None:
+        work = np.empty(cells.shape, np.float32)
+    waveform = work[:n]
+    np.copyto(waveform, cells, casting='unsafe')
+
+    baseline_cells = waveform[:, :n_baseline]
+    baseline = baseline_cells.mean(axis=1)
+    baseline_rms = baseline_cells.std(axis=1)
+    waveform -= baseline[:, None]
+    if polarity < 0:
+        np.negative(waveform, out=waveform)
+
+    rows = np.arange(n)
+    peak_cell = waveform.argmax(axis=1)
+    amplitude = waveform[rows, peak_cell]
+    if integral_window is None:
+        integral = waveform.sum(axis=1)
+    else:
+        integral = waveform[:, integral_window[0]:integral_window[1]].sum(axis=1)
+    above = waveform > threshold
+    time_over_threshold = above.sum(axis=1)
+    threshold_cell = np.where(time_over_threshold > 0, above.argmax(axis=1), NO_CROSSING)
+
+    features = np.empty(n, getDtype('waveform_features'))
+    features['Event ID'] = packets['Event ID']
+    features['PPS Timestamp'] = packets['PPS Timestamp']
+    features['Source ID'] = packets['Source ID']
+    features['Peak Cell'] = peak_cell
+    features['Threshold Cell'] = threshold_cell
+    features['Time over Threshold'] = np.minimum(time_over_threshold, 255)
+    features['Amplitude'] = amplitude
+    features['Integral'] = integral
+    features['Baseline'] = baseline
+    features['Baseline RMS'] = baseline_rms
+    if triggered_only:
+        features = features[time_over_threshold > 0]
+    return features
+
+
+def extractDecoded(decoded: dict, threshold: float, **options) -> np.ndarray:
+    """Features of decoded pipeline sampling packets, see extractFeatures and decoders.decode."""
+    return extractFeatures(decoded['cells'], decoded['packets'], threshold, **options)
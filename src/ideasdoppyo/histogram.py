@@ -0,0 +1,184 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Streaming histograms of ADC samples, accumulated per captured batch.
+
+Counts are fixed integer bins, so memory is O(bins) whatever the run length. A batch adds the np.bincount
+of the range of bins it touches, allocating O(samples in the batch + bins in that range).
+Samples of any integer dtype and byte order are accepted; they are converted to native int64 once per batch.
+
+Example, per-cell spectra of pipeline sampling during a run:
+    histogram = SampleHistogram(low=0, high=4096, n_rows=dataformats.PIPELINE_CELLS)
+    ring = udp.startCapture()
+    for data, lengths in ring.batches(timeout=1.0):
+        histogram.updateDecoded(4, decode(4, data, lengths))
+"""
+
+import numpy as np
+
+
+class SampleHistogram:
+    """
+    Histogram of n_rows rows (e.g. channels or cells) of bins [low, high) of width bin_width.
+
+    Samples outside [low, high) are counted per row in underflow and overflow.
+    """
+    def __init__(self, low: int=0, high: int=65536, bin_width: int=1, n_rows: int=1, by: str='cell'):
+        """
+        Args:
+            low: Lowest sample value of the first bin.
+            high: End of the last bin, excluded.
+            bin_width: Sample values per bin.
+            n_rows: Number of rows, 1 for a single histogram.
+            by: Row of each sample in updateDecoded for pipeline sampling, 'cell' or 'source' (Source ID).
+        """
+        assert (high > low and bin_width >= 1), f"expected low < high and bin_width >= 1"
+        assert (by in ['cell', 'source']), f"by should be 'cell' or 'source'"
+        self.low = int(low)
+        self.high = int(high)
+        self.bin_width = int(bin_width)
+        self.n_bins = -(-(self.high - self.low)//self.bin_width)
+        self.n_rows = n_rows
+        self.by = by
+        self.counts = np.zeros((n_rows, self.n_bins), np.int64)
+        self.underflow = np.zeros(n_rows, np.int64)
+        self.overflow = np.zeros(n_rows, np.int64)
+        self.n_samples = 0
+
+    @property
+    def edges(self) -> np.ndarray:
+        """Bin edges, n_bins + 1."""
+        return self.low + self.bin_width*np.arange(self.n_bins + 1)
+
+    @property
+    def centers(self) -> np.ndarray:
+        return self.low + self.bin_width*(np.arange(self.n_bins) + 0.5)
+
+    def reset(self) -> None:
+        """Clears all counts."""
+        self.counts[:] = 0
+        self.underflow[:] = 0
+        self.overflow[:] = 0
+        self.n_samples = 0
+
+    def update(self, samples: np.ndarray, rows: np.ndarray=None) -> None:
+        """
+        Adds samples.
+
+        Args:
+            samples: Integer samples, any shape.
+            rows: Row of each sample, broadcastable to samples. Required if n_rows > 1.
+        """
+        samples = np.asarray(samples)
+        if samples.size == 0:
+            return
+        bins = samples.astype(np.int64).ravel()
+        if rows is None:
+            assert (self.n_rows == 1), f"rows is required for a histogram of {self.n_rows} rows"
+            rows = np.zeros(1, np.int64)
+        rows = np.broadcast_to(rows, samples.shape).ravel().astype(np.int64, copy=False)
+        assert (rows.max() < self.n_rows), f"row {rows.max()} is outside histogram of {self.n_rows} rows"
+
+        if bins.min() < self.low or bins.max() >= self.high:
+            below = bins < self.low
+            above = bins >= self.high
+            self.underflow += np.bincount(rows[below], minlength=self.n_rows)[:self.n_rows]
+            self.overflow += np.bincount(rows[above], minlength=self.n_rows)[:self.n_rows]
+            in_range = ~(below | above)
+            bins = bins[in_range]
+            rows = rows[in_range]
+        if self.low:
+            bins -= self.low
+        if self.bin_width > 1:
+            bins //= self.bin_width
+        if self.n_rows > 1:
+            bins += rows*self.n_bins
+        if bins.size:
+            # Count over the bins the batch touches only, np.add.at is slow before numpy 1.25
+            first = bins.min()
+            last = bins.max()
+            self.counts.reshape(-1)[first:last + 1] += np.bincount(bins - first, minlength=last - first + 1)
+        self.n_samples += samples.size
+
+    def updateDecoded(self, data_format: int, decoded: dict) -> None:
+        """
+        Adds the samples of decoded packets, see decoders.decode.
+
+        Rows with n_rows > 1:
+            4, pipeline sampling: cell index (by='cell') or Source ID (by='source').
+            1, multi-event pulse height: Channel ID of each sample.
+            2, single-event pulse height: Channel ID of the packet.
+        """
+        if data_format == 4:
+            samples = decoded['cells']
+            rows = None
+            if self.n_rows > 1:
+                if self.by == 'cell':
+                    rows = np.arange(samples.shape[1])
+                else:
+                    rows = decoded['packets']['Source ID'][:, None]
+        elif data_format == 1:
+            samples = decoded['samples']['Sample']
+            rows = decoded['samples']['Channel ID'] if self.n_rows > 1 else None
+        elif data_format == 2:
+            samples = decoded['samples']['Sample']
+            rows = None
+            if self.n_rows > 1:
+                rows = np.repeat(decoded['packets']['Channel ID'], np.diff(decoded['sample_offsets']))
+        else:
+            assert False, f"data_format {data_format} has no ADC samples"
+        self.update(samples, rows)
+
+    def merge(self, other: 'SampleHistogram') -> None:
+        """Adds the counts of a histogram with the same bins."""
+        assert (self.counts.shape == other.counts.shape and self.low == other.low
+                and self.bin_width == other.bin_width), f"histograms have different bins"
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.n_samples += other.n_samples
+
+    def save(self, path: str) -> None:
+        """Saves counts, bins and row grouping as .npz."""
+        np.savez(path, counts=self.counts, underflow=self.underflow, overflow=self.overflow,
+                 bins=np.array([self.low, self.high, self.bin_width, self.n_samples]), by=np.array(self.by))
+
+    @classmethod
+    def load(cls, path: str) -> 'SampleHistogram':
+        with np.load(path) as arrays:
+            low, high, bin_width, n_samples = arrays['bins'].tolist()
+            by = str(arrays['by']) if 'by' in arrays else 'cell'
+            histogram = cls(low, high, bin_width, arrays['counts'].shape[0], by)
+            histogram.counts[:] = arrays['counts']
+            histogram.underflow[:] = arrays['underflow']
+            histogram.overflow[:] = arrays['overflow']
+            histogram.n_samples = n_samples
+        return histogram
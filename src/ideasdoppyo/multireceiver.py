@@ -0,0 +1,225 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Receives UDP packets from several Doppio boards in one event loop, merged into one time-ordered stream.
+
+MultiReceiver binds one socket per (server_ip, port) and waits on all of them with selectors
+(epoll on Linux). Each packet is tagged with its origin, an index into origins of
+(local address, board address). Packets are merged on a common header or packet header field, Timestamp
+by default, through a bounded k-way merge:
+    - A packet is emitted when every active origin has a packet pending, so nothing earlier can still arrive.
+    - An origin that sent nothing for max_wait seconds is not waited for. Neither is a socket that
+      received nothing in the first max_wait seconds.
+    - An origin with max_pending packets pending forces emission, bounding memory. Packets emitted
+      before an earlier one of another origin are counted in out_of_order. Its socket is not read
+      further until then, following packets wait in the socket receive buffer.
+Packets of one origin keep their arrival order.
+
+Key values wrap at 2**(8*field size). They are unwrapped per origin into a monotonic integer, like
+sequencechecker.SequenceChecker: a step of less than half the modulo is taken as forward or backward.
+The first key of an origin is unwrapped relative to the last key received from any origin, so boards
+with synchronised clocks stay ordered across a wrap. A key that resets, e.g. PPS Timestamp at each
+PPS, is a backward step, packets are ordered within a PPS period only.
+
+Example:
+    receiver = MultiReceiver(4, [('10.10.0.100', 50011), ('10.10.0.100', 50012)], key='PPS Timestamp')
+    for origin, packet in receiver.packets(timeout=1.0):
+        ...
+"""
+
+import collections
+import heapq
+import selectors
+import socket
+import time
+
+from capturebuffer import MAX_PACKET_SIZE
+from dataformats import getDtype
+from decoders import DATA_FORMAT_DTYPE
+
+
+class MultiReceiver:
+    """
+    Args:
+        data_format: See UDPhandler. Selects the packet header holding key.
+        addresses: (server_ip, port) to bind, one socket each.
+        key: Big-endian field of the packet header to order on, e.g. 'Timestamp' or 'PPS Timestamp'.
+        max_pending: Maximum packets pending per origin.
+        max_wait: Seconds an origin may be silent before it is no longer waited for.
+        max_packet_size: Longer packets are truncated.
+    """
+    def __init__(self, data_format: int, addresses: list, key: str='Timestamp', max_pending: int=1024,
+                 max_wait: float=0.1, max_packet_size: int=MAX_PACKET_SIZE):
+        dtype = getDtype(DATA_FORMAT_DTYPE[data_format])
+        assert (key in dtype.names), f"{key} is not a field of {DATA_FORMAT_DTYPE[data_format]}"
+        field_dtype, self.key_offset = dtype.fields[key][:2]
+        self.key_length = field_dtype.itemsize
+        self.key_modulo = 1 << (8*self.key_length)
+        self.key = key
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.max_packet_size = max_packet_size
+
+        self.selector = selectors.DefaultSelector()
+        self.sockets = []
+        for server_ip, port in addresses:
+            udp_s = socket.socket(type=socket.SOCK_DGRAM)
+            udp_s.bind((server_ip, port))
+            udp_s.setblocking(False)
+            self.selector.register(udp_s, selectors.EVENT_READ, len(self.sockets))
+            self.sockets.append(udp_s)
+
+        self.origins = []                   # (local address, board address) per origin
+        self.received = []                  # Packets received per origin
+        self.out_of_order = 0
+        self._origin_index = {}
+        self._queues = []                   # Per origin: deque of (unwrapped key value, packet)
+        self._last_seen = []                # Per origin: time of last packet
+        self._last_unwrapped = []           # Per origin: unwrapped key value of last packet
+        self._reference_key = None          # Unwrapped key value of the last packet of any origin
+        self._heap = []                     # (key value, arrival number, origin) of each non-empty queue head
+        self._n_arrived = 0
+        self._last_key = None
+        self._socket_seen = [False]*len(self.sockets)
+        self._started = time.monotonic()
+
+    def _getOrigin(self, socket_index: int, board_address: tuple) -> int:
+        origin = self._origin_index.get((socket_index, board_address))
+        if origin is None:
+            origin = len(self.origins)
+            self._origin_index[(socket_index, board_address)] = origin
+            self.origins.append((self.sockets[socket_index].getsockname(), board_address))
+            self.received.append(0)
+            self._queues.append(collections.deque())
+            self._last_seen.append(0.0)
+            self._last_unwrapped.append(self._reference_key)
+        return origin
+
+    def _unwrapKey(self, origin: int, key_value: int) -> int:
+        """Unwraps key_value relative to the last key of origin, see module docstring."""
+        reference = self._last_unwrapped[origin]
+        if reference is None:
+            reference = key_value
+        step = (key_value - reference + self.key_modulo//2) % self.key_modulo - self.key_modulo//2
+        unwrapped = reference + step
+        self._last_unwrapped[origin] = unwrapped
+        self._reference_key = unwrapped
+        return unwrapped
+
+    def _receive(self, timeout: float) -> int:
+        """
+        Receives the packets waiting on ready sockets, until an origin has max_pending packets pending.
+
+        Returns:
+            n: Number of packets.
+        """
+        n = 0
+        now = time.monotonic()
+        for selector_key, _ in self.selector.select(timeout):
+            udp_s = selector_key.fileobj
+            while True:
+                try:
+                    packet, board_address = udp_s.recvfrom(self.max_packet_size)
+                except BlockingIOError:
+                    break
+                origin = self._getOrigin(selector_key.data, board_address)
+                self._socket_seen[selector_key.data] = True
+                key_value = int.from_bytes(packet[self.key_offset:self.key_offset + self.key_length], 'big')
+                key_value = self._unwrapKey(origin, key_value)
+                queue = self._queues[origin]
+                if not queue:
+                    heapq.heappush(self._heap, (key_value, self._n_arrived, origin))
+                queue.append((key_value, packet))
+                self._n_arrived += 1
+                self.received[origin] += 1
+                self._last_seen[origin] = now
+                n += 1
+                if len(queue) >= self.max_pending:
+                    break
+        return n
+
+    def _mergeReady(self, flush: bool=False):
+        """Generator of (origin, packet) that can be emitted in order, all pending if flush."""
+        queues = self._queues
+        while self._heap:
+            if not flush:
+                now = time.monotonic()
+                full = any(len(queue) >= self.max_pending for queue in queues)
+                waiting = any(not queue and now - last_seen < self.max_wait
+                              for queue, last_seen in zip(queues, self._last_seen))
+                if not all(self._socket_seen) and now - self._started < self.max_wait:
+                    waiting = True              # Sockets without any origin yet
+                if waiting and not full:
+                    return
+            key_value, _, origin = heapq.heappop(self._heap)
+            queue = queues[origin]
+            _, packet = queue.popleft()
+            if queue:
+                heapq.heappush(self._heap, (queue[0][0], self._n_arrived, origin))
+                self._n_arrived += 1
+            if self._last_key is not None and key_value < self._last_key:
+                self.out_of_order += 1
+            else:
+                self._last_key = key_value
+            yield origin, packet
+
+    def packets(self, timeout: float=None):
+        """
+        Generator of (origin, packet) of all sockets, ordered on key.
+
+        Ends after no packet arrived for timeout seconds, after emitting all pending packets.
+        Waits forever if timeout is None.
+        """
+        last_packet = time.monotonic()
+        while True:
+            poll = self.max_wait if timeout is None else min(self.max_wait, timeout)
+            if self._receive(poll):
+                last_packet = time.monotonic()
+            elif timeout is not None and time.monotonic() - last_packet >= timeout:
+                yield from self._mergeReady(flush=True)
+                return
+            yield from self._mergeReady()
+
+    def collectNpackets(self, N: int, timeout: float=None) -> list:
+        """List of N (origin, packet), ordered on key. Fewer if timeout expires."""
+        collected = []
+        for item in self.packets(timeout):
+            collected.append(item)
+            if len(collected) == N:
+                break
+        return collected
+
+    def close(self) -> None:
+        """Closes all sockets."""
+        for udp_s in self.sockets:
+            self.selector.unregister(udp_s)
+            udp_s.close()
+        self.selector.close()
@@ -0,0 +1,139 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Packet tracing for TCPhandler, cheap enough to stay enabled in production.
+
+PacketTrace stores the raw bytes of each packet; formatting is deferred until it is needed:
+    - In-memory ring of the last capacity packets, formatted only by dump().
+    - logging, at level on logger. Skipped by a level check when the level is disabled, and formatted
+      by the logging handler only when the record is emitted.
+    - Optionally a background thread formats and logs, so the caller never formats or writes.
+
+Example:
+    logging.basicConfig(level=logging.DEBUG)
+    tcp.doPrint = False
+    tcp.setTrace(PacketTrace(capacity=10000, background=True))
+    ...
+    print('\\n'.join(tcp.trace.dump()[-20:]))
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+from tcphandler import doPrinter
+
+
+def formatPacket(packet: bytes, doPrintFormat: int=1) -> str:
+    """Formats packet as doPrinter with the given doPrintFormat."""
+    printer = doPrinter(doPrintFormat)
+    printer.data_bytes = packet
+    return str(printer)
+
+
+class LazyPacket:
+    """Logging argument formatted only if the log record is emitted."""
+    __slots__ = ('packet', 'doPrintFormat')
+
+    def __init__(self, packet: bytes, doPrintFormat: int=1):
+        self.packet = packet
+        self.doPrintFormat = doPrintFormat
+
+    def __str__(self) -> str:
+        return formatPacket(self.packet, self.doPrintFormat)
+
+
+class PacketTrace:
+    """
+    Records raw packets. See module docstring.
+
+    Args:
+        capacity: Number of packets kept in the ring. 0 disables the ring.
+        logger: Logger name, packets are logged at level.
+        background: Format and log in a background thread.
+    """
+    def __init__(self, capacity: int=4096, logger: str='ideasdoppyo.packets', level: int=logging.DEBUG,
+                 doPrintFormat: int=1, background: bool=False):
+        self.ring = collections.deque(maxlen=capacity) if capacity else None
+        self.logger = logging.getLogger(logger)
+        self.level = level
+        self.doPrintFormat = doPrintFormat
+        self._queue = None
+        self._thread = None
+        if background:
+            self._queue = queue.SimpleQueue()
+            self._thread = threading.Thread(target=self._writeLoop, name='PacketTrace', daemon=True)
+            self._thread.start()
+
+    def record(self, packet: bytes) -> None:
+        """Records packet. Called by TCPhandler for every sent and received packet."""
+        if self.ring is not None:
+            self.ring.append((time.time(), packet))
+        if self.logger.isEnabledFor(self.level):
+            if self._queue is not None:
+                self._queue.put(packet)
+            else:
+                self.logger.log(self.level, '%s', LazyPacket(packet, self.doPrintFormat))
+
+    def _writeLoop(self) -> None:
+        while True:
+            packet = self._queue.get()
+            if packet is None:
+                break
+            self.logger.log(self.level, '%s', formatPacket(packet, self.doPrintFormat))
+
+    def dump(self, doPrintFormat: int=None) -> list:
+        """
+        Formats the packets in the ring, oldest first.
+
+        Returns:
+            lines: 'time packet' per packet.
+        """
+        if self.ring is None:
+            return []
+        doPrintFormat = doPrintFormat or self.doPrintFormat
+        return [f'{time.strftime("%H:%M:%S", time.localtime(t))}.{int(t % 1*1e6):06d} {formatPacket(packet, doPrintFormat)}'
+                for t, packet in list(self.ring)]
+
+    def clear(self) -> None:
+        """Empties the ring."""
+        if self.ring is not None:
+            self.ring.clear()
+
+    def close(self) -> None:
+        """Stops the background thread, after logging the queued packets."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
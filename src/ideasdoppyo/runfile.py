@@ -0,0 +1,362 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Run files for recorded UDP data. Written by RunWriter, read by RunReader.
+
+A run is a series of segments <base_path>_<segment>.dat / .idx:
+    .dat: Header, then the raw packets (including common header) appended as received.
+    .idx: Header, then one INDEX_DTYPE record per packet.
+The .dat header is RUN_MAGIC, version, JSON length (little-endian u4 each) and JSON with data_format and dtype.
+"""
+
+import concurrent.futures
+import collections
+import glob
+import json
+import struct
+import time
+
+import numpy as np
+from capturebuffer import CaptureBuffer
+from dataformats import getDtype
+from decoders import DATA_FORMAT_PACKET_TYPE, DATA_FORMAT_DTYPE, decoder_dict, gatherRecords, gatherRanges, mergeDecoded
+
+RUN_MAGIC = b'IDEASRUN'
+INDEX_MAGIC = b'IDEASIDX'
+RUN_VERSION = 1
+RUN_HEADER = struct.Struct('<8sII')         # Magic, version, JSON length
+INDEX_HEADER = struct.Struct('<8sII')       # Magic, version, record size
+
+INDEX_DTYPE = np.dtype([('Offset', '<u8'),              # Byte offset of packet in .dat
+                        ('Length', '<u4'),              # Byte length of packet, including common header
+                        ('Packet Sequence', '<u2'),
+                        ('Timestamp', '<u4')])
+
+
+def getSegmentPaths(base_path: str, segment: int) -> tuple:
+    """(.dat path, .idx path) of a run segment."""
+    return f'{base_path}_{segment:04d}.dat', f'{base_path}_{segment:04d}.idx'
+
+
+class RunWriter:
+    """
+    Streams captured packets to run files.
+
+    Packets are collected in memory and written in chunks of chunk_bytes. Writes are done by a
+    background thread, so the capture path only copies packets into the chunk.
+    A new segment is started when a segment exceeds max_file_bytes or max_file_seconds.
+    """
+    def __init__(self, base_path: str, data_format: int, max_file_bytes: int=None, max_file_seconds: float=None,
+                 chunk_bytes: int=4*1024*1024, max_pending_chunks: int=16):
+        """
+        Args:
+            base_path: Path and name of run, without segment number and extension.
+            data_format: UDPhandler data_format of the packets.
+            max_file_bytes: Size of .dat file before rotation. None for no limit.
+            max_file_seconds: Duration of a segment before rotation. None for no limit.
+            chunk_bytes: Size of writes to disk.
+            max_pending_chunks: Chunks queued for the writer thread before writePackets blocks.
+        """
+        self.base_path = base_path
+        self.data_format = data_format
+        self.max_file_bytes = max_file_bytes
+        self.max_file_seconds = max_file_seconds
+        self.chunk_bytes = chunk_bytes
+        self.max_pending_chunks = max_pending_chunks
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending_writes = collections.deque()
+
+        self._pending_data = []
+        self._pending_index = []
+        self._pending_bytes = 0
+
+        self.n_packets = 0
+        self.segment = -1
+        self._data_file = None
+        self._index_file = None
+        self._openSegment()
+
+    def _runHeader(self) -> bytes:
+        dtype_name = DATA_FORMAT_DTYPE[self.data_format]
+        header = {
+            'data_format': self.data_format,
+            'packet_type': DATA_FORMAT_PACKET_TYPE[self.data_format],
+            'dtype_name': dtype_name,
+            'dtype': getDtype(dtype_name).descr,
+            'segment': self.segment,
+            'created': time.time()
+        }
+        header_json = json.dumps(header).encode('utf-8')
+        return RUN_HEADER.pack(RUN_MAGIC, RUN_VERSION, len(header_json)) + header_json
+
+    def _submit(self, function, *args) -> None:
+        """Runs function on the writer thread, in order. Blocks if too many writes are pending."""
+        while len(self._pending_writes) >= self.max_pending_chunks:
+            self._pending_writes.popleft().result()
+        while self._pending_writes and self._pending_writes[0].done():
+            self._pending_writes.popleft().result()
+        self._pending_writes.append(self._executor.submit(function, *args))
+
+    def _openSegment(self) -> None:
+        self.segment += 1
+        data_path, index_path = getSegmentPaths(self.base_path, self.segment)
+        self._data_file = open(data_path, 'wb')
+        self._index_file = open(index_path, 'wb')
+        run_header = self._runHeader()
+        self._submit(self._data_file.write, run_header)
+        self._submit(self._index_file.write, INDEX_HEADER.pack(INDEX_MAGIC, RUN_VERSION, INDEX_DTYPE.itemsize))
+        self._file_bytes = len(run_header)
+        self._segment_packets = 0
+        self._segment_start = time.monotonic()
+
+    def _closeSegment(self) -> None:
+        self.flush()
+        self._submit(self._data_file.close)
+        self._submit(self._index_file.close)
+
+    def _rotate(self) -> bool:
+        """True if the current segment is full."""
+        if self._segment_packets == 0:
+            return False
+        segment_bytes = self._file_bytes + self._pending_bytes
+        if self.max_file_bytes is not None and segment_bytes >= self.max_file_bytes:
+            return True
+        if self.max_file_seconds is not None and time.monotonic() - self._segment_start >= self.max_file_seconds:
+            return True
+        return False
+
+    def writePackets(self, data: np.ndarray, lengths: np.ndarray) -> None:
+        """
+        Appends packets in slots, e.g. a batch from CaptureRing.batches().
+
+        Args:
+            data: (n_packets, slot_size) uint8 array, packets including common header.
+            lengths: Received bytes per packet.
+        """
+        n, slot_size = data.shape
+        if n == 0:
+            return
+        if self._rotate():
+            self._closeSegment()
+            self._openSegment()
+
+        lengths = np.asarray(lengths[:n], dtype=np.int64)
+        slot_offsets = np.arange(n, dtype=np.int64)*slot_size
+        packet_bytes, packet_offsets = gatherRanges(data.reshape(-1), slot_offsets, lengths)
+        headers = gatherRecords(data.reshape(-1), slot_offsets, getDtype('common_header'))
+
+        index = np.empty(n, dtype=INDEX_DTYPE)
+        index['Offset'] = self._file_bytes + self._pending_bytes + packet_offsets[:-1]
+        index['Length'] = lengths
+        index['Packet Sequence'] = headers['Packet Sequence']
+        index['Timestamp'] = headers['Timestamp']
+
+        self._pending_data.append(packet_bytes)
+        self._pending_index.append(index)
+        self._pending_bytes += len(packet_bytes)
+        self._segment_packets += n
+        self.n_packets += n
+        if self._pending_bytes >= self.chunk_bytes:
+            self.flush()
+
+    def writeCapture(self, capture: CaptureBuffer) -> None:
+        """Appends all packets of capture."""
+        self.writePackets(capture.data[:capture.n_packets], capture.lengths)
+
+    def flush(self) -> None:
+        """Hands collected packets to the writer thread as one chunk."""
+        if not self._pending_data:
+            return
+        data_chunk = np.concatenate(self._pending_data)
+        index_chunk = np.concatenate(self._pending_index)
+        self._submit(self._data_file.write, data_chunk)
+        self._submit(self._index_file.write, index_chunk)
+        self._file_bytes += self._pending_bytes
+        self._pending_data = []
+        self._pending_index = []
+        self._pending_bytes = 0
+
+    def close(self) -> None:
+        """Writes remaining packets, closes files and waits for the writer thread."""
+        if self._data_file is None:
+            return
+        self._closeSegment()
+        self._data_file = None
+        self._executor.shutdown(wait=True)
+        for pending_write in self._pending_writes:
+            pending_write.result()
+        self._pending_writes.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def readRunHeader(data_path: str) -> dict:
+    """Run header of a .dat file."""
+    with open(data_path, 'rb') as data_file:
+        magic, version, header_length = RUN_HEADER.unpack(data_file.read(RUN_HEADER.size))
+        assert (magic == RUN_MAGIC), f"{data_path} is not a run file"
+        assert (version == RUN_VERSION), f"{data_path} has run file version {version}, expected {RUN_VERSION}"
+        return json.loads(data_file.read(header_length))
+
+
+class RunReader:
+    """
+    Random access to a recorded run through memory maps of all segments.
+
+    Opening a run only maps the files. Decoding and filtering read the pages of the packets and
+    fields that are accessed. Packets are numbered over all segments, from 0 to len(run) - 1.
+    """
+    def __init__(self, base_path: str):
+        """
+        Args:
+            base_path: Same as given to RunWriter.
+        """
+        self.base_path = base_path
+        data_paths = sorted(glob.glob(glob.escape(base_path) + '_[0-9][0-9][0-9][0-9].dat'))
+        assert (data_paths), f"no run files found for {base_path}"
+
+        self.header = readRunHeader(data_paths[0])
+        self.data_format = self.header['data_format']
+        self.packet_type = self.header['packet_type']
+        self.dtype = getDtype(self.header['dtype_name'])
+        self._decoder = decoder_dict[(self.data_format, self.packet_type)]
+
+        self.data = []
+        self.index = []
+        for data_path in data_paths:
+            index_path = data_path[:-len('.dat')] + '.idx'
+            self.data.append(np.memmap(data_path, dtype=np.uint8, mode='r'))
+            self.index.append(np.memmap(index_path, dtype=INDEX_DTYPE, mode='r', offset=INDEX_HEADER.size))
+
+        # First packet number of each segment, and total
+        self.segment_starts = np.zeros(len(self.index) + 1, dtype=np.int64)
+        np.cumsum([len(index) for index in self.index], out=self.segment_starts[1:])
+
+    def __len__(self) -> int:
+        return int(self.segment_starts[-1])
+
+    def __getitem__(self, packets) -> dict:
+        """run[start:stop] decodes a packet range, run[indices] selected packets."""
+        if isinstance(packets, slice):
+            start, stop, step = packets.indices(len(self))
+            assert (step == 1), f"packet slices with step are not supported, use indices"
+            return self.decode(start, stop)
+        return self.decodeIndices(packets)
+
+    def _segmentIndices(self, indices: np.ndarray):
+        """Yields (segment, local indices) for sorted packet numbers."""
+        indices = np.asarray(indices, dtype=np.int64)
+        bounds = np.searchsorted(indices, self.segment_starts)
+        for segment in range(len(self.index)):
+            if bounds[segment + 1] > bounds[segment]:
+                yield segment, indices[bounds[segment]:bounds[segment + 1]] - self.segment_starts[segment]
+
+    def _segmentRanges(self, start: int, stop: int):
+        """Yields (segment, local start, local stop) for a packet range."""
+        for segment in range(len(self.index)):
+            first = max(start, self.segment_starts[segment])
+            last = min(stop, self.segment_starts[segment + 1])
+            if last > first:
+                yield segment, int(first - self.segment_starts[segment]), int(last - self.segment_starts[segment])
+
+    def decode(self, start: int=0, stop: int=None) -> dict:
+        """
+        Decodes packets start to stop - 1, see decoders.decode.
+
+        Fixed-length records of a range within one segment are views of the memory map.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        results = []
+        for segment, first, last in self._segmentRanges(start, stop):
+            index = self.index[segment][first:last]
+            results.append(self._decoder(self.data[segment], index['Offset'].astype(np.int64),
+                                         index['Length'].astype(np.int64)))
+        if not results:
+            return self._decoder(self.data[0], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        return mergeDecoded(results)
+
+    def decodeIndices(self, indices: np.ndarray) -> dict:
+        """Decodes selected packets, e.g. from selectTimestamp or selectEventId. Indices must be sorted."""
+        results = []
+        for segment, local_indices in self._segmentIndices(indices):
+            index = self.index[segment][local_indices]
+            results.append(self._decoder(self.data[segment], index['Offset'].astype(np.int64),
+                                         index['Length'].astype(np.int64)))
+        if not results:
+            return self._decoder(self.data[0], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        return mergeDecoded(results)
+
+    def field(self, name: str, start: int=0, stop: int=None) -> np.ndarray:
+        """
+        One field of the fixed part of each packet (see DATA_FORMAT_DTYPE), without decoding the rest.
+
+        Index fields ('Offset', 'Length', 'Packet Sequence', 'Timestamp') are read from the index only.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        fields = []
+        for segment, first, last in self._segmentRanges(start, stop):
+            index = self.index[segment][first:last]
+            if name in INDEX_DTYPE.names:
+                fields.append(np.asarray(index[name]))
+            else:
+                records = gatherRecords(self.data[segment], index['Offset'].astype(np.int64), self.dtype)
+                fields.append(np.asarray(records[name]))
+        if not fields:
+            return np.zeros(0, dtype=INDEX_DTYPE[name] if name in INDEX_DTYPE.names else self.dtype[name])
+        return np.concatenate(fields)
+
+    def selectTimestamp(self, t_start: int, t_stop: int) -> np.ndarray:
+        """Packet numbers with t_start <= common header Timestamp < t_stop. Reads the index only."""
+        timestamps = self.field('Timestamp')
+        return np.flatnonzero((timestamps >= t_start) & (timestamps < t_stop))
+
+    def selectEventId(self, first: int, last: int=None) -> np.ndarray:
+        """Packet numbers with first <= Event ID <= last (pipeline sampling). Reads only the Event ID field."""
+        if last is None:
+            last = first
+        event_ids = self.field('Event ID')
+        return np.flatnonzero((event_ids >= first) & (event_ids <= last))
+
+    def close(self) -> None:
+        """Releases the memory maps."""
+        self.data = []
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,155 @@
+
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Packet loss and reordering detection from the common header Packet Sequence counter.
+Checks are vectorized and run once per batch of packets, not per packet.
+"""
+
+import numpy as np
+from dataformats import getDtype
+
+SEQUENCE_OFFSET = getDtype('common_header').fields['Packet Sequence'][1]
+SEQUENCE_MODULO = 1 << 16
+MISSING_WINDOW = SEQUENCE_MODULO // 2
+
+
+def getPacketSequence(data: np.ndarray) -> np.ndarray:
+    """
+    Packet Sequence of each packet.
+
+    Args:
+        data: (n_packets, packet bytes) uint8 array of packets including common header, e.g. CaptureBuffer.data.
+    """
+    return (data[:, SEQUENCE_OFFSET].astype(np.int64) << 8) | data[:, SEQUENCE_OFFSET + 1]
+
+
+class SequenceChecker:
+    """
+    Tracks the 16-bit Packet Sequence across batches, including wraparound.
+
+    Each packet is compared to the highest sequence seen so far:
+        gap: Sequence jumps forward by more than one. The skipped packets are counted as lost.
+        duplicate: Sequence equals the highest seen, or is below it and was already received.
+        reorder: Sequence is below the highest seen and was missing, i.e. a late packet. It is no longer counted as lost.
+
+    Missing sequences are remembered for the last MISSING_WINDOW sequences. Older late packets count as duplicates.
+
+    Counters are totals since reset(). Index arrays returned by check() are packet numbers counted from reset().
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        """Clears counters and sequence history."""
+        self.n_checked = 0
+        self.gaps = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reorders = 0
+
+        self._last_sequence = None      # Last raw sequence value
+        self._last_unwrapped = 0        # Last sequence without wraparound
+        self._max_unwrapped = 0         # Highest sequence without wraparound
+        self._missing = np.zeros(MISSING_WINDOW, dtype=bool)   # Missing flag, indexed by unwrapped % MISSING_WINDOW
+
+    def check(self, sequence: np.ndarray) -> dict:
+        """
+        Checks one batch of Packet Sequence values, in order of arrival.
+
+        Returns:
+            report: {'gaps': indices, 'lost': packets lost, 'duplicates': indices, 'reorders': indices}
+        """
+        sequence = np.asarray(sequence, dtype=np.int64)
+        n = len(sequence)
+        if n == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return {'gaps': empty, 'lost': 0, 'duplicates': empty, 'reorders': empty}
+
+        if self._last_sequence is None:
+            self._last_sequence = int(sequence[0]) - 1
+            self._last_unwrapped = self._last_sequence
+            self._max_unwrapped = self._last_sequence
+
+        # Signed step between consecutive packets, in [-2**15, 2**15)
+        steps = np.diff(sequence, prepend=self._last_sequence)
+        steps = (steps + SEQUENCE_MODULO//2) % SEQUENCE_MODULO - SEQUENCE_MODULO//2
+        unwrapped = self._last_unwrapped + np.cumsum(steps)
+
+        running_max = np.maximum.accumulate(unwrapped)
+        previous_max = np.empty(n, dtype=np.int64)
+        previous_max[0] = self._max_unwrapped
+        np.maximum(running_max[:-1], self._max_unwrapped, out=previous_max[1:])
+        advance = unwrapped - previous_max
+
+        gaps = np.flatnonzero(advance > 1)
+        backward = np.flatnonzero(advance < 0)
+
+        # A late packet fills a missing sequence if it is the first packet of its sequence in this batch,
+        # and the sequence was skipped in this batch or was missing before it
+        start_max = self._max_unwrapped
+        end_max = max(start_max, int(running_max[-1]))
+        _, first = np.unique(unwrapped, return_index=True)
+        is_first = np.zeros(n, dtype=bool)
+        is_first[first] = True
+        late = unwrapped[backward]
+        was_missing = np.where(late > start_max, True,
+                               (late > start_max - MISSING_WINDOW) & self._missing[late % MISSING_WINDOW])
+        filled = is_first[backward] & was_missing
+        reorders = backward[filled]
+        duplicates = np.union1d(np.flatnonzero(advance == 0), backward[~filled])
+        lost = int((advance[gaps] - 1).sum()) - len(reorders)
+
+        # Sequences newly passed by the highest are missing, unless received in this batch
+        if end_max > start_max:
+            passed = np.arange(max(start_max, end_max - MISSING_WINDOW) + 1, end_max + 1)
+            self._missing[passed % MISSING_WINDOW] = True
+        received = unwrapped[unwrapped > end_max - MISSING_WINDOW]
+        self._missing[received % MISSING_WINDOW] = False
+
+        self._last_sequence = int(sequence[-1])
+        self._last_unwrapped = int(unwrapped[-1])
+        self._max_unwrapped = end_max
+
+        offset = self.n_checked
+        self.n_checked += n
+        self.gaps += len(gaps)
+        self.lost += lost
+        self.duplicates += len(duplicates)
+        self.reorders += len(reorders)
+
+        return {'gaps': gaps + offset, 'lost': lost, 'duplicates': duplicates + offset, 'reorders': reorders + offset}
+
+    def checkPackets(self, data: np.ndarray) -> dict:
+        """Checks one batch of packets, see getPacketSequence."""
+        return self.check(getPacketSequence(data))
+
+    def __str__(self) -> str:
+        return f'{self.n_checked} packets checked: {self.gaps} gaps, {self.lost} lost, {self.duplicates} duplicates, {self.reorders} reorders'
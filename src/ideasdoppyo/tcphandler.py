@@ -35,10 +35,48 @@ For TCP, the hardware is configured as the network server, with the PC as client
 """
 
 import numpy as np
+import math
+import select
 import socket
+import struct
 import binascii
 import time
 
+# Packet ID, Packet Sequence, Reserved, Data Length
+PACKET_HEADER = struct.Struct('>HHIH')
+
+# Register space of the shadow cache per readback packet type
+SHADOW_SPACE = {0x12: 'sys', 0xC4: 'spi'}
+
+
+def getPacketHeaderFields(handler, packet_type: hex) -> tuple:
+    """
+    Packet ID and Packet Sequence header fields.
+
+    Args:
+        handler: TCPhandler or AsyncTCPhandler, for version, system_number, sequence_flag and packet_count.
+    """
+    packet_id = (handler.version & 0x7) << 13 | (handler.system_number & 0x1F) << 8 | (packet_type & 0xFF)
+    packet_sequence = (handler.sequence_flag & 0x3) << 14 | handler.packet_count
+    return packet_id, packet_sequence
+
+
+def parseReadBack(frame: bytes) -> tuple:
+    """
+    Decodes a readback packet of type 0x12, 0xC4 or 0xC1.
+
+    Returns:
+        (packet_count, reg_addr, value): reg_addr is None for 0xC1. All None for unknown packet types.
+    """
+    packet_count = ((frame[2] << 8) | frame[3]) & 0x3FFF
+    if frame[1] == 0x12:
+        return packet_count, int.from_bytes(frame[10:12], 'big'), int.from_bytes(frame[13:], 'big')
+    elif frame[1] == 0xC4:
+        return packet_count, int.from_bytes(frame[12:14], 'big'), int.from_bytes(frame[16:], 'big')
+    elif frame[1] == 0xC1:
+        return packet_count, None, int.from_bytes(frame[13:], 'big')
+    return None, None, None
+
 
 class TCPhandler:
     """
@@ -58,23 +96,43 @@ class TCPhandler:
         self.asic_id = int(0).to_bytes(1, 'big')
 
         # For SPI transactions
-        self.version = '{0:03b}'.format(0)
-        self.system_number = '{0:05b}'.format(0)
-        self.sequence_flag = '{0:02b}'.format(0)
-        self.packet_count = '{0:014b}'.format(0)
-        self.reserved = '{0:032b}'.format(0)
+        self.version = 0                                    # 3 bits
+        self.system_number = 0                              # 5 bits
+        self.sequence_flag = 0                              # 2 bits
+        self.packet_count = 0                               # 14 bits
+        self.reserved = 0                                   # 32 bits
         self.spi_format = int(2).to_bytes(1, 'big')         # System level SPI format.
 
         # Printer instance
         self.doPrint = True
         self.doPrintFormat = 1
         self.doPrinter = doPrinter(self.doPrintFormat)
+        self.trace = None                                   # Optional PacketTrace, see setTrace
 
         # TCP ReadBack
-        self.spare_bytes = b''
-        self.auto_readback = [False, 50]
-        self.not_readback = {}                              # packet_count: ((package meta data length, data length), (address, value))
-        self.now_readback = []
+        self.reader = FramedReader(self.tcp_s)
+        self._batch = None                                  # Active PacketBatch, see batch()
+        self.auto_readback = False                          # Sliding-window readback after each write, see setAutoReadBack
+        self.readback_window = 50                           # Maximum outstanding readbacks, limited by the board receive buffer
+        self.adaptive_window = False
+        self.readback_rtt = 0.0                             # Moving average of readback round trip time [s]
+        self.send_interval = 0.0                            # Moving average of time between sent packets [s]
+        self._last_send_time = None
+        self.not_readback = {}                              # packet_count: (readback length, (address, value), send time, shadow epoch)
+        self.now_readback = []                              # (address, value) of received readbacks
+        self.max_not_readback = 4096                        # Oldest outstanding readback is dropped beyond this
+        self.readback_timeout = 3.0                         # Seconds before an outstanding readback is reported
+        self.wrongly_programmed = []                        # Addresses with wrong readback since checkReadBack
+        self.readback_timeouts = []                         # Addresses without readback since checkReadBack
+        self.unexpected_readback = []                       # Packet counts of readbacks without request
+
+        # Shadow register cache, see applyConfiguration
+        self.shadow = {}                                    # See _getShadowKey: last value confirmed by readback
+        self.pulse_registers = set()                        # (space, address) never cached, always written
+        self.reset_registers = {0xFFA0}                     # System registers resetting the ASIC SPI registers
+        self.elided_writes = 0
+        self.shadow_epoch = 0                               # Incremented by invalidateShadow, recorded per request
+        self._invalidated_epoch = {'sys': 0, 'spi': 0}      # shadow_epoch of the last invalidation per space
 
         # Length of header + metadata in readback packets
         self._0x12_METADATA_LENGTH = 10 + 2 + 1 
@@ -84,12 +142,10 @@ class TCPhandler:
         """
         Change sequence_flag.
 
-        '00': Standalone, '01': First packet, '10': Continuation Packet, '11': Last packet.
+        0: Standalone, 1: First packet, 2: Continuation Packet, 3: Last packet.
         """
-        options = ['00', '01', '10', '11']
-        sequence_flag = '{0:02b}'.format(value)
-        assert (sequence_flag in options), f"sequence_flag should be 0, 1, 2 or 3"
-        self.sequence_flag = sequence_flag
+        assert (value in [0, 1, 2, 3]), f"sequence_flag should be 0, 1, 2 or 3"
+        self.sequence_flag = value
 
     def setSpiFormat(self, spi_format: int) -> None:
         """
@@ -115,55 +171,344 @@ class TCPhandler:
         self.doPrintFormat = doPrint_format
         self.doPrinter = doPrinter(self.doPrintFormat)
 
-    def setAutoReadBack(self, enable: bool) -> None:
-        """Performes readback automatically after TCP write."""
-        self.auto_readback[0] = enable
+    def setTrace(self, trace) -> None:
+        """
+        Records every sent and received packet in trace, e.g. packettrace.PacketTrace. None disables.
+
+        Unlike doPrint, a trace only stores the raw packet on the hot path.
+        """
+        self.trace = trace
+
+    def _tracePacket(self, packet: bytes) -> None:
+        """Prints packet if doPrint, and records it in the trace."""
+        if self.doPrint:
+            self.doPrinter.data_bytes = packet
+            print(self.doPrinter)
+        if self.trace is not None:
+            self.trace.record(packet)
+
+    def setAutoReadBack(self, enable: bool, window: int=50, adaptive: bool=False) -> None:
+        """
+        Performes readback automatically after TCP write, with sliding-window flow control.
+
+        After each write, readbacks already received are read without blocking. Writing only blocks
+        when window readbacks are outstanding. Use finishReadBack and checkReadBack after the last write.
+
+        Args:
+            enable: Enables auto readback.
+            window: Maximum number of outstanding readbacks.
+            adaptive: Size the window from the measured readback round trip time and the write rate,
+                up to window. Keeps fewer packets in flight on fast links.
+        """
+        self.auto_readback = enable
+        self.readback_window = window
+        self.adaptive_window = adaptive
+
+    def getReadBackWindow(self) -> int:
+        """Current number of readbacks allowed outstanding."""
+        if not self.adaptive_window or self.send_interval <= 0.0 or self.readback_rtt <= 0.0:
+            return self.readback_window
+        # Packets sent during one round trip, plus one
+        window = math.ceil(self.readback_rtt/self.send_interval) + 1
+        return max(1, min(self.readback_window, window))
+
+    def drainReadBacks(self, max_outstanding: int=None) -> int:
+        """
+        Reads readbacks that are already received, without blocking.
+
+        Args:
+            max_outstanding: If given, blocks until at most this many readbacks are outstanding.
+                Readbacks missing for readback_timeout are reported in readback_timeouts and no longer waited for.
+
+        Returns:
+            n: Number of readbacks read.
+        """
+        n = 0
+        self.reader.receiveAvailable()
+        while self.reader.frameAvailable():
+            self._commonReadBack(None)
+            n += 1
+            if not self.reader.frameAvailable():
+                self.reader.receiveAvailable()
+        if max_outstanding is not None:
+            while len(self.not_readback) > max_outstanding:
+                n += self._waitReadBack()
+        return n
+
+    def _waitReadBack(self, expected_data_length: int=None) -> bool:
+        """
+        Reads one readback. On socket timeout, expires outstanding readbacks older than readback_timeout instead.
+
+        Returns:
+            received: False on socket timeout.
+        """
+        try:
+            self._commonReadBack(expected_data_length)
+            return True
+        except socket.timeout:
+            self.expireReadBacks()
+            return False
+
+    def invalidateShadow(self, space: str=None) -> None:
+        """
+        Forgets shadow register values, so applyConfiguration writes them again.
+
+        Args:
+            space: 'sys' or 'spi'. All if None.
+        """
+        # Readbacks of requests sent before now are no longer stored, see _shadowReadBack
+        self.shadow_epoch += 1
+        for invalidated_space in self._invalidated_epoch:
+            if space is None or invalidated_space == space:
+                self._invalidated_epoch[invalidated_space] = self.shadow_epoch
+        if space is None:
+            self.shadow.clear()
+        else:
+            self.shadow = {key: value for key, value in self.shadow.items() if key[0] != space}
+
+    def _getShadowKey(self, space: str, reg_addr: hex, asic_id: int=None) -> tuple:
+        """
+        Key of a register in shadow: ('sys', address) or ('spi', asic_id, address).
+
+        Args:
+            asic_id: ASIC of an 'spi' register. The current asic_id if None.
+        """
+        if space == 'spi':
+            return space, self.asic_id[0] if asic_id is None else asic_id, reg_addr
+        return space, reg_addr
+
+    def _shadowWrite(self, space: str, reg_addr: hex, asic_id: int=None) -> None:
+        """Forgets the shadow value of a register being written, until its readback confirms it."""
+        self.shadow.pop(self._getShadowKey(space, reg_addr, asic_id), None)
+        if space == 'sys' and reg_addr in self.reset_registers:
+            self.invalidateShadow('spi')
+
+    def _shadowReadBack(self, space: str, reg_addr: hex, value: hex, epoch: int=None, asic_id: int=None) -> None:
+        """
+        Stores a value confirmed by readback.
+
+        Args:
+            epoch: shadow_epoch when the request was sent. Readbacks of requests sent before
+                the space was last invalidated, e.g. by a reset register, are not stored.
+            asic_id: See _getShadowKey.
+        """
+        if (space, reg_addr) in self.pulse_registers or (space == 'sys' and reg_addr in self.reset_registers):
+            return
+        if epoch is not None and epoch < self._invalidated_epoch[space]:
+            return
+        self.shadow[self._getShadowKey(space, reg_addr, asic_id)] = value
+
+    def applyConfiguration(self, configuration: dict, window: int=50) -> list:
+        """
+        Writes the registers of configuration that differ from the shadow register cache, in one batch.
+
+        The shadow cache holds the last value confirmed by readback of each register, from writes and reads.
+        ASIC SPI registers are cached per asic_id, and written to the current asic_id.
+        Pulse registers and reset registers are always written, and writing a reset register
+        forgets all ASIC SPI register values. Use invalidateShadow after e.g. power cycling the board.
+
+        Example:
+            tcp.pulse_registers.add(('spi', 0x0027))
+            configuration = {
+                ('sys', 0xFFA0): (1, 1),            # value, len_reg_data
+                ('spi', 0xFA00): (5, 1, 8),         # value, reg_length, asic_bit_length
+            }
+            tcp.applyConfiguration(configuration)
+
+        Args:
+            configuration: Ordered dict of (space, reg_addr): register, space is 'sys' or 'spi'.
+            window: See batch().
+
+        Returns:
+            wrongly_programmed: See checkReadBack.
+        """
+        with self.batch(window) as batch:
+            for (space, reg_addr), register in configuration.items():
+                value = register[0]
+                if ((space, reg_addr) not in self.pulse_registers
+                        and self.shadow.get(self._getShadowKey(space, reg_addr)) == value):
+                    self.elided_writes += 1
+                    continue
+                if space == 'sys':
+                    self.writeSysReg(reg_addr, value, register[1])
+                elif space == 'spi':
+                    self.writeAsicSpiReg(reg_addr, register[1], register[2], value)
+                else:
+                    assert False, f"register space should be 'sys' or 'spi', not {space}"
+        return batch.wrongly_programmed
 
     def socketClose(self) -> None:
         """Closes TCP socket."""
         self.tcp_s.close()
 
+    def batch(self, window: int=50) -> 'PacketBatch':
+        """
+        Collects all packets written inside a with-block, and sends them together when the block ends.
+
+        Example:
+            with tcp.batch() as batch:
+                tcp.writeSysReg(0xFFA0, 1, 1)
+                tcp.writeAsicSpiReg(0xFA00, 1, 8, 5)
+            print(batch.wrongly_programmed)
+
+        Args:
+            window: Maximum number of packets sent before their readbacks are received.
+        """
+        return PacketBatch(self, window)
+
+    def writeAsicSpiRegs(self, registers: list, window: int=50) -> list:
+        """
+        Writes many ASIC SPI registers in one batch, see batch().
+
+        Args:
+            registers: List of (reg_addr, reg_length, asic_bit_length, write_data), see writeAsicSpiReg.
+
+        Returns:
+            wrongly_programmed: See checkReadBack.
+        """
+        with self.batch(window) as batch:
+            for reg_addr, reg_length, asic_bit_length, write_data in registers:
+                self.writeAsicSpiReg(reg_addr, reg_length, asic_bit_length, write_data)
+        return batch.wrongly_programmed
+
+    def writeSysRegs(self, registers: list, window: int=50) -> list:
+        """
+        Writes many system registers in one batch, see batch().
+
+        Args:
+            registers: List of (reg_addr, value, len_reg_data), see writeSysReg.
+
+        Returns:
+            wrongly_programmed: See checkReadBack.
+        """
+        with self.batch(window) as batch:
+            for reg_addr, value, len_reg_data in registers:
+                self.writeSysReg(reg_addr, value, len_reg_data)
+        return batch.wrongly_programmed
+
+    def _sendPacket(self, write_packet: bytes, readback_length: int=None, reg_addr: hex=None, value: hex=None) -> None:
+        """
+        Sends packet, or adds it to the active batch. The readback is expected with the current packet_count.
+
+        Args:
+            readback_length: Expected length of the readback packet, None if unknown.
+            reg_addr: Register address, reported if the readback is wrong or missing.
+            value: Expected readback value. None if not verified, e.g. for reads.
+        """
+        if self._batch is not None:
+            self._batch.add(write_packet, readback_length, (reg_addr, value), self.shadow_epoch)
+            return
+        send_time = time.monotonic()
+        self._expectReadBack(self.packet_count, (readback_length, (reg_addr, value), send_time, self.shadow_epoch))
+        self.tcp_s.sendall(write_packet)
+        if self._last_send_time is not None:
+            self.send_interval += 0.1*(send_time - self._last_send_time - self.send_interval)
+        self._last_send_time = send_time
+        if self.auto_readback:
+            self.drainReadBacks()
+            window = self.getReadBackWindow()
+            if len(self.not_readback) >= window:
+                self.drainReadBacks(max_outstanding=window - 1)
+
+    def _expectReadBack(self, packet_count: int, request: tuple) -> None:
+        """
+        Adds a sent request to not_readback.
+
+        An outstanding request with the same packet count, or the oldest beyond max_not_readback, is reported as timeout.
+        """
+        if packet_count in self.not_readback:
+            # Packet count wrapped around before the old readback arrived
+            self._reportTimeout(packet_count, self.not_readback.pop(packet_count))
+        elif len(self.not_readback) >= self.max_not_readback:
+            oldest = next(iter(self.not_readback))
+            self._reportTimeout(oldest, self.not_readback.pop(oldest))
+        self.not_readback[packet_count] = request
+
     def checkReadBack(self) -> list:
         """
-        Compares write dictionary (not_readback) with read back dictionary (now_readback). 
-        
+        Reports readbacks verified since the last call.
+
+        Each readback is matched to its request by packet count when it arrives (see _matchReadBack).
+        Outstanding requests older than readback_timeout are reported as timeouts.
+
         Returns:
-            wrongly_programmed: Addresses. Note: The address may be a pulse register!
-        """
-        wrongly_programmed = []
-        not_readback_addr_val = [a[1] for a in self.not_readback.values()]
-        if len(self.now_readback) == len(not_readback_addr_val):
-            if self.now_readback == not_readback_addr_val:
-                if self.doPrint:
-                    print(f'Readback is as expected!')
-            else:
-                for i, j in zip(self.now_readback, not_readback_addr_val):
-                    if i != j:
-                        wrongly_programmed.append(j[0])
-                        if self.doPrint:
-                            print(f'ERROR: Readback is wrong!: {j[0]}')
+            wrongly_programmed: Addresses with wrong readback, then addresses without readback.
+                Note: The address may be a pulse register!
+        """
+        self.expireReadBacks()
+        wrongly_programmed = self.wrongly_programmed + self.readback_timeouts
         if self.doPrint:
-            print(f'Clearing now_readback and not_readback.')
+            if not wrongly_programmed and not self.readback_timeouts:
+                print(f'Readback is as expected!')
+            if self.readback_timeouts:
+                print(f'ERROR: No readback from: {self.readback_timeouts}')
+            print(f'Clearing now_readback. {len(self.not_readback)} readbacks outstanding.')
         self.now_readback = []
-        self.not_readback = {}
-        wrongly_programmed = [hex(val) for val in wrongly_programmed]
+        self.wrongly_programmed = []
+        self.readback_timeouts = []
         return wrongly_programmed
+
+    def expireReadBacks(self, timeout: float=None) -> None:
+        """
+        Reports outstanding readbacks older than timeout (default readback_timeout), oldest first.
+        """
+        if timeout is None:
+            timeout = self.readback_timeout
+        deadline = time.monotonic() - timeout
+        while self.not_readback:
+            packet_count = next(iter(self.not_readback))
+            if self.not_readback[packet_count][2] > deadline:
+                break
+            self._reportTimeout(packet_count, self.not_readback.pop(packet_count))
+
+    def _reportTimeout(self, packet_count: int, request: tuple) -> None:
+        _, (reg_addr, _), _, _ = request
+        if reg_addr is not None:
+            self.readback_timeouts.append(hex(reg_addr))
+        if self.doPrint:
+            print(f'ERROR: No readback for packet count {packet_count}, address {reg_addr}')
+
+    def _matchReadBack(self, packet_count: int, reg_addr: int, value: int) -> bool:
+        """
+        Matches a received readback to its request in not_readback, and reports a wrong value.
+
+        Returns:
+            matched: True if the readback has a request and is as expected.
+        """
+        request = self.not_readback.pop(packet_count, None)
+        if request is None:
+            self.unexpected_readback.append(packet_count)
+            if self.doPrint:
+                print(f'ERROR: Readback without request, packet count {packet_count}')
+            return False
+        _, (expected_addr, expected_value), send_time, _ = request
+        self.readback_rtt += 0.1*(time.monotonic() - send_time - self.readback_rtt)
+        if expected_value is not None and (reg_addr, value) != (expected_addr, expected_value):
+            self.wrongly_programmed.append(hex(expected_addr))
+            if self.doPrint:
+                print(f'ERROR: Readback is wrong!: {expected_addr}')
+            return False
+        return True
     
-    def finishReadBack(self, len_reg_data: int) -> list:
+    def finishReadBack(self, len_reg_data: int=None) -> list:
         """
         Reads back packages not currently read back.
 
-        To be used after 'fast readout' (auto_readback[0]=True).
+        To be used after 'fast readout' (auto_readback=True). Readbacks missing for readback_timeout
+        are reported in readback_timeouts, see checkReadBack.
         """
-        to_be_read_back = len([a[1] for a in self.not_readback.values()]) - len(self.now_readback)
-        for _ in range(to_be_read_back):
-            self.getAsicSpiReadBack(len_reg_data)
-        self.auto_readback = [False, 50]                # Resets auto_readback
+        while self.not_readback:
+            self._waitReadBack()
+        self.auto_readback = False                      # Resets auto_readback
 
 
     def _packetCountIncrement(self) -> None:
         """Updates packet_count by 1."""
-        self.packet_count = '{0:014b}'.format(int(self.packet_count, 2) + 1)[-14:]
+        self.packet_count = (self.packet_count + 1) & 0x3FFF
+
+    def _getPacketHeaderFields(self, packet_type: hex) -> tuple:
+        """Packet ID and Packet Sequence fields of the header, see getPacketHeaderFields."""
+        return getPacketHeaderFields(self, packet_type)
 
     def _getPacketHeader(self, packet_type: hex, len_reg_data: hex) -> bytes:
         """
@@ -173,32 +518,41 @@ class TCPhandler:
             packet_type: Defines how the packet data field should be decoded.
             len_reg_data: Number of bytes proceeding header.
         """
-        packet_type_bin = '{0:08b}'.format(packet_type)
-        data_length_bin = '{0:016b}'.format(len_reg_data)
-        packet_header = self.version + self.system_number + packet_type_bin + self.sequence_flag + self.packet_count + self.reserved + data_length_bin
-        packet_header_10 = int(packet_header, 2).to_bytes(10, 'big')
-        expected_packet_length = 3+5+8+2+14+32+16
-        if len(packet_header) != expected_packet_length:
-            # TODO Raise error
-            print(f"Packet header size isn't of correct size... Now length was {len(packet_header)}, but it should be {expected_packet_length}.")
-        return packet_header_10
+        packet_id, packet_sequence = self._getPacketHeaderFields(packet_type)
+        return PACKET_HEADER.pack(packet_id, packet_sequence, self.reserved, len_reg_data)
+
+    def _packPacketHeader(self, buffer, offset: int, packet_type: hex, len_reg_data: hex) -> None:
+        """
+        Writes packet header in place, into buffer at offset. See _getPacketHeader.
+
+        Args:
+            buffer: Writable buffer, e.g. bytearray, of at least offset + 10 bytes.
+        """
+        packet_id, packet_sequence = self._getPacketHeaderFields(packet_type)
+        PACKET_HEADER.pack_into(buffer, offset, packet_id, packet_sequence, self.reserved, len_reg_data)
 
     def _commonReadBack(self, expected_data_length: int) -> bytes:
         """
         Internal function called by getSystemReadBack and getASICSPIReadBack. 
-        """
-        data = self.spare_bytes
-        while len(data) < expected_data_length:
-            data += self.tcp_s.recv(1)
-        spare_bytes_length = len(data) - expected_data_length
-        self.spare_bytes = data[-spare_bytes_length:] if spare_bytes_length != 0 else b''
-        return_data = data[:-spare_bytes_length or None]
-        if self.doPrint:
-            self.doPrinter.data_bytes = return_data     # If no spare: Full array is used.
-            print(self.doPrinter)
-        if return_data[1] == 18: self.now_readback.append((int.from_bytes(return_data[10:12], byteorder='big'), int.from_bytes(return_data[13:], byteorder='big')))
-        elif return_data[1] == 196: self.now_readback.append((int.from_bytes(return_data[12:14], byteorder='big'), int.from_bytes(return_data[16:], byteorder='big')))
-        else: print(f'Unknown readback..')
+
+        Reads one packet, framed by the Data Length field of its header.
+        Length is not checked if expected_data_length is None.
+        """
+        return_data = self.reader.readFrame()
+        if self.doPrint and expected_data_length is not None and len(return_data) != expected_data_length:
+            print(f'Readback length is {len(return_data)}, expected {expected_data_length}.')
+        if self.doPrint or self.trace is not None:
+            self._tracePacket(return_data)
+        packet_count, reg_addr, value = parseReadBack(return_data)
+        if packet_count is None:
+            print(f'Unknown readback..')
+            return return_data
+        self.now_readback.append((reg_addr, value))
+        request = self.not_readback.get(packet_count)
+        if self._matchReadBack(packet_count, reg_addr, value) and return_data[1] in SHADOW_SPACE:
+            space = SHADOW_SPACE[return_data[1]]
+            asic_id = return_data[10] if space == 'spi' else None
+            self._shadowReadBack(space, reg_addr, value, request[3], asic_id)
         return return_data
 
     def writeSysReg(self, reg_addr: hex, value: hex, len_reg_data: hex) -> bool:
@@ -221,11 +575,10 @@ class TCPhandler:
         data_bytes = value.to_bytes(len_reg_data, 'big')
         data_field = reg_addr_bytes + reg_length_bytes + data_bytes
         write_packet = packet_header_array + data_field
-        self.tcp_s.sendall(write_packet)
-        if self.doPrint:
-            self.doPrinter.data_bytes = write_packet
-            print(self.doPrinter)
-        self.not_readback[self.packet_count] = ((self._0x12_METADATA_LENGTH, len_reg_data), (reg_addr, value))
+        self._shadowWrite('sys', reg_addr)
+        self._sendPacket(write_packet, self._0x12_METADATA_LENGTH + len_reg_data, reg_addr, value)
+        if self.doPrint or self.trace is not None:
+            self._tracePacket(write_packet)
         self._packetCountIncrement()    
 
     def readSysReg(self, reg_addr: hex) -> None:
@@ -240,11 +593,9 @@ class TCPhandler:
         packet_header = self._getPacketHeader(PACKET_TYPE, DATA_LENGTH)
         reg_addr_bytes = reg_addr.to_bytes(2, 'big')
         write_packet = packet_header + reg_addr_bytes
-        self.tcp_s.sendall(write_packet)
-        if self.doPrint:
-            self.doPrinter.data_bytes = write_packet
-            print(self.doPrinter)
-        self.not_readback[self.packet_count] = ((self._0x12_METADATA_LENGTH, ...), (reg_addr, None))        # TODO: To be reviewed
+        self._sendPacket(write_packet, None, reg_addr)
+        if self.doPrint or self.trace is not None:
+            self._tracePacket(write_packet)
         self._packetCountIncrement()
 
     def getSysReadBack(self, len_reg_data: int) -> bytes:
@@ -272,10 +623,9 @@ class TCPhandler:
         conf_bit_len = (conf_len*8-(8-conf_len%8)).to_bytes(2, 'big')
         data_packet = self.asic_id + conf_bit_len + configuration_data
         write_packet = packet_header + data_packet
-        self.tcp_s.sendall(write_packet)
-        if self.doPrint:
-            self.doPrinter.data_bytes = write_packet
-            print(self.doPrinter)
+        self._sendPacket(write_packet, 10 + 1 + 2 + conf_len)
+        if self.doPrint or self.trace is not None:
+            self._tracePacket(write_packet)
         self._packetCountIncrement()
 
     def getShiftRegReadBack(self, len_reg_data: int) -> bytes:
@@ -304,21 +654,13 @@ class TCPhandler:
         packet_header = self._getPacketHeader(PACKET_TYPE, len_reg_data)
         reg_addr_bytes = reg_addr.to_bytes(2, 'big')
         asic_bit_length_bytes = asic_bit_length.to_bytes(2, 'big')
-        data_bytes = write_data.to_bytes(1, 'big')            # TODO: Not constant
+        data_bytes = write_data.to_bytes(reg_length, 'big')
         data_packet = self.asic_id + self.spi_format + reg_addr_bytes + asic_bit_length_bytes + data_bytes
         write_packet = packet_header + data_packet
-        if self.doPrint:
-            self.doPrinter.data_bytes = write_packet
-            print(self.doPrinter)
-        self.tcp_s.sendall(write_packet)
-        self.not_readback[self.packet_count] = ((self._0xC4_METADATA_LENGTH, reg_length), (reg_addr, write_data))
-        if self.auto_readback[0]:
-            self.auto_readback[1] -= 1
-            if self.auto_readback[1] == 0:
-                self.to_be_read_back = 50
-                for _ in range(50):
-                    self.getAsicSpiReadBack(reg_length)
-                self.auto_readback[1] = 50
+        if self.doPrint or self.trace is not None:
+            self._tracePacket(write_packet)
+        self._shadowWrite('spi', reg_addr)
+        self._sendPacket(write_packet, self._0xC4_METADATA_LENGTH + reg_length, reg_addr, write_data)
         self._packetCountIncrement()
 
     def readAsicSpiReg(self, reg_addr: hex, reg_bit_length: int) -> None:
@@ -336,10 +678,9 @@ class TCPhandler:
         reg_bit_length = reg_bit_length.to_bytes(2, 'big')
         data_packet = self.asic_id + self.spi_format + reg_addr_bytes + reg_bit_length
         write_packet = packet_header + data_packet
-        self.tcp_s.sendall(write_packet)
-        if self.doPrint:
-            self.doPrinter.data_bytes = write_packet
-            print(self.doPrinter)
+        self._sendPacket(write_packet, None, reg_addr)
+        if self.doPrint or self.trace is not None:
+            self._tracePacket(write_packet)
         self._packetCountIncrement()
 
     def getAsicSpiReadBack(self, len_reg_data) -> bytes:
@@ -354,6 +695,193 @@ class TCPhandler:
         return data
 
 
+class PacketBatch:
+    """
+    Packets collected by TCPhandler.batch(), encoded into one contiguous buffer.
+
+    On send, packets are sent with a sliding window: at most window packets are outstanding, and
+    when half of them are read back the next packets are sent with one sendall.
+    Readbacks are verified with TCPhandler.checkReadBack. Packets are added to TCPhandler.not_readback
+    when they are sent. If the with-block raises, nothing is sent and the packet counts of the batch are reused.
+    """
+    def __init__(self, tcp: TCPhandler, window: int=50):
+        self.tcp = tcp
+        self.window = window
+        self.buffer = bytearray()
+        self.packet_ends = []                   # End of each packet in buffer
+        self.requests = []                      # (readback length, (address, value), shadow epoch) per packet
+        self.packet_counts = []                 # Packet count of each packet
+        self.first_packet_count = None          # TCPhandler.packet_count when the batch was entered
+        self.wrongly_programmed = []
+
+    def __enter__(self) -> 'PacketBatch':
+        assert (self.tcp._batch is None), f"batches can not be nested"
+        self.tcp._batch = self
+        self.first_packet_count = self.tcp.packet_count
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.tcp._batch = None
+        if exc_type is None:
+            self.send()
+        else:
+            self.discard()
+
+    def discard(self) -> None:
+        """Forgets the unsent packets and rewinds the packet count."""
+        self.tcp.packet_count = self.first_packet_count
+        self.buffer = bytearray()
+        self.packet_ends = []
+        self.requests = []
+        self.packet_counts = []
+
+    def __len__(self) -> int:
+        return len(self.packet_ends)
+
+    def add(self, write_packet: bytes, readback_length: int=None, register: tuple=(None, None), epoch: int=0) -> None:
+        """
+        Appends packet to the batch, with the current packet count.
+
+        Args:
+            register: (address, value) expected in the readback, see TCPhandler._sendPacket.
+            epoch: TCPhandler.shadow_epoch when the packet was written.
+        """
+        self.buffer += write_packet
+        self.packet_ends.append(len(self.buffer))
+        self.requests.append((readback_length, register, epoch))
+        self.packet_counts.append(self.tcp.packet_count)
+
+    def send(self) -> list:
+        """
+        Sends all packets and receives all readbacks.
+
+        Returns:
+            wrongly_programmed: See TCPhandler.checkReadBack.
+        """
+        tcp = self.tcp
+        view = memoryview(self.buffer)
+        n_packets = len(self.packet_ends)
+        window = min(self.window or n_packets, tcp.max_not_readback)
+        n_sent = 0
+        n_done = 0                                      # Packets before this are matched or expired
+        try:
+            while n_done < n_packets:
+                if n_sent < n_packets and n_sent - n_done <= window//2:
+                    last = min(n_done + window, n_packets)
+                    send_time = time.monotonic()
+                    for i in range(n_sent, last):
+                        readback_length, register, epoch = self.requests[i]
+                        tcp._expectReadBack(self.packet_counts[i], (readback_length, register, send_time, epoch))
+                    start_byte = self.packet_ends[n_sent - 1] if n_sent else 0
+                    tcp.tcp_s.sendall(view[start_byte:self.packet_ends[last - 1]])
+                    n_sent = last
+                else:
+                    tcp._waitReadBack(self.requests[n_done][0])
+                while n_done < n_sent and self.packet_counts[n_done] not in tcp.not_readback:
+                    n_done += 1
+        finally:
+            view.release()
+        self.wrongly_programmed = self.tcp.checkReadBack()
+        return self.wrongly_programmed
+
+
+class FramedReader:
+    """
+    Buffered reader of Doppio packets from a TCP socket.
+
+    Receives in large recv_into calls into a reusable buffer, and splits packets on the Data Length
+    field of the 10 byte header. Bytes of following packets stay in the buffer for the next read.
+    """
+    HEADER_LENGTH = 10
+
+    def __init__(self, tcp_s: socket.socket, buffer_size: int=65536):
+        self.tcp_s = tcp_s
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0                      # First unread byte
+        self.end = 0                        # End of received bytes
+
+    def pending(self) -> int:
+        """Number of received bytes not yet read."""
+        return self.end - self.start
+
+    def _fill(self, length: int) -> None:
+        """Receives until at least length unread bytes are buffered."""
+        if self.start + length > len(self.buffer):
+            # Move unread bytes to the front, and grow for packets larger than the buffer
+            unread = self.end - self.start
+            if length > len(self.buffer):
+                buffer = bytearray(max(length, 2*len(self.buffer)))
+                buffer[:unread] = self.view[self.start:self.end]
+                self.view.release()
+                self.buffer = buffer
+                self.view = memoryview(self.buffer)
+            else:
+                self.view[:unread] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = unread
+        while self.end - self.start < length:
+            n_bytes = self.tcp_s.recv_into(self.view[self.end:])
+            if n_bytes == 0:
+                raise ConnectionError('TCP connection closed by Doppio.')
+            self.end += n_bytes
+
+    def frameAvailable(self) -> bool:
+        """True if a complete packet is buffered, i.e. readFrame will not block."""
+        unread = self.end - self.start
+        if unread < self.HEADER_LENGTH:
+            return False
+        data_length = (self.buffer[self.start + 8] << 8) | self.buffer[self.start + 9]
+        return unread >= self.HEADER_LENGTH + data_length
+
+    def receiveAvailable(self) -> int:
+        """Receives bytes already waiting in the socket, without blocking. Returns number of bytes."""
+        readable, _, _ = select.select([self.tcp_s], [], [], 0)
+        if not readable:
+            return 0
+        if self.end == len(self.buffer):
+            if self.start == 0:
+                return 0                    # Buffer full of unread bytes, readFrame first
+            unread = self.end - self.start
+            self.view[:unread] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = unread
+        n_bytes = self.tcp_s.recv_into(self.view[self.end:])
+        if n_bytes == 0:
+            raise ConnectionError('TCP connection closed by Doppio.')
+        self.end += n_bytes
+        return n_bytes
+
+    def readInto(self, view: memoryview) -> int:
+        """Reads up to len(view) bytes into view, buffered bytes first. Blocks until at least one byte is read."""
+        unread = self.end - self.start
+        if unread > 0:
+            n_bytes = min(unread, len(view))
+            view[:n_bytes] = self.view[self.start:self.start + n_bytes]
+            self.start += n_bytes
+            if self.start == self.end:
+                self.start = 0
+                self.end = 0
+            return n_bytes
+        n_bytes = self.tcp_s.recv_into(view)
+        if n_bytes == 0:
+            raise ConnectionError('TCP connection closed by Doppio.')
+        return n_bytes
+
+    def readFrame(self) -> bytes:
+        """Returns the next complete packet, header included."""
+        self._fill(self.HEADER_LENGTH)
+        data_length = (self.buffer[self.start + 8] << 8) | self.buffer[self.start + 9]
+        frame_length = self.HEADER_LENGTH + data_length
+        self._fill(frame_length)
+        frame = bytes(self.view[self.start:self.start + frame_length])
+        self.start += frame_length
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return frame
+
+
 class doPrinter:
     """
     Formats printing of TCPhandler object.
@@ -379,12 +907,12 @@ class doPrinter:
     def __str__(self) -> str:
         """Prints according to selected doPrintFormat."""
         doPrintFunctions = {
-            # Key: doPrintFormat
-            1: self.default_doPrintFormat(),
-            2: self.uint8_doPrintFormat(),
+            # Key: doPrintFormat. Only the selected format is called.
+            1: self.default_doPrintFormat,
+            2: self.uint8_doPrintFormat,
             3: ...                                  # Please add issue to github repo if you wish another print format.
         }
-        printString = doPrintFunctions[self.doPrintFormat]
+        printString = doPrintFunctions[self.doPrintFormat]()
         return printString
 
     def default_doPrintFormat(self) -> str:
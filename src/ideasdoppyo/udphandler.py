@@ -38,6 +38,14 @@ import numpy as np
 import socket
 import binascii
 from dataformats import common_header_format, pipeline_sampling_format
+from capturebuffer import CaptureBuffer, MAX_PACKET_SIZE
+from batchreceiver import BatchReceiver
+from capturering import CaptureRing, CaptureThread
+from sequencechecker import SequenceChecker
+from decoders import decode
+from runfile import RunWriter
+from histogram import SampleHistogram
+from decodepool import DecodePool
 
 class UDPhandler:
     """
@@ -67,12 +75,21 @@ class UDPhandler:
         self.mask_common_header = False # Only mask common header
 
         self.header_byte_length  = header_byte_length_dict[data_format]
+        self.max_packet_size = MAX_PACKET_SIZE
 
         udp_s = socket.socket(type=2)
         udp_s.bind((self.server_ip, self.port))
         udp_s.settimeout(None)
         self.udp_s = udp_s
 
+        self.batch_receiver = None      # Set by setBatchReceive
+        self.capture_thread = None      # Set by startCapture
+        self.capture_ring = None
+        self.sequence_checker = None    # Set by setSequenceCheck
+        self.run_writer = None          # Set by startRecording
+        self.histogram = None           # Set by setHistogram
+        self.decode_pool = None         # Set by startDecodePool
+
     def loadDataPacketFormat(self):
         ...
 
@@ -80,43 +97,237 @@ class UDPhandler:
         """Set timeout on udp."""
         self.udp_s.settimeout(timeout)
 
-    def receiveData(self) -> bytes:
+    def setBatchReceive(self, enable: bool, batch_size: int=64, use_recvmmsg: bool=True) -> None:
         """
-        Receives UDP packets.
+        Receive many packets per call in captureNpackets.
 
-        NOTE Only max 1024 bytes that is received.
+        Args:
+            enable: If False, captureNpackets receives one packet per call.
+            batch_size: Maximum number of packets per receive call.
+            use_recvmmsg: Use recvmmsg on Linux. Other platforms always fall back to a recv_into loop.
         """
-        data, _ = self.udp_s.recvfrom(1024)
-        return data
+        if enable:
+            self.batch_receiver = BatchReceiver(self.udp_s, batch_size, use_recvmmsg)
+        else:
+            self.batch_receiver = None
 
-    def collectNpackets(self, N: int) -> bytes:
+    def setSequenceCheck(self, enable: bool) -> None:
         """
-        Collects N data samples.
+        Check the common header Packet Sequence of packets from captureNpackets and startCapture.
 
-        Each packet must be less than 1024 bytes.
+        Gaps, duplicates and reorders are counted in sequence_checker, once per captured batch.
         """
-        data_bytes = b''
-        packet_counter = 0
+        if enable:
+            self.sequence_checker = SequenceChecker()
+        else:
+            self.sequence_checker = None
+
+    def setHistogram(self, histogram: SampleHistogram) -> None:
+        """
+        Accumulate the samples of packets from captureNpackets in histogram, see histogram.SampleHistogram.
+
+        For startCapture, update the histogram from capture_ring.batches() in the consumer instead.
+        None disables.
+        """
+        self.histogram = histogram
+
+    def receiveData(self) -> bytes:
+        """
+        Receives UDP packets.
 
+        NOTE Only max max_packet_size bytes that is received.
+        """
+        data, _ = self.udp_s.recvfrom(self.max_packet_size)
+        return data
+
+    def _getFilterIndex(self) -> int:
+        """Number of bytes masked at the start of each packet, set by mask_header and mask_common_header."""
         if self.mask_common_header:
             filter_index = 10
         elif self.mask_header:
             filter_index = self.header_byte_length + 10
         else:
             filter_index = 0
+        return filter_index
+
+    def collectNpackets(self, N: int) -> bytes:
+        """
+        Collects N data samples.
+
+        Each packet must be at most max_packet_size bytes.
+        """
+        data_packets = []
+        packet_counter = 0
+
+        filter_index = self._getFilterIndex()
 
         while packet_counter <= N:
             data_packet = self.receiveData()[filter_index:]
-            data_bytes += data_packet
+            data_packets.append(data_packet)
             packet_counter += 1
 
-        return data_bytes
+        return b''.join(data_packets)
+
+    def captureNpackets(self, N: int, capture: CaptureBuffer=None) -> CaptureBuffer:
+        """
+        Captures N packets into a preallocated buffer, without intermediate copies.
+
+        Header masking (mask_header, mask_common_header) is applied as an offset on the returned views.
+        Uses batched receive if enabled with setBatchReceive, checks sequence if enabled with setSequenceCheck,
+        records the packets if startRecording is called and histograms them if setHistogram is called.
+
+        Args:
+            N: Number of packets to capture.
+            capture: Buffer to reuse between captures. Allocated with N slots of max_packet_size if not given.
+
+        Returns:
+            capture: Use capture.payloads(), capture.packet(i) or capture.offsets to access data.
+        """
+        if capture is None:
+            capture = CaptureBuffer(N, self.max_packet_size)
+        assert (N <= capture.n_slots), f"capture buffer holds {capture.n_slots} packets, {N} requested"
+        capture.reset(skip=self._getFilterIndex())
+
+        if self.batch_receiver is not None:
+            while capture.n_packets < N:
+                capture.n_packets += self.batch_receiver.receiveInto(capture, capture.n_packets, N - capture.n_packets)
+        else:
+            recv_into = self.udp_s.recv_into
+            slot_views = capture.slot_views
+            lengths = capture.lengths
+            for i in range(N):
+                lengths[i] = recv_into(slot_views[i])
+                capture.n_packets = i + 1
+
+        if self.sequence_checker is not None:
+            self.sequence_checker.checkPackets(capture.data[:N])
+            if self.doPrint:
+                print(self.sequence_checker)
+        if self.run_writer is not None:
+            self.run_writer.writeCapture(capture)
+        if self.histogram is not None:
+            self.histogram.updateDecoded(self.data_format, self.decodeCapture(capture))
+        return capture
+
+    def decodeCapture(self, capture: CaptureBuffer) -> dict:
+        """Decodes captured packets with the decoder for data_format. See decoders.decode."""
+        return decode(self.data_format, capture)
+
+    def startCapture(self, n_slots: int=4096, batch_size: int=64, ring: CaptureRing=None) -> CaptureRing:
+        """
+        Starts a background thread receiving packets into a ring of n_slots packet slots.
+
+        Consume with capture_ring.packets() or capture_ring.batches(). Header masking is applied
+        as set when the capture starts. Check capture_ring.high_water and capture_ring.overruns
+        to size the ring.
+
+        Args:
+            n_slots: Number of packet slots in the ring.
+            batch_size: Maximum packets per receive call, if setBatchReceive is not enabled.
+            ring: Ring to capture into, e.g. from DecodePool.createRing. Allocated with n_slots if None.
+
+        Returns:
+            capture_ring: Ring filled by the capture thread.
+        """
+        assert (self.capture_thread is None), f"capture is already running, call stopCapture first"
+        if ring is None:
+            ring = CaptureRing(n_slots, self.max_packet_size, skip=self._getFilterIndex())
+        batch_receiver = self.batch_receiver or BatchReceiver(self.udp_s, batch_size)
+        self.capture_thread = CaptureThread(ring, batch_receiver, self.sequence_checker, self.run_writer)
+        self.capture_ring = ring
+        self.capture_thread.start()
+        return ring
+
+    def stopCapture(self) -> None:
+        """
+        Stops the background capture thread. Packets already in capture_ring can still be consumed.
+
+        Raises the exception that stopped the capture thread early, also available as capture_ring.error.
+        """
+        if self.capture_thread is None:
+            return
+        capture_thread = self.capture_thread
+        capture_thread.stopCapture()
+        self.capture_thread = None
+        if self.doPrint:
+            ring = self.capture_ring
+            print(f'Capture stopped: {ring.packets_received} packets, high water {ring.high_water}/{ring.n_slots}, {ring.overruns} overruns.')
+            if self.sequence_checker is not None:
+                print(self.sequence_checker)
+            if capture_thread.error is not None:
+                print(f'Capture failed: {capture_thread.error!r}')
+        if capture_thread.error is not None:
+            raise capture_thread.error
+
+    def startDecodePool(self, reduce, n_workers: int=None, n_slots: int=4096, batch_size: int=64,
+                        max_batch: int=256) -> DecodePool:
+        """
+        Starts capture into shared memory, decoded by worker processes. See decodepool.DecodePool.
+
+        Consume with decode_pool.results(). Sequence check and recording apply as for startCapture.
+
+        Args:
+            reduce: Picklable function of the decoded batch, returning a small result.
+            n_workers: Number of worker processes, default number of CPUs.
+            max_batch: Maximum packets per worker task.
+        """
+        pool = DecodePool(self.data_format, reduce, n_workers, n_slots, self.max_packet_size, max_batch)
+        ring = self.startCapture(n_slots, batch_size, ring=pool.createRing(self._getFilterIndex()))
+        pool.attach(ring)
+        self.decode_pool = pool
+        return pool
+
+    def stopDecodePool(self) -> None:
+        """Stops the capture and the worker processes."""
+        if self.decode_pool is None:
+            return
+        try:
+            self.stopCapture()
+        finally:
+            self.capture_ring = None
+            self.decode_pool.close()
+            self.decode_pool = None
+
+    def startRecording(self, base_path: str, max_file_bytes: int=None, max_file_seconds: float=None) -> RunWriter:
+        """
+        Records all packets from captureNpackets and startCapture to run files, see runfile.RunWriter.
+
+        Call before startCapture. The capture thread records every received packet, also when the ring overruns.
+
+        Args:
+            base_path: Path and name of run, files are <base_path>_<segment>.dat/.idx.
+            max_file_bytes: Start a new segment after this many bytes.
+            max_file_seconds: Start a new segment after this many seconds.
+        """
+        assert (self.capture_thread is None), f"call startRecording before startCapture"
+        self.stopRecording()
+        self.run_writer = RunWriter(base_path, self.data_format, max_file_bytes, max_file_seconds)
+        return self.run_writer
+
+    def stopRecording(self) -> None:
+        """Writes remaining packets and closes the run files. Call after stopCapture."""
+        if self.run_writer is None:
+            return
+        assert (self.capture_thread is None), f"call stopCapture before stopRecording"
+        self.run_writer.close()
+        if self.doPrint:
+            print(f'Recorded {self.run_writer.n_packets} packets in {self.run_writer.segment + 1} segments.')
+        self.run_writer = None
 
     def data2csv(self, data_array: np.ndarray, filename: str) -> None:
-        """Store captured data to a csv-file."""
+        """
+        Store captured data to a csv-file.
+
+        NOTE Text output is slow and large. Use startRecording to store runs.
+        """
         data_array.tofile(filename, sep=';')
 
     def socketClose(self) -> None:
         """Closes UDP connection."""
-        self.udp_s.shutdown(socket.SHUT_RDWR)
-        self.udp_s.close()
+        try:
+            self.stopDecodePool()
+            self.stopCapture()
+        finally:
+            self.stopRecording()
+            self.udp_s.shutdown(socket.SHUT_RDWR)
+            self.udp_s.close()
@@ -0,0 +1,96 @@
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Tests of TCPhandler readback flow control against emulator.DoppioEmulator.
+
+Run: python -m pytest tests
+"""
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo'))
+
+import pytest
+from emulator import DoppioEmulator
+from tcphandler import TCPhandler
+
+READBACK_TIMEOUT = 0.2
+
+
+@pytest.fixture
+def board():
+    with DoppioEmulator() as board:
+        yield board
+
+
+def connect(board: DoppioEmulator) -> TCPhandler:
+    tcp = TCPhandler(*board.tcp_address)
+    tcp.doPrint = False
+    tcp.readback_timeout = READBACK_TIMEOUT
+    tcp.tcp_s.settimeout(READBACK_TIMEOUT)
+    return tcp
+
+
+def test_dropped_readback_auto_readback(board):
+    tcp = connect(board)
+    board.drop_readbacks.add(3)
+    tcp.setAutoReadBack(True, window=3)
+    for reg_addr in range(10):
+        tcp.writeSysReg(0x0F00 + reg_addr, reg_addr, 1)
+    tcp.finishReadBack()
+    assert not tcp.not_readback
+    assert tcp.readback_timeouts == [hex(0x0F03)]
+    assert board.n_requests == 10
+
+
+def test_batch_larger_than_max_not_readback(board):
+    tcp = connect(board)
+    registers = [(reg_addr, 1, 8, reg_addr & 0xFF) for reg_addr in range(tcp.max_not_readback + 904)]
+    assert tcp.writeAsicSpiRegs(registers, window=None) == []
+    assert tcp.unexpected_readback == []
+    assert not tcp.not_readback
+    assert board.n_requests == len(registers)
+
+
+def test_batch_reports_dropped_readback(board):
+    tcp = connect(board)
+    board.drop_readbacks.add(5)
+    assert tcp.writeSysRegs([(0x0F00 + reg_addr, reg_addr, 1) for reg_addr in range(20)], window=4) == [hex(0x0F05)]
+    assert not tcp.not_readback
+
+
+def test_batch_reads_until_own_readbacks(board):
+    tcp = connect(board)
+    tcp.setAutoReadBack(True, window=50)
+    for reg_addr in range(5):
+        tcp.writeSysReg(0x0F00 + reg_addr, reg_addr, 1)
+    # Readbacks of the writes above are still outstanding when the batch starts
+    assert tcp.writeSysRegs([(0x0F10 + reg_addr, reg_addr, 1) for reg_addr in range(10)]) == []
+    assert not tcp.not_readback
+    assert tcp.reader.pending() == 0
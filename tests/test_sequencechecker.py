@@ -0,0 +1,92 @@
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Tests of SequenceChecker loss, duplicate and reorder classification.
+
+Run: python -m pytest tests
+"""
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo'))
+
+import numpy as np
+from sequencechecker import SequenceChecker, SEQUENCE_OFFSET
+
+
+def checkCounts(sequence, lost, duplicates, reorders, gaps=0):
+    checker = SequenceChecker()
+    checker.check(sequence)
+    assert (checker.lost, checker.duplicates, checker.reorders, checker.gaps) == (lost, duplicates, reorders, gaps)
+    return checker
+
+
+def test_in_order():
+    checkCounts([1, 2, 3], lost=0, duplicates=0, reorders=0)
+
+
+def test_stale_repeat_is_duplicate():
+    checkCounts([1, 2, 3, 2], lost=0, duplicates=1, reorders=0)
+
+
+def test_repeated_run_is_duplicate():
+    checkCounts([1, 2, 3, 1, 2, 3], lost=0, duplicates=3, reorders=0)
+
+
+def test_late_packet_fills_gap_once():
+    checkCounts([1, 3, 2, 2], lost=0, duplicates=1, reorders=1, gaps=1)
+
+
+def test_gap_lost():
+    checkCounts([1, 2, 5, 6], lost=2, duplicates=0, reorders=0, gaps=1)
+
+
+def test_late_packet_in_later_batch():
+    checker = SequenceChecker()
+    checker.check([1, 4])
+    report = checker.check([2, 2, 3, 5])
+    assert list(report['reorders']) == [2, 4]
+    assert list(report['duplicates']) == [3]
+    assert checker.lost == 0
+
+
+def test_late_packet_across_wraparound():
+    checker = SequenceChecker()
+    checker.check([65534, 65535, 1])
+    checker.check([0, 0])
+    assert (checker.lost, checker.duplicates, checker.reorders) == (0, 1, 1)
+
+
+def test_packets():
+    sequence = np.arange(4, dtype=np.uint16)[[0, 2, 1, 1, 3]]
+    data = np.zeros((5, 16), dtype=np.uint8)
+    data[:, SEQUENCE_OFFSET:SEQUENCE_OFFSET + 2] = sequence.astype('>u2').view(np.uint8).reshape(5, 2)
+    checker = SequenceChecker()
+    checker.checkPackets(data)
+    assert (checker.lost, checker.duplicates, checker.reorders) == (0, 1, 1)
@@ -0,0 +1,89 @@
+"""
+Copyright 2024 Integrated Detector Electronics AS, Norway.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions
+are met:
+
+1. Redistributions of source code must retain the above copyright
+   notice, this list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+3. Neither the name of the copyright holder nor the names of its contributors
+   may be used to endorse or promote products derived from this software
+   without specific prior written permission.
+   
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS “AS IS”
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Tests of the TCPhandler shadow register cache against emulator.DoppioEmulator.
+
+Run: python -m pytest tests
+"""
+
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'ideasdoppyo'))
+
+import pytest
+from emulator import DoppioEmulator
+from tcphandler import TCPhandler
+
+
+@pytest.fixture
+def board():
+    with DoppioEmulator() as board:
+        yield board
+
+
+def connect(board: DoppioEmulator) -> TCPhandler:
+    tcp = TCPhandler(*board.tcp_address)
+    tcp.doPrint = False
+    return tcp
+
+
+def spiConfiguration(value: int) -> dict:
+    return {('spi', reg_addr): (value, 1, 8) for reg_addr in range(10)}
+
+
+def test_unchanged_configuration_is_elided(board):
+    tcp = connect(board)
+    assert tcp.applyConfiguration(spiConfiguration(3)) == []
+    n_requests = board.n_requests
+    assert tcp.applyConfiguration(spiConfiguration(3)) == []
+    assert board.n_requests == n_requests
+    assert tcp.elided_writes == 10
+
+
+def test_elision_per_asic_id(board):
+    tcp = connect(board)
+    assert tcp.applyConfiguration(spiConfiguration(3)) == []
+    tcp.asic_id = int(1).to_bytes(1, 'big')
+    n_requests = board.n_requests
+    assert tcp.applyConfiguration(spiConfiguration(3)) == []
+    assert board.n_requests == n_requests + 10
+    tcp.asic_id = int(0).to_bytes(1, 'big')
+    assert tcp.applyConfiguration(spiConfiguration(3)) == []
+    assert board.n_requests == n_requests + 10
+
+
+def test_reset_forgets_spi_registers(board):
+    tcp = connect(board)
+    configuration = spiConfiguration(3)
+    configuration[('sys', 0xFFA0)] = (1, 1)
+    assert tcp.applyConfiguration(configuration) == []
+    assert not any(key[0] == 'spi' for key in tcp.shadow)
+    n_requests = board.n_requests
+    assert tcp.applyConfiguration(spiConfiguration(3)) == []
+    assert board.n_requests == n_requests + 10